@@ -0,0 +1,18 @@
+from benchmarks.common import measure, summarize
+from givr.giveaway import Giveaway
+from givr.user import User
+import random
+import uuid
+
+
+def run(quick=False):
+    rows = []
+    for size in ((1000, 10000) if quick else (1000, 100000, 1000000)):
+        users = [User.from_user_id(str(uuid.uuid1())) for x in range(size)]
+        g = Giveaway(users=users)
+        for winners in (1, 100):
+            rows.append(summarize("giveaway.draw", measure(lambda: g.draw(winners), 200), users=size, winners=winners))
+        weighted = Giveaway(users=users, weights=[random.randint(1, 10) for u in users])
+        rows.append(summarize("giveaway.build_alias_table", measure(lambda: weighted.alias_table, 1), users=size))
+        rows.append(summarize("giveaway.draw_weighted", measure(lambda: weighted.draw(1), 200), users=size, winners=1))
+    return rows
@@ -0,0 +1,21 @@
+from benchmarks.common import measure, summarize
+from givr.room import House
+from unittest.mock import Mock
+import random
+import uuid
+
+
+def run(quick=False):
+    rows = []
+    house = House.get_instance()
+    for size in ((100, 1000) if quick else (100, 10000, 100000)):
+        rooms = [Mock(room_id=str(uuid.uuid1()), address=("127.0.0.1", 9000 + x)) for x in range(size)]
+        for room in rooms:
+            house.add_room(room)
+        room_ids = [random.choice(rooms).room_id for x in range(10000)]
+        it = iter(room_ids)
+        rows.append(summarize("house.get_room", measure(lambda: house.get_room(next(it)), len(room_ids)), rooms=size))
+        rows.append(summarize("house.get_available_port", measure(house.get_available_port, 1000), rooms=size))
+        for room in rooms:
+            house.remove_room(room)
+    return rows
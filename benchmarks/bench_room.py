@@ -0,0 +1,45 @@
+from benchmarks.common import measure, summarize
+from givr.membership import Membership, CompactMembership
+from givr.room import Room
+from givr.user import User
+import tracemalloc
+import uuid
+
+
+def membership_bytes(backend, uids):
+    """ Memory held by a `backend` filled with `uids`, counting the Users it keeps alive """
+    tracemalloc.start()
+    members = backend()
+    for uid in uids:
+        members.add(User.from_user_id(uid))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+
+def run(quick=False):
+    rows = []
+    for size in ((1000, 10000) if quick else (1000, 100000, 1000000)):
+        uids = [str(uuid.uuid1()) for x in range(size)]
+        # measured before any User exists, so the Users a backend keeps alive count against it
+        for backend in (Membership, CompactMembership):
+            total = membership_bytes(backend, uids)
+            rows.append(summarize("membership.memory", [0.0], users=size, membership=backend.__name__,
+                                  bytes_per_member=total / size))
+        users = User.from_user_ids(uids)
+        for backend in (Membership, CompactMembership):
+            name = backend.__name__
+            room = type("BenchRoom", (Room,), {"MEMBERSHIP": backend})()
+            room.open()
+            it = iter(users)
+            rows.append(summarize("room.add_user", measure(lambda: room.add_user(next(it)), size), users=size, membership=name))
+            it = iter(users)
+            rows.append(summarize("room.has_user", measure(lambda: room.has_user(next(it)), size), users=size, membership=name))
+            it = iter(users)
+            rows.append(summarize("room.remove_user", measure(lambda: room.remove_user(next(it)), size), users=size, membership=name))
+            for u in users:
+                room.add_user(u)
+            # what a GIVEAWAY command pays for the draw, however big the room
+            rows.append(summarize("room.draw", measure(lambda: room.draw(1), 200), users=size, winners=1, membership=name))
+            rows.append(summarize("room.close", measure(room.close, 1), users=size, membership=name))
+    return rows
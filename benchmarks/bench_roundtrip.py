@@ -0,0 +1,59 @@
+from benchmarks.common import measure, summarize
+from givr.room import House, WebSocketRoom
+from givr.roomserver import RoomServer
+from givr.frames import unmask
+import socket
+import struct
+import os
+import uuid
+
+
+def connect(address, room_id):
+    sck = socket.create_connection(address)
+    sck.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sck.sendall("GET /{room} HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n"
+                .format(room=room_id).encode())
+    response = b""
+    while b"\r\n\r\n" not in response:
+        response += sck.recv(4096)
+    return sck
+
+
+def send_text(sck, text):
+    payload = text.encode()
+    mask = os.urandom(4)
+    sck.sendall(struct.pack("!BB", 0x81, 0x80 | len(payload)) + mask + unmask(payload, mask))
+
+
+def recv_frame(sck):
+    first, length = sck.recv(2)
+    data = b""
+    while len(data) < length:
+        data += sck.recv(length - len(data))
+    return data
+
+
+def run(quick=False):
+    n = 500 if quick else 5000
+    house = House.get_instance()
+    server = RoomServer(address=("127.0.0.1", 0), house=house)
+    thread = server.dlisten()
+    room = WebSocketRoom(address=server.address)
+    room.open()
+    house.add_room(room)
+    clients = [connect(server.address, room.room_id) for x in range(10)]
+    joins = iter(["{u}:{r}:JOIN".format(u=uuid.uuid1(), r=room.room_id) for x in range(n)])
+
+    def round_trip():
+        client = clients[0]
+        send_text(client, next(joins))
+        recv_frame(client)
+
+    rows = [summarize("roundtrip.join", measure(round_trip, n), clients=len(clients))]
+    for client in clients:
+        client.close()
+    server.stop_listening()
+    thread.join(timeout=5)
+    house.remove_room(room)
+    return rows
@@ -0,0 +1,20 @@
+from benchmarks.common import measure, summarize
+from givr.socketmessage import SocketMessage
+import uuid
+
+
+def run(quick=False):
+    n = 2000 if quick else 20000
+    texts = ["{s}:{r}:JOIN".format(s=uuid.uuid1(), r=uuid.uuid1()) for x in range(n)]
+    it = iter(texts * 3)
+    rows = [summarize("socketmessage.from_text", measure(lambda: SocketMessage.from_text(next(it)), n))]
+    msgs = SocketMessage.from_texts(texts)
+    it = iter(msgs)
+    # fresh messages so the cached text isn't what gets measured
+    rows.append(summarize("socketmessage.to_text", measure(lambda: next(it).to_text(), n)))
+    it = iter(SocketMessage.from_texts(texts))
+    rows.append(summarize("socketmessage.to_bytes", measure(lambda: next(it).to_bytes(), n)))
+    frames = [m.to_bytes() for m in msgs]
+    it = iter(frames * 3)
+    rows.append(summarize("socketmessage.from_bytes", measure(lambda: SocketMessage.from_bytes(next(it)), n)))
+    return rows
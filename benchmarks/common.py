@@ -0,0 +1,69 @@
+import os
+# keep debug logging off the measured paths; must be set before any givr module is imported
+os.environ.setdefault("GIVR_LOG_LEVEL", "WARNING")
+
+import json
+import time
+import platform
+import subprocess
+import statistics
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    i = min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))
+    return ordered[i]
+
+
+def measure(fn, repeat):
+    """ Calls `fn` `repeat` times and returns the duration of each call in seconds """
+    samples = []
+    clock = time.perf_counter
+    for x in range(repeat):
+        start = clock()
+        fn()
+        samples.append(clock() - start)
+    return samples
+
+
+def summarize(name, samples, **params):
+    """ Builds a result row from per-operation durations in seconds """
+    mean = statistics.mean(samples)
+    row = {"name": name,
+           "runs": len(samples),
+           "p50_us": percentile(samples, 50) * 1e6,
+           "p99_us": percentile(samples, 99) * 1e6,
+           "mean_us": mean * 1e6,
+           "ops_per_sec": 1.0 / mean if mean else None}
+    row.update(params)
+    return row
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_row(row):
+    params = ", ".join("{k}={v}".format(k=k, v=v) for k, v in row.items()
+                       if k not in ("name", "runs", "p50_us", "p99_us", "mean_us", "ops_per_sec"))
+    print("{name:<32} {params:<24} p50 {p50:>10.2f}us  p99 {p99:>10.2f}us  {ops:>12.0f} ops/s".format(
+        name=row["name"], params=params, p50=row["p50_us"], p99=row["p99_us"], ops=row["ops_per_sec"] or 0))
+
+
+def save_results(rows, path=None):
+    commit = git_commit()
+    if not path:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, "{commit}-{ts}.json".format(commit=commit, ts=int(time.time())))
+    with open(path, "w") as f:
+        json.dump({"commit": commit,
+                   "timestamp": time.time(),
+                   "python": platform.python_version(),
+                   "machine": platform.machine(),
+                   "results": rows}, f, indent=2)
+    return path
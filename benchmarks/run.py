@@ -0,0 +1,54 @@
+""" Runs the benchmark suite, prints p50/p99 per workload and saves the results as JSON so runs can
+    be compared between commits:
+
+        python -m benchmarks.run [--quick] [--only room giveaway] [--output results.json]
+        python -m benchmarks.run --compare old.json new.json
+"""
+from benchmarks.common import print_row, save_results
+import argparse
+import importlib
+import json
+
+SUITES = ("socketmessage", "room", "giveaway", "house", "roundtrip")
+
+
+def row_key(row):
+    return tuple(sorted((k, v) for k, v in row.items() if k not in ("runs", "p50_us", "p99_us", "mean_us", "ops_per_sec")))
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = {row_key(r): r for r in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    for row in new:
+        before = old.get(row_key(row))
+        if before:
+            change = (row["p50_us"] - before["p50_us"]) / before["p50_us"] * 100 if before["p50_us"] else 0
+            print("{name:<32} p50 {old:>10.2f}us -> {new:>10.2f}us ({change:+.1f}%)".format(
+                name=row["name"], old=before["p50_us"], new=row["p50_us"], change=change))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quick", action="store_true", default=False, help="use smaller sizes")
+    parser.add_argument("--only", nargs="+", choices=SUITES, default=SUITES)
+    parser.add_argument("--output", default=None, help="where to save results (default benchmarks/results/)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    rows = []
+    for suite in args.only:
+        module = importlib.import_module("benchmarks.bench_{suite}".format(suite=suite))
+        for row in module.run(quick=args.quick):
+            print_row(row)
+            rows.append(row)
+    print("Results saved to {path}".format(path=save_results(rows, path=args.output)))
+
+
+if __name__ == "__main__":
+    main()
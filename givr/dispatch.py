@@ -0,0 +1,109 @@
+from givr.exceptions import GivrException, RoomException
+from givr.socketmessage import SocketMessage
+from givr.metrics import metrics
+from givr.logging import get_logger
+import functools
+import time
+
+logger = get_logger(__name__)
+
+# Middleware wraps a command handler once, when the dispatch table of a class is built, so the chain
+# costs nothing to resolve per message. Each middleware is called as `middleware(handler, command)`
+# and returns a `handler(room, msg)` that does its part and calls on to `handler`.
+
+
+def command(message, *middleware):
+    """ Registers the decorated method as the handler for `message`, wrapped in `middleware`
+        (outermost first) inside the class's own MIDDLEWARE """
+    def register(fn):
+        fn.command = (message, middleware)
+        return fn
+    return register
+
+
+def reply_failure(handler, command):
+    """ Turns an exception raised by the handler into a FAILURE reply to the sender """
+    @functools.wraps(handler)
+    def replying(room, msg):
+        try:
+            return handler(room, msg)
+        except GivrException as err:
+            logger.warning("A handled application error has occurred: {err}".format(err=err))
+            fail_msg = "{err_type}: '{err_msg}'".format(err_type=err.__class__.__name__, err_msg=err.args[0])
+        except Exception as err:
+            logger.error("An unhandled application error has occurred: {err}".format(err=err))
+            fail_msg = "{err_type}: '{err_msg}'".format(err_type=err.__class__.__name__,
+                                                      err_msg=err.args[0] if err.args else "")
+        return room.MessageClass(recipient=msg.sender,
+                                 sender=room.room_id,
+                                 message=SocketMessage.FAILURE,
+                                 info=fail_msg)
+    return replying
+
+
+def record_metrics(handler, command):
+    """ Counts the command by outcome and records how long the handler took """
+    record_command = metrics.record_command
+
+    @functools.wraps(handler)
+    def recording(room, msg):
+        outcome = "unhandled_error"
+        start = time.perf_counter()
+        try:
+            resp = handler(room, msg)
+            outcome = "ok"
+            return resp
+        except GivrException:
+            outcome = "handled_error"
+            raise
+        finally:
+            record_command(command, outcome, time.perf_counter() - start)
+    return recording
+
+
+def check_recipient(handler, command):
+    """ Answers messages addressed to another room with a FAILURE instead of handling them """
+    @functools.wraps(handler)
+    def checking(room, msg):
+        if msg.recipient != room.room_id:
+            logger.warning("Message sent to incorrect room: {msg}".format(msg=msg))
+            return room.MessageClass(recipient=msg.sender,
+                                     sender=room.room_id,
+                                     message=SocketMessage.FAILURE,
+                                     info="Message not intended for this room")
+        return handler(room, msg)
+    return checking
+
+
+def _unknown_command(room, msg):
+    raise RoomException("No handler for '{m}' messages".format(m=msg.message))
+
+
+class CommandDispatcher:
+    """ Builds `commands`, a table from message type to the fully wrapped handler, once for every
+        class that inherits it. Handlers are methods registered with `@command`; a subclass can
+        replace a handler by overriding the method under the same name, or add its own commands """
+
+    MIDDLEWARE = ()
+    commands = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        registered = {}  # method name -> (message, middleware), most derived registration wins
+        for klass in reversed(cls.__mro__):
+            for name, attr in vars(klass).items():
+                spec = getattr(attr, "command", None)
+                if isinstance(spec, tuple):
+                    registered[name] = spec
+        cls.commands = {message: cls.wrap(getattr(cls, name), message, middleware)
+                        for name, (message, middleware) in registered.items()}
+        # every valid message type gets an entry, so dispatching is a plain index
+        for message in SocketMessage.all_messages:
+            if message not in cls.commands:
+                cls.commands[message] = cls.wrap(_unknown_command, message, ())
+
+    @classmethod
+    def wrap(cls, handler, message, middleware):
+        for layer in reversed(cls.MIDDLEWARE + tuple(middleware)):
+            handler = layer(handler, message)
+        return handler
@@ -1,80 +1,120 @@
 from givr.app import app
-from givr.room import WebSocketRoom, House
-from givr.user import User
+from givr.operations import run_room_operation
+from givr.room import House
+from givr.exceptions import RoomException
+from givr.metrics import metrics
 from givr.logging import get_logger
-from flask import request, jsonify
+from flask import request, jsonify, Response
+import json
+import time
 
 logger = get_logger(__name__)
 
+ROUTER_POLL_INTERVAL = .5
+
+
+def room_operation(name, data):
+    """ Runs a room operation here, or forwards it to the worker that owns the room when the app
+        was started with a ShardRouter """
+    data = data if data else {}
+    router = app.config.get("GIVR_SHARD_ROUTER")
+    if router:
+        return router.forward(name, data)
+    return run_room_operation(name, data)
+
 @app.route("/api/room/create", methods=["POST"])
 def api_room_create():
-    data = request.get_json()
-    h = House.get_instance()
-    port = h.get_available_port()
-    room = WebSocketRoom(address=('127.0.0.1', port))
-    h.add_room(room)
-    return jsonify({"success": True, "room_id": room.room_id})
+    return jsonify(room_operation("create", request.get_json()))
 
 @app.route("/api/room/open", methods=["POST"])
 def api_room_open():
-    h = House.get_instance()
-    data = request.get_json()
-    room_id = data.get("room_id")
-    room = h.get_room(room_id)
-    room.open()
-    room.listen()
-    owner_id = data.get("owner_id")
-
-    resp = {"success": True, "address": room.address[0], "port": room.address[1]}
-    if owner_id:
-        room.add_owner(User.from_user_id(owner_id))
-        resp["owner_id"] = owner_id
-    return jsonify(resp)
+    return jsonify(room_operation("open", request.get_json()))
 
 @app.route("/api/room/close", methods=["POST"])
 def api_room_close():
-    h = House.get_instance()
-    data = request.get_json()
-    room_id = data.get("room_id")
-    room = h.get_room(room_id)
-    room.close()
-    if room.listening:
-        room.stop_listening()
-    resp = {"success": True, "address": room.address[0], "port": room.address[1]}
-    return jsonify(resp)
+    return jsonify(room_operation("close", request.get_json()))
 
 @app.route("/api/room/add_user", methods=["POST"])
 def api_room_add_user():
-    h = House.get_instance()
-    data = request.get_json()
-    user_id = data.get("user_id")
-    room_id = data.get("room_id")
-    room = h.get_room(room_id)
-    room.add_user(User.from_user_id(user_id))
-    return jsonify({"success": True, "room_id": room_id, "user_count": room.user_count()})
+    return jsonify(room_operation("add_user", request.get_json()))
 
 @app.route("/api/room/remove_user", methods=["POST"])
 def api_room_remove_user():
-    h = House.get_instance()
-    data = request.get_json()
-    user_id = data.get("user_id")
-    room_id = data.get("room_id")
-    room = h.get_room(room_id)
-    user = User.from_user_id(user_id)
-    if room.has_user(user):
-        room.remove_user(user)
-        resp = {"success": True, "user_count": room.user_count(), "room_id": room.room_id}
-    else:
-        resp = {"success": True, "user_count": room.user_count(), "message": "User not in room"}
-    return jsonify(resp)
+    return jsonify(room_operation("remove_user", request.get_json()))
+
+@app.route("/api/room/add_users", methods=["POST"])
+def api_room_add_users():
+    return jsonify(room_operation("add_users", request.get_json()))
+
+@app.route("/api/room/remove_users", methods=["POST"])
+def api_room_remove_users():
+    return jsonify(room_operation("remove_users", request.get_json()))
+
+@app.route("/api/room/bulk_membership", methods=["POST"])
+def api_room_bulk_membership():
+    return jsonify(room_operation("bulk_membership", request.get_json()))
 
 @app.route("/api/room/info", methods=["GET"])
 def api_room_info():
-    args = request.args
-    room = House.get_instance().get_room(args.get("room_id"))
-    return jsonify({"room_id": room.room_id,
-                    "is_open": room.is_open(),
-                    "user_count": room.user_count(),
-                    "owner": room.owner.user_id if room.owner else None,
-                    "address": room.address[0],
-                    "port": room.address[1]})
+    args = request.args.to_dict()
+    # the ETag follows the room's version counter, so an unchanged room answers 304 without
+    # building or encoding the info at all. The epoch of the process that owns the room keeps a
+    # version counted again after a restart from matching an old ETag
+    etag = "{room_id}-{epoch}-{version}".format(**room_operation("version", args))
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = jsonify(room_operation("info", args))
+    resp.set_etag(etag)
+    return resp
+
+def watch_room(room_id, timeout):
+    """ Yields the room's info each time it changes, coalescing every change made while the
+        previous info was being sent, and at least every `timeout` seconds """
+    router = app.config.get("GIVR_SHARD_ROUTER")
+    data = {"room_id": room_id}
+    version = None
+    while True:
+        if router:
+            # waiting inside a shard worker would hold its pipe, so sharded rooms are polled
+            if version is not None:
+                time.sleep(ROUTER_POLL_INTERVAL)
+        else:
+            House.get_instance().get_room(room_id).wait_for_change(version, timeout)
+        info = room_operation("info", data)
+        version = info["version"]
+        yield info
+
+@app.route("/api/room/events", methods=["GET"])
+def api_room_events():
+    """ Server-sent events stream of room-state deltas: the first event carries the full room info,
+        later ones only the fields that changed. Idle streams get a comment line every `timeout`
+        seconds so dead clients are noticed """
+    room_id = request.args.get("room_id")
+    timeout = float(request.args.get("timeout", 15))
+    changes = watch_room(room_id, timeout)
+    first = next(changes)  # unknown rooms fail here, before the stream starts
+
+    def stream():
+        last = first
+        yield "event: room\ndata: {d}\n\n".format(d=json.dumps(first))
+        try:
+            for info in changes:
+                delta = {k: v for k, v in info.items() if last.get(k) != v}
+                last = info
+                if delta:
+                    delta["room_id"] = room_id
+                    yield "event: room\ndata: {d}\n\n".format(d=json.dumps(delta))
+                else:
+                    yield ": keepalive\n\n"
+        except RoomException:
+            yield "event: removed\ndata: {d}\n\n".format(d=json.dumps({"room_id": room_id}))
+
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.route("/api/metrics", methods=["GET"])
+def api_metrics():
+    router = app.config.get("GIVR_SHARD_ROUTER")
+    # the rooms and commands of a sharded app live in its workers, this process has none
+    text = router.render_metrics() if router else metrics.render(House.get_instance())
+    return Response(text, mimetype="text/plain; version=0.0.4")
@@ -6,3 +6,9 @@ class RoomException(GivrException):
 
 class SocketMessageException(GivrException):
     pass
+
+class GiveawayException(GivrException):
+    pass
+
+class FrameException(GivrException):
+    pass
@@ -0,0 +1,142 @@
+from stevesockets.websocket import WebSocketFrame
+from givr.exceptions import FrameException
+import struct
+import zlib
+
+
+def encode_frame(payload, opcode=WebSocketFrame.OPCODE_TEXT, compressed=False):
+    """ Builds an unmasked, unfragmented server frame around `payload` (str or bytes). `compressed`
+        sets RSV1, which marks a permessage-deflate payload """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    length = len(payload)
+    first = 0x80 | (0x40 if compressed else 0) | opcode
+    if length <= 125:
+        header = struct.pack("!BB", first, length)
+    elif length < 2 ** 16:
+        header = struct.pack("!BBH", first, 126, length)
+    else:
+        header = struct.pack("!BBQ", first, 127, length)
+    return header + payload
+
+
+def unmask(payload, mask):
+    if not payload:
+        return payload
+    repeated = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(repeated, "big")).to_bytes(len(payload), "big")
+
+
+async def read_frame(reader, max_size=0):
+    """ Reads one frame from `reader` and returns `(fin, compressed, opcode, payload)`, `compressed`
+        being the RSV1 bit a permessage-deflate peer sets on a compressed message's first frame.
+        Raises FrameException, before reading the payload, when the frame declares a length over
+        `max_size` (0 for no limit) """
+    first, second = await reader.readexactly(2)
+    length = second & 0x7f
+    if length == 126:
+        length, = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack("!Q", await reader.readexactly(8))
+    if max_size and length > max_size:
+        raise FrameException("Frame of {n} bytes is over the {max} byte limit".format(n=length, max=max_size))
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask:
+        payload = unmask(payload, mask)
+    return bool(first & 0x80), bool(first & 0x40), first & 0x0f, payload
+
+
+class PerMessageDeflate:
+    """ permessage-deflate (RFC 7692) state for one connection. Outbound messages share one
+        compression context unless the client asked for server_no_context_takeover, so a broadcast
+        repeating the ids the connection has seen before shrinks to a few bytes. Inbound messages
+        are inflated with a context of their own """
+
+    NAME = "permessage-deflate"
+    # both servers negotiate compression with clients that offer it; False turns it off
+    ENABLED = True
+    TAIL = b"\x00\x00\xff\xff"
+    # a small window and memLevel keep each connection's compressor around 32KB instead of 256KB;
+    # room messages are short, so a bigger window finds hardly any more repeats
+    WINDOW_BITS = 12
+    MEM_LEVEL = 5
+    LEVEL = 6
+    # shorter messages go out uncompressed, a deflate block wouldn't make them any smaller
+    MIN_SIZE = 24
+
+    def __init__(self, window_bits=WINDOW_BITS, context_takeover=True, response=NAME):
+        self.window_bits = window_bits
+        self.context_takeover = context_takeover
+        self.response = response  # the Sec-WebSocket-Extensions value that accepted the offer
+        self._compressor = None
+        self._decompressor = None
+
+    @classmethod
+    def negotiate(cls, header):
+        """ Picks the first permessage-deflate offer in a Sec-WebSocket-Extensions header whose
+            parameters are supported, returning None when there is none """
+        for offer in (header or "").split(","):
+            name, *params = [p.strip() for p in offer.split(";")]
+            if name != cls.NAME:
+                continue
+            deflate = cls._accept(params)
+            if deflate:
+                return deflate
+        return None
+
+    @classmethod
+    def _accept(cls, params):
+        window_bits = cls.WINDOW_BITS
+        context_takeover = True
+        response = [cls.NAME]
+        seen = set()
+        for param in params:
+            key, _, value = param.partition("=")
+            key, value = key.strip(), value.strip().strip('"')
+            if key in seen:
+                return None
+            seen.add(key)
+            if key == "server_no_context_takeover" and not value:
+                context_takeover = False
+                response.append(key)
+            elif key == "client_no_context_takeover" and not value:
+                response.append(key)
+            elif key == "server_max_window_bits" and value.isdigit() and 9 <= int(value) <= 15:
+                # zlib can't produce raw deflate with an 8 bit window, so those offers are declined
+                window_bits = min(window_bits, int(value))
+                response.append("{key}={value}".format(key=key, value=value))
+            elif key == "client_max_window_bits" and (not value or value.isdigit() and 8 <= int(value) <= 15):
+                pass  # inflating with the full window handles whatever the client picks
+            else:
+                return None
+        return cls(window_bits=window_bits, context_takeover=context_takeover, response="; ".join(response))
+
+    def compress(self, data):
+        compressor = self._compressor
+        if compressor is None:
+            compressor = zlib.compressobj(self.LEVEL, zlib.DEFLATED, -self.window_bits, self.MEM_LEVEL)
+            if self.context_takeover:
+                self._compressor = compressor
+        # a sync flush always ends in the empty block the extension leaves off the wire
+        return (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+    def decompress(self, data, max_size=0):
+        """ Inflates one message, raising zlib.error when it's corrupt or inflates past `max_size` """
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj(-15)
+        decompressor = self._decompressor
+        data = decompressor.decompress(data + self.TAIL, max_size)
+        if decompressor.unconsumed_tail:
+            self._decompressor = None
+            raise zlib.error("Message inflates past {n} bytes".format(n=max_size))
+        return data
+
+    def encode_frame(self, payload, opcode=WebSocketFrame.OPCODE_TEXT):
+        """ Frames a data message, compressing it when it's long enough to be worth it. The frame
+            depends on this connection's compression context, so it can't be shared with others """
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if len(payload) < self.MIN_SIZE:
+            return encode_frame(payload, opcode=opcode)
+        return encode_frame(self.compress(payload), opcode=opcode, compressed=True)
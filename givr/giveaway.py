@@ -1,21 +1,118 @@
 from givr.logging import get_logger
+from givr.exceptions import GiveawayException
+import heapq
+import math
 import random
 
 logger = get_logger(__name__)
 
 
+class AliasTable:
+    """ Walker/Vose alias table over a list of non-negative weights. Building the table is O(n),
+        after which each weighted pick is O(1) """
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        if n == 0 or total <= 0:
+            raise GiveawayException("Weighted giveaway needs at least one positive weight")
+        if any(w < 0 for w in weights):
+            raise GiveawayException("Giveaway weights can't be negative")
+        self.size = n
+        self.eligible = sum(1 for w in weights if w > 0)
+        self.prob = [0.0] * n
+        self.alias = [0] * n
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # whatever is left over is 1.0 give or take float error
+        for i in large + small:
+            self.prob[i] = 1.0
+
+    def pick(self, rng):
+        i = rng.randrange(self.size)
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+
 class Giveaway:
 
-    def __init__(self, users=None):
+    # picks per winner before a weighted draw stops rejecting repeats
+    REJECTION_FACTOR = 4
+
+    def __init__(self, users=None, weights=None, rng=None):
         self.users = users
+        self.rng = rng if rng else random.Random()
+        self.weights = weights
+        self._alias_table = None
         logger.debug("New Giveaway created")
 
+    @property
+    def alias_table(self):
+        # built on first weighted draw and reused for every draw after it
+        if self._alias_table is None:
+            if len(self.weights) != len(self.users):
+                raise GiveawayException("Giveaway needs exactly one weight per user")
+            self._alias_table = AliasTable(self.weights)
+        return self._alias_table
+
     def draw(self, n):
-        choosable_users = self.users[:]
-        chosen_users = []
-        for x in range(n):
-            chosen_one = choosable_users[random.randrange(0, len(choosable_users))]
-            chosen_users.append(chosen_one)
-            choosable_users.remove(chosen_one)
-        logger.info("Giveaway selected users {users}".format(users=str(chosen_users)))
+        if n < 0:
+            raise GiveawayException("Can't draw a negative number of winners")
+        if self.weights is not None:
+            indices = self._draw_weighted(n)
+        else:
+            indices = self._draw_uniform(n)
+        chosen_users = [self.users[i] for i in indices]
+        logger.info("Giveaway selected %s users", len(chosen_users))
         return chosen_users
+
+    def _draw_uniform(self, n):
+        """ Partial Fisher-Yates shuffle that records swaps in a dict instead of shuffling a copy
+            of the entrant list, so picking n winners is O(n) regardless of how many users entered """
+        size = len(self.users)
+        if n > size:
+            raise GiveawayException("Can't draw {n} winners from {size} users".format(n=n, size=size))
+        swapped = {}
+        indices = []
+        for x in range(n):
+            j = self.rng.randrange(x, size)
+            indices.append(swapped.get(j, j))
+            swapped[j] = swapped.get(x, x)
+        return indices
+
+    def _draw_weighted(self, n):
+        """ Draws from the alias table, rejecting repeats so winners are distinct. Skewed weights can
+            make repeats all but certain, so after `n * REJECTION_FACTOR` picks the rest of the
+            winners come from `_draw_weighted_keys` instead """
+        table = self.alias_table
+        if n > table.eligible:
+            raise GiveawayException("Can't draw {n} winners from {size} weighted users".format(n=n, size=table.eligible))
+        chosen = set()
+        indices = []
+        attempts = n * self.REJECTION_FACTOR
+        while len(indices) < n and attempts:
+            attempts -= 1
+            i = table.pick(self.rng)
+            if i not in chosen:
+                chosen.add(i)
+                indices.append(i)
+        if len(indices) < n:
+            indices.extend(self._draw_weighted_keys(n - len(indices), chosen))
+        return indices
+
+    def _draw_weighted_keys(self, n, exclude):
+        """ Efraimidis-Spirakis weighted sampling without replacement: every eligible user gets the
+            key log(u) / weight for a uniform u, and the n largest keys win, in key order. O(users) """
+        rng = self.rng
+        keys = ((math.log(1.0 - rng.random()) / w, i)
+                for i, w in enumerate(self.weights) if w > 0 and i not in exclude)
+        return [i for key, i in heapq.nlargest(n, keys)]
@@ -0,0 +1,221 @@
+from givr.logging import get_logger
+import threading
+import json
+import mmap
+import os
+
+logger = get_logger(__name__)
+
+
+class RoomJournal:
+    """ Append-only journal of room lifecycle and membership events, one JSON list per line:
+
+            ["create", room_id, [host, port]]    ["open", room_id]      ["close", room_id]
+            ["owner", room_id, user_id]          ["add", room_id, [user_ids]]
+            ["remove", room_id, [user_ids]]      ["giveaway", room_id, [winner_ids], seed]
+            ["remove_room", room_id]
+
+        Events are buffered in memory and written and fsync'ed together by a background thread
+        every `sync_interval` seconds, so recording never waits on the disk; a crash loses at most
+        that window. `snapshot` compacts the journal into a snapshot of the current House and
+        starts a new journal generation. Replaying events is idempotent, so an event that lands in
+        both a snapshot and the journal after it is harmless """
+
+    SNAPSHOT_FILE = "snapshot.json"
+    JOURNAL_FILE = "journal-{generation}.log"
+
+    def __init__(self, directory, sync_interval=.05, snapshot_interval=300, snapshot_events=1000000):
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_events = snapshot_events
+        self.generation = 0
+        self.house = None
+        self._pending = []
+        self._events_since_snapshot = 0
+        self._file = None
+        self._lock = threading.Lock()  # guards the pending events, and is all that recording takes
+        self._io_lock = threading.Lock()  # guards the journal file and generation
+        self._stopped = threading.Event()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _journal_path(self, generation):
+        return os.path.join(self.directory, self.JOURNAL_FILE.format(generation=generation))
+
+    def record(self, *event):
+        line = json.dumps(event, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._pending.append(line)
+            self._events_since_snapshot += 1
+
+    def start(self, house):
+        """ Starts recording into the journal of the current generation and starts the background
+            thread that syncs it and takes periodic snapshots of `house` """
+        self.house = house
+        self._file = open(self._journal_path(self.generation), "a")
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        since_snapshot = 0.0
+        while not self._stopped.wait(self.sync_interval):
+            self.sync()
+            since_snapshot += self.sync_interval
+            if since_snapshot >= self.snapshot_interval or self._events_since_snapshot >= self.snapshot_events:
+                self.snapshot()
+                since_snapshot = 0.0
+
+    def sync(self):
+        with self._io_lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        """ Writes and fsyncs the buffered events; call with `_io_lock` held. The buffer is swapped
+            out under `_lock` so rooms keep recording while the disk is busy """
+        if not self._file:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if pending:
+            self._file.write("".join(pending))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        with self._io_lock:
+            self._write_pending()
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def snapshot(self):
+        """ Starts a fresh journal and then writes the state of every room to a new snapshot.
+            Recording is never held off: rooms record while holding their own locks, so their state
+            is collected without any journal lock held, and the snapshot is built and written after
+            the switch. Every event from the switch on is in the new journal, and replaying one the
+            snapshot already reflects is harmless """
+        with self._io_lock:
+            self._write_pending()
+            generation = self.generation + 1
+            if self._file:
+                self._file.close()
+                self._file = open(self._journal_path(generation), "a")
+            old_path = self._journal_path(self.generation)
+            self.generation = generation
+        with self._lock:
+            self._events_since_snapshot = 0
+        state = {"generation": generation, "rooms": [self._room_state(room) for room in self.house.rooms]}
+        tmp_path = os.path.join(self.directory, self.SNAPSHOT_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.directory, self.SNAPSHOT_FILE))
+        # the old journal is only needed until the snapshot covering it is on disk
+        if os.path.exists(old_path):
+            os.remove(old_path)
+        logger.info("Journal snapshot {g} written with {n} rooms".format(g=generation, n=len(state["rooms"])))
+
+    @staticmethod
+    def _room_state(room):
+        address = getattr(room, "address", None)
+        return {"room_id": room.room_id,
+                "address": list(address) if address else None,
+                "open": room.is_open(),
+                "owner": room.owner.user_id if room.owner else None,
+                "users": [u.user_id for u in room.users]}
+
+    def load(self):
+        """ Reads the latest snapshot and the journal after it and returns the rooms as a dict of
+            room_id -> room state, in the same shape `_room_state` writes """
+        rooms = {}
+        snapshot_path = os.path.join(self.directory, self.SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path) as f:
+                state = json.load(f)
+            self.generation = state["generation"]
+            for room in state["rooms"]:
+                room["users"] = dict.fromkeys(room["users"])
+                rooms[room["room_id"]] = room
+        # a crash while a snapshot was being written leaves the journal it started next to the
+        # snapshot's own, so every generation from the snapshot's on is replayed, oldest first
+        for generation in self._journal_generations():
+            journal_path = self._journal_path(generation)
+            if os.path.getsize(journal_path):
+                with open(journal_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    self._replay(m, rooms)
+            self.generation = generation
+        for room in rooms.values():
+            room["users"] = list(room["users"])
+        return rooms
+
+    def _journal_generations(self):
+        """ Removes the journals older than the snapshot and returns the generations of the rest """
+        generations = []
+        for name in os.listdir(self.directory):
+            if not (name.startswith("journal-") and name.endswith(".log")):
+                continue
+            try:
+                generation = int(name[len("journal-"):-len(".log")])
+            except ValueError:
+                continue
+            if generation < self.generation:
+                os.remove(os.path.join(self.directory, name))
+            else:
+                generations.append(generation)
+        return sorted(generations)
+
+    @staticmethod
+    def _decode(buffer):
+        """ Decodes every complete event in `buffer` with a single json.loads call """
+        end = buffer.rfind(b"\n") + 1
+        if end < len(buffer):
+            # a torn write from a crash; everything before it is intact
+            logger.warning("Ignoring incomplete event at the end of the journal")
+        if not end:
+            return []
+        data = buffer[:end - 1]
+        try:
+            return json.loads(b"[" + data.replace(b"\n", b",") + b"]")
+        except ValueError:
+            logger.warning("Journal has a corrupt event, skipping it")
+            events = []
+            for line in data.split(b"\n"):
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    pass
+            return events
+
+    @classmethod
+    def _replay(cls, buffer, rooms):
+        for event in cls._decode(buffer):
+            kind, room_id = event[0], event[1]
+            if kind == "create":
+                rooms.setdefault(room_id, {"room_id": room_id, "address": event[2], "open": False,
+                                           "owner": None, "users": {}})
+                continue
+            room = rooms.get(room_id)
+            if room is None:
+                continue
+            if kind == "add":
+                users = room["users"]
+                for user_id in event[2]:
+                    users[user_id] = None
+            elif kind == "remove":
+                for user_id in event[2]:
+                    room["users"].pop(user_id, None)
+            elif kind == "open":
+                room["open"] = True
+            elif kind == "close":
+                room["open"] = False
+                room["users"].clear()
+            elif kind == "owner":
+                room["owner"] = event[2]
+            elif kind == "remove_room":
+                del rooms[room_id]
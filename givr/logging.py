@@ -1,15 +1,63 @@
-import logging, sys, os
+import logging, logging.handlers, queue, sys, os, atexit, threading
+
+LOG_DIR = "logs"
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - (%(funcName)s): %(message)s"
+LOG_LEVEL = os.environ.get("GIVR_LOG_LEVEL", "DEBUG").upper()
+
+_queue_handler = None
+_listener = None
+_lock = threading.Lock()
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """ Puts records on the queue as they are, so message formatting happens on the writer thread
+        rather than on the thread that logged """
+
+    def prepare(self, record):
+        return record
+
+
+def _get_queue_handler():
+    """ Builds the shared stdout and file handlers once and starts the background thread that
+        drains the queue into them """
+    global _queue_handler, _listener
+    with _lock:
+        if _queue_handler is None:
+            formatter = logging.Formatter(LOG_FORMAT)
+            ch = logging.StreamHandler(sys.stdout)
+            ch.setLevel(logging.DEBUG)
+            ch.setFormatter(formatter)
+            os.makedirs(LOG_DIR, exist_ok=True)
+            fh = logging.FileHandler(os.path.join(LOG_DIR, "debug.log"))
+            fh.setLevel(logging.DEBUG)
+            fh.setFormatter(formatter)
+            log_queue = queue.SimpleQueue()
+            _listener = logging.handlers.QueueListener(log_queue, ch, fh, respect_handler_level=True)
+            _listener.start()
+            atexit.register(_listener.stop)
+            _queue_handler = DeferredQueueHandler(log_queue)
+    return _queue_handler
+
+
+def _restart_listener_in_child():
+    """ The writer thread doesn't survive a fork, so forked children (e.g. shard workers) start
+        their own listener on the inherited queue """
+    global _listener, _lock
+    _lock = threading.Lock()
+    if _listener is not None:
+        atexit.unregister(_listener.stop)
+        _listener = logging.handlers.QueueListener(_listener.queue, *_listener.handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+os.register_at_fork(after_in_child=_restart_listener_in_child)
+
 
 def get_logger(name):
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setLevel(logging.DEBUG)
-    fh = logging.FileHandler(os.path.join("logs", "debug.log"))
-    fh.setLevel(logging.DEBUG)
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - (%(funcName)s): %(message)s")
-    ch.setFormatter(formatter)
-    fh.setFormatter(formatter)
+    handler = _get_queue_handler()
     logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(ch)
-    logger.addHandler(fh)
+    logger.setLevel(LOG_LEVEL)
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
     return logger
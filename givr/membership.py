@@ -0,0 +1,196 @@
+from givr.exceptions import RoomException
+from givr.user import User
+import array
+
+# Membership backends for Room. Both keep every member at a position in a flat sequence, refilling
+# a leaving member's position from the end, so giveaways can pick winners by random index; they
+# differ in what a member costs. Rooms only call them with the room's lock held, except for
+# `len` and `in`, which are safe to call without it.
+
+
+class Membership:
+    """ Members as User objects in a list, with a dict from user_id to list position that keeps the
+        order users joined in """
+
+    def __init__(self):
+        self._positions = {}  # user_id -> position in _entrants, dicts keep insertion order
+        self._entrants = []
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, user_id):
+        return user_id in self._positions
+
+    def add(self, user):
+        """ Adds `user` and reports whether it wasn't a member yet """
+        if user.user_id in self._positions:
+            return False
+        self._positions[user.user_id] = len(self._entrants)
+        self._entrants.append(user)
+        return True
+
+    def add_all(self, users):
+        """ Adds every user and reports, per user, whether it wasn't a member yet """
+        add = self.add
+        return [add(user) for user in users]
+
+    def remove(self, user_id):
+        """ Removes the user and reports whether it was a member """
+        i = self._positions.pop(user_id, None)
+        if i is None:
+            return False
+        last = self._entrants.pop()
+        if i < len(self._entrants):
+            self._entrants[i] = last
+            self._positions[last.user_id] = i
+        return True
+
+    def users(self):
+        entrants = self._entrants
+        return [entrants[i] for i in self._positions.values()]
+
+    def entrants(self):
+        """ Every member, indexable by position, for Giveaway to draw from """
+        return self._entrants
+
+
+class CompactMembership:
+    """ Members as 16-byte binary UUIDs packed into one bytearray, with an open-addressing hash
+        index (linear probing over an array of positions) for O(1) lookups. A member costs 16 bytes
+        plus 6 to 12 bytes of index instead of a User and its 36 character id, so a million members
+        take about 30MB. User objects are only built for the members someone asks for, e.g.
+        a giveaway's winners.
+
+        Only UUID user ids can be stored, and `users` comes back in position order rather than the
+        order users joined in """
+
+    ID_SIZE = 16
+    EMPTY = -1
+    DELETED = -2
+    MIN_CAPACITY = 8
+
+    def __init__(self):
+        self._ids = bytearray()
+        self._count = 0
+        self._deleted = 0
+        self._index = array.array("i", [self.EMPTY]) * self.MIN_CAPACITY
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, user_id):
+        try:
+            key = User.id_to_bytes(user_id)
+        except ValueError:
+            return False
+        return self._find(key)[0] >= 0
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._count:
+            raise IndexError("Member position {i} out of range".format(i=i))
+        start = i * self.ID_SIZE
+        return User.from_user_id(User.id_from_bytes(self._ids[start:start + self.ID_SIZE]))
+
+    def _find(self, key):
+        """ Returns the position of `key`, or -1, and the index slot that holds it or that it should
+            be inserted at """
+        index = self._index
+        ids = self._ids
+        mask = len(index) - 1
+        size = self.ID_SIZE
+        i = hash(key) & mask
+        free = -1
+        while True:
+            pos = index[i]
+            if pos == self.EMPTY:
+                return -1, (free if free >= 0 else i)
+            if pos == self.DELETED:
+                if free < 0:
+                    free = i
+            elif ids[pos * size:pos * size + size] == key:
+                return pos, i
+            i = (i + 1) & mask
+
+    @staticmethod
+    def _key(user):
+        try:
+            return User.id_to_bytes(user.user_id)
+        except ValueError as err:
+            raise RoomException(err.args[0])
+
+    def add(self, user):
+        return self._add_key(self._key(user))
+
+    def add_all(self, users):
+        """ Adds every user and reports, per user, whether it wasn't a member yet. Every id is
+            packed before anything is added, so a non-UUID id raises RoomException with the
+            membership unchanged """
+        keys = [self._key(user) for user in users]
+        add = self._add_key
+        return [add(key) for key in keys]
+
+    def _add_key(self, key):
+        pos, slot = self._find(key)
+        if pos >= 0:
+            return False
+        if self._index[slot] == self.DELETED:
+            self._deleted -= 1
+        self._index[slot] = self._count
+        self._ids += key
+        self._count += 1
+        # keep at least a third of the slots empty so probes stay short
+        if (self._count + self._deleted) * 3 >= len(self._index) * 2:
+            self._rebuild_index()
+        return True
+
+    def remove(self, user_id):
+        try:
+            key = User.id_to_bytes(user_id)
+        except ValueError:
+            return False
+        pos, slot = self._find(key)
+        if pos < 0:
+            return False
+        self._index[slot] = self.DELETED
+        self._deleted += 1
+        size = self.ID_SIZE
+        last = self._count - 1
+        if pos != last:
+            last_key = bytes(self._ids[last * size:])
+            self._ids[pos * size:pos * size + size] = last_key
+            self._index[self._find(last_key)[1]] = pos
+        del self._ids[last * size:]
+        self._count -= 1
+        return True
+
+    def _rebuild_index(self):
+        """ Builds an index at most a third full, dropping the tombstones left by removals """
+        capacity = self.MIN_CAPACITY
+        while capacity < self._count * 3:
+            capacity *= 2
+        index = array.array("i", [self.EMPTY]) * capacity
+        mask = capacity - 1
+        ids = self._ids
+        size = self.ID_SIZE
+        for pos in range(self._count):
+            i = hash(bytes(ids[pos * size:pos * size + size])) & mask
+            while index[i] != self.EMPTY:
+                i = (i + 1) & mask
+            index[i] = pos
+        # swapped in whole, so a reader that isn't holding the room's lock sees one index or the other
+        self._index = index
+        self._deleted = 0
+
+    def users(self):
+        return User.from_user_ids(self.user_ids())
+
+    def user_ids(self):
+        ids = self._ids
+        size = self.ID_SIZE
+        from_bytes = User.id_from_bytes
+        return [from_bytes(ids[pos * size:pos * size + size]) for pos in range(self._count)]
+
+    def entrants(self):
+        # indexing builds the User for just the member asked for
+        return self
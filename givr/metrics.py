@@ -0,0 +1,138 @@
+from givr.logging import get_logger
+import threading
+import bisect
+
+logger = get_logger(__name__)
+
+
+class Metrics:
+    """ Command counters and latency histograms. Every thread records into its own shard, so the
+        hot path never takes a lock; shards are only summed when the metrics are rendered """
+
+    LATENCY_BUCKETS = (.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0)
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = {"commands": {}, "latency": {}}
+            with self._shards_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+            return shard
+
+    def record_command(self, command, outcome, seconds):
+        shard = self._shard()
+        key = (command, outcome)
+        commands = shard["commands"]
+        commands[key] = commands.get(key, 0) + 1
+        histogram = shard["latency"].get(command)
+        if histogram is None:
+            # one slot per bucket plus +Inf, then the running sum
+            histogram = shard["latency"][command] = [0] * (len(self.LATENCY_BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    def command_counts(self):
+        totals = {}
+        with self._shards_lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for key, count in list(shard["commands"].items()):
+                totals[key] = totals.get(key, 0) + count
+        return totals
+
+    def latency_histograms(self):
+        totals = {}
+        with self._shards_lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for command, histogram in list(shard["latency"].items()):
+                total = totals.setdefault(command, [0] * len(histogram))
+                for i, value in enumerate(list(histogram)):
+                    total[i] += value
+        return totals
+
+    def reset(self):
+        with self._shards_lock:
+            for shard in self._shards:
+                shard["commands"].clear()
+                shard["latency"].clear()
+
+    def render(self, house):
+        """ Renders every metric, including room and connection gauges read from `house`, in the
+            Prometheus text exposition format """
+        lines = ["# HELP givr_commands_total Socket commands handled, by command and outcome",
+                 "# TYPE givr_commands_total counter"]
+        for (command, outcome), count in sorted(self.command_counts().items()):
+            lines.append('givr_commands_total{{command="{c}",outcome="{o}"}} {n}'.format(c=command, o=outcome, n=count))
+
+        lines += ["# HELP givr_command_latency_seconds Time spent handling socket commands",
+                  "# TYPE givr_command_latency_seconds histogram"]
+        for command, histogram in sorted(self.latency_histograms().items()):
+            cumulative = 0
+            for bound, count in zip(self.LATENCY_BUCKETS + ("+Inf",), histogram):
+                cumulative += count
+                lines.append('givr_command_latency_seconds_bucket{{command="{c}",le="{le}"}} {n}'.format(
+                    c=command, le=bound, n=cumulative))
+            lines.append('givr_command_latency_seconds_sum{{command="{c}"}} {s}'.format(c=command, s=histogram[-1]))
+            lines.append('givr_command_latency_seconds_count{{command="{c}"}} {n}'.format(c=command, n=cumulative))
+
+        rooms = house.rooms
+        open_rooms = sum(1 for room in rooms if room.is_open())
+        lines += ["# HELP givr_rooms Rooms registered in the House",
+                  "# TYPE givr_rooms gauge",
+                  'givr_rooms{{state="open"}} {n}'.format(n=open_rooms),
+                  'givr_rooms{{state="closed"}} {n}'.format(n=len(rooms) - open_rooms),
+                  "# HELP givr_room_users Users in each room",
+                  "# TYPE givr_room_users gauge"]
+        lines += ['givr_room_users{{room_id="{r}"}} {n}'.format(r=room.room_id, n=room.user_count()) for room in rooms]
+        lines += ["# HELP givr_room_connections Open connections to each room",
+                  "# TYPE givr_room_connections gauge"]
+        room_server = house.room_server
+        for room in rooms:
+            connections = len(getattr(room, "connections", ()))
+            if room_server:
+                connections += len(room_server.room_connections.get(room.room_id, ()))
+            lines.append('givr_room_connections{{room_id="{r}"}} {n}'.format(r=room.room_id, n=connections))
+        if house.rate_limiter:
+            lines += ["# HELP givr_commands_rate_limited_total Commands rejected by the rate limiter",
+                      "# TYPE givr_commands_rate_limited_total counter",
+                      "givr_commands_rate_limited_total {n}".format(n=house.rate_limiter.rejected)]
+        if house.reaper:
+            lines += ["# HELP givr_rooms_evicted_total Idle or closed rooms evicted by the reaper",
+                      "# TYPE givr_rooms_evicted_total counter",
+                      "givr_rooms_evicted_total {n}".format(n=house.reaper.evicted)]
+        return "\n".join(lines) + "\n"
+
+
+def merge_shards(rendered):
+    """ Merges the rendered metrics of several shard workers, `{shard: text}`, into one exposition
+        with a `shard` label on every sample and each metric's HELP and TYPE lines only once """
+    families = {}  # metric name -> (HELP and TYPE lines, samples of every shard), in the order first seen
+    for shard, text in sorted(rendered.items()):
+        label = 'shard="{s}"'.format(s=shard)
+        samples = None
+        for line in text.splitlines():
+            if line.startswith("# "):
+                headers, samples = families.setdefault(line.split()[2], ([], []))
+                if line not in headers:
+                    headers.append(line)
+            elif line:
+                name, labelled, rest = line.partition("{")
+                if labelled:
+                    samples.append("{n}{{{l},{r}".format(n=name, l=label, r=rest))
+                else:
+                    name, _, value = line.partition(" ")
+                    samples.append("{n}{{{l}}} {v}".format(n=name, l=label, v=value))
+    lines = []
+    for headers, samples in families.values():
+        lines += headers + samples
+    return "\n".join(lines) + "\n"
+
+metrics = Metrics()
@@ -0,0 +1,192 @@
+from givr.room import House
+from givr.user import User
+from givr.exceptions import RoomException
+from givr.metrics import metrics
+from givr.logging import get_logger
+
+logger = get_logger(__name__)
+
+# Room operations behind the /api/room/* endpoints. Each takes the House that owns the room and the
+# request data and returns the response dict, so the same code runs in the Flask process or in the
+# shard worker that owns the room.
+
+
+def room_create(h, data):
+    return _create_room(h)
+
+
+def room_create_with_id(h, data):
+    """ Creates the room under the id the shard router picked up front, so it knows which worker
+        owns the room. Only shard workers run this; clients never get to choose a room's id """
+    return _create_room(h, data["room_id"])
+
+
+def _create_room(h, room_id=None):
+    room = h.room_pool.take() if h.room_pool else None
+    if room is None:
+        room = h.new_room()
+    if room_id:
+        room.room_id = room_id
+    h.add_room(room)
+    return {"success": True, "room_id": room.room_id}
+
+
+def room_open(h, data):
+    room_id = data.get("room_id")
+    room = h.get_room(room_id)
+    room.open()
+    if not h.is_multiplexed(room) and not room.listening:
+        # listen() loops until the room stops listening, so it runs on the room's own thread. Rooms
+        # handed out by the RoomPool are already listening
+        room.dlisten()
+    owner_id = data.get("owner_id")
+
+    resp = {"success": True, "address": room.address[0], "port": room.address[1]}
+    if owner_id:
+        room.add_owner(User.from_user_id(owner_id))
+        resp["owner_id"] = owner_id
+    return resp
+
+
+def room_close(h, data):
+    room_id = data.get("room_id")
+    room = h.get_room(room_id)
+    room.close()
+    if room.listening:
+        room.stop_listening()
+    if h.reaper:
+        # closed rooms expire after closed_ttl, which may be sooner than the schedule they have
+        h.reaper.track(room)
+    return {"success": True, "address": room.address[0], "port": room.address[1]}
+
+
+def room_add_user(h, data):
+    user_id = data.get("user_id")
+    room_id = data.get("room_id")
+    room = h.get_room(room_id)
+    room.add_user(User.from_user_id(user_id))
+    return {"success": True, "room_id": room_id, "user_count": room.user_count()}
+
+
+def room_remove_user(h, data):
+    user_id = data.get("user_id")
+    room_id = data.get("room_id")
+    room = h.get_room(room_id)
+    user = User.from_user_id(user_id)
+    if room.has_user(user):
+        room.remove_user(user)
+        return {"success": True, "user_count": room.user_count(), "room_id": room.room_id}
+    else:
+        return {"success": True, "user_count": room.user_count(), "message": "User not in room"}
+
+
+def room_add_users(h, data):
+    room_id = data.get("room_id")
+    user_ids = data.get("user_ids") or []
+    room = h.get_room(room_id)
+    added = room.add_users([User.from_user_id(uid) for uid in user_ids])
+    return {"success": True,
+            "room_id": room_id,
+            "results": [{"user_id": uid, "added": a} for uid, a in zip(user_ids, added)],
+            "user_count": room.user_count()}
+
+
+def room_remove_users(h, data):
+    room_id = data.get("room_id")
+    user_ids = data.get("user_ids") or []
+    room = h.get_room(room_id)
+    removed = room.remove_users([User.from_user_id(uid) for uid in user_ids])
+    return {"success": True,
+            "room_id": room_id,
+            "results": [{"user_id": uid, "removed": r} for uid, r in zip(user_ids, removed)],
+            "user_count": room.user_count()}
+
+
+def _apply_one(apply, user):
+    try:
+        return True, apply([user])[0]
+    except RoomException as err:
+        return False, err.args[0]
+
+
+def room_bulk_membership(h, data):
+    """ Applies a list of `{"room_id", "user_id", "action": "add"|"remove"}` items, grouped per room
+        so each room is looked up once. A failing item (unknown room, closed room, bad action) is
+        reported in its own result without stopping the rest """
+    items = data.get("memberships") or []
+    results = [None] * len(items)
+    by_room = {}
+    for i, item in enumerate(items):
+        by_room.setdefault(item.get("room_id"), []).append(i)
+
+    user_counts = {}
+    for room_id, indices in by_room.items():
+        try:
+            room = h.get_room(room_id)
+        except RoomException as err:
+            for i in indices:
+                results[i] = {"room_id": room_id, "user_id": items[i].get("user_id"), "success": False,
+                              "message": err.args[0]}
+            continue
+        for action, apply in (("add", room.add_users), ("remove", room.remove_users)):
+            action_indices = [i for i in indices if items[i].get("action", "add") == action]
+            if not action_indices:
+                continue
+            users = [User.from_user_id(items[i].get("user_id")) for i in action_indices]
+            try:
+                outcomes = [(True, changed) for changed in apply(users)]
+            except RoomException:
+                # a batch is applied all or nothing, so the items go one at a time to find the ones
+                # that failed
+                outcomes = [_apply_one(apply, user) for user in users]
+            for (success, outcome), i in zip(outcomes, action_indices):
+                result = {"room_id": room_id, "user_id": items[i].get("user_id"), "success": success}
+                result["changed" if success else "message"] = outcome
+                results[i] = result
+        for i in indices:
+            if results[i] is None:
+                results[i] = {"room_id": room_id, "user_id": items[i].get("user_id"), "success": False,
+                              "message": "Unknown action '{a}'".format(a=items[i].get("action"))}
+        user_counts[room_id] = room.user_count()
+    return {"success": True, "results": results, "user_counts": user_counts}
+
+
+def room_version(h, data):
+    return {"room_id": data.get("room_id"), "version": h.get_room(data.get("room_id")).version, "epoch": h.epoch}
+
+
+def room_info(h, data):
+    room = h.get_room(data.get("room_id"))
+    snapshot = room.snapshot()
+    return {"room_id": room.room_id,
+            "version": snapshot.version,
+            "is_open": snapshot.is_open,
+            "user_count": snapshot.user_count,
+            "owner": snapshot.owner,
+            "address": room.address[0],
+            "port": room.address[1]}
+
+
+ROOM_OPERATIONS = {
+    "create": room_create,
+    "open": room_open,
+    "close": room_close,
+    "add_user": room_add_user,
+    "remove_user": room_remove_user,
+    "add_users": room_add_users,
+    "remove_users": room_remove_users,
+    "bulk_membership": room_bulk_membership,
+    "info": room_info,
+    "version": room_version,
+}
+
+def worker_metrics(h, data):
+    return {"success": True, "metrics": metrics.render(h)}
+
+
+# what the shard router may ask its workers for on top of the operations behind the endpoints
+WORKER_OPERATIONS = dict(ROOM_OPERATIONS, create_with_id=room_create_with_id, metrics=worker_metrics)
+
+
+def run_room_operation(name, data, house=None, operations=ROOM_OPERATIONS):
+    return operations[name](house if house else House.get_instance(), data)
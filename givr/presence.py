@@ -0,0 +1,125 @@
+from givr.reaper import TimerWheel
+from givr.socketmessage import SocketMessage
+from givr.user import User
+from givr.logging import get_logger
+import contextvars
+import functools
+import threading
+import time
+
+logger = get_logger(__name__)
+
+# (Presence, connection) of the frame being handled, set by the server that read it so the JOIN and
+# LEAVE handlers can record which connection a user came in on
+current_connection = contextvars.ContextVar("current_connection", default=None)
+
+
+class Presence:
+    """ Tracks which users joined which rooms through which connection, so that users are removed
+        from their rooms when their connection goes away instead of staying until they send LEAVE.
+
+        Servers report every frame they read with `seen` and get back, from `expire`, the connections
+        that sent nothing for `timeout` seconds. Heartbeat pings every `ping_interval` keep healthy
+        but quiet clients answering. Connections sit on a TimerWheel, so finding the expired ones
+        is a batch job on a timer that only looks at connections that are due """
+
+    # connections silent for this many seconds are closed and their users removed from their rooms,
+    # the default of both servers' HEARTBEAT_TIMEOUT
+    TIMEOUT = 30.0
+
+    def __init__(self, timeout=TIMEOUT, slots=64):
+        self.timeout = timeout
+        self.ping_interval = timeout / 3
+        self.wheel = TimerWheel(tick=min(1.0, timeout / 10), slots=slots)
+        self._last_seen = {}  # connection -> monotonic time of its last frame
+        self._joined = {}  # connection -> {(room, user_id)}
+        self._connections = {}  # (room, user_id) -> connections the user joined through
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._last_seen)
+
+    @property
+    def connections(self):
+        return list(self._last_seen)
+
+    def connected(self, connection, now=None):
+        now = time.monotonic() if now is None else now
+        self._last_seen[connection] = now
+        self.wheel.schedule(connection, now + self.timeout)
+
+    def seen(self, connection, now=None):
+        if connection in self._last_seen:
+            self._last_seen[connection] = time.monotonic() if now is None else now
+        else:
+            self.connected(connection, now)
+
+    def joined(self, connection, room, user_id):
+        with self._lock:
+            self._joined.setdefault(connection, set()).add((room, user_id))
+            self._connections.setdefault((room, user_id), set()).add(connection)
+
+    def left(self, connection, room, user_id):
+        with self._lock:
+            key = (room, user_id)
+            self._joined.get(connection, set()).discard(key)
+            # a user that left through one connection has left, whichever others it joined through
+            for other in self._connections.pop(key, ()):
+                self._joined.get(other, set()).discard(key)
+
+    def disconnected(self, connection):
+        """ Forgets `connection` and removes every user that was only in a room through it, one
+            batch per room """
+        self._last_seen.pop(connection, None)
+        leaving = {}
+        with self._lock:
+            for key in self._joined.pop(connection, ()):
+                connections = self._connections.get(key)
+                connections.discard(connection)
+                if not connections:
+                    del self._connections[key]
+                    room, user_id = key
+                    leaving.setdefault(room, []).append(user_id)
+        for room, user_ids in leaving.items():
+            logger.debug("Removing %s disconnected users from room '%s'", len(user_ids), room.room_id)
+            room.remove_users(User.from_user_ids(user_ids))
+        return sum(len(user_ids) for user_ids in leaving.values())
+
+    def idle(self, now=None):
+        """ Returns the connections that have been quiet for at least `ping_interval` """
+        since = (time.monotonic() if now is None else now) - self.ping_interval
+        return [connection for connection, last_seen in list(self._last_seen.items()) if last_seen <= since]
+
+    def expire(self, now=None):
+        """ Returns the connections that have been silent for longer than `timeout`. It's up to the
+            server to close them and report them `disconnected` """
+        now = time.monotonic() if now is None else now
+        expired = []
+        for connection in self.wheel.expire(now):
+            last_seen = self._last_seen.get(connection)
+            if last_seen is None:
+                continue  # already disconnected
+            if last_seen + self.timeout > now:
+                self.wheel.schedule(connection, last_seen + self.timeout)
+            else:
+                expired.append(connection)
+        return expired
+
+
+def track_presence(handler, command):
+    """ Middleware for JOIN and LEAVE that records the user against the connection the message came
+        in on, when the server handling it tracks presence """
+    joining = command == SocketMessage.JOIN
+
+    @functools.wraps(handler)
+    def tracking(room, msg):
+        resp = handler(room, msg)
+        current = current_connection.get()
+        if current is not None and resp.message == SocketMessage.SUCCESS:
+            presence, connection = current
+            if joining:
+                presence.joined(connection, room, msg.sender)
+            else:
+                presence.left(connection, room, msg.sender)
+        return resp
+    return tracking
@@ -0,0 +1,105 @@
+from givr.logging import get_logger
+import threading
+import weakref
+import time
+
+logger = get_logger(__name__)
+
+
+class TokenBucket:
+    """ Holds up to `burst` tokens and refills at `rate` tokens a second """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst=None, now=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now=None):
+        """ Takes a token if one is available and reports whether it did """
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now=None):
+        """ Seconds until the next token is available """
+        self._refill(time.monotonic() if now is None else now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def is_full(self, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens >= self.burst
+
+
+class RateLimiter:
+    """ Token-bucket limits on what clients send to rooms:
+
+        - every connection may send `connection_rate` frames a second (bursts of `connection_burst`).
+          Over its limit a connection simply isn't read from until it has a token again, so its data
+          waits in the socket buffers and TCP pushes back on the client
+        - every sender may send each command at the `(rate, burst)` given for it in `command_limits`.
+          Over-limit commands are answered with a FAILURE without being parsed or handled
+
+        Commands are checked on their raw text, so rejecting one costs a split and a dict lookup """
+
+    COMMAND_LIMITS = {
+        "JOIN": (5, 10),
+        "LEAVE": (5, 10),
+        "GIVEAWAY": (1, 5),
+    }
+    MAX_SENDERS = 100000
+
+    def __init__(self, connection_rate=100, connection_burst=None, command_limits=None):
+        self.connection_rate = connection_rate
+        self.connection_burst = connection_burst if connection_burst is not None else connection_rate
+        self.command_limits = dict(self.COMMAND_LIMITS if command_limits is None else command_limits)
+        self.rejected = 0
+        self._connections = weakref.WeakKeyDictionary()  # connection -> TokenBucket
+        self._senders = {}  # (sender, command) -> TokenBucket
+        self._lock = threading.Lock()
+
+    def connection_delay(self, connection, now=None):
+        """ Takes a token for the next frame from `connection` and returns 0, or returns how many
+            seconds to wait before reading from it again """
+        bucket = self._connections.get(connection)
+        if bucket is None:
+            bucket = self._connections[connection] = TokenBucket(self.connection_rate, self.connection_burst, now)
+        if bucket.take(now):
+            return 0
+        return bucket.wait_time(now)
+
+    def allow(self, text, now=None):
+        """ Reports whether the sender of the raw command `text` may send it now """
+        parts = text.split(":", 3)
+        if len(parts) < 3:
+            return True  # left for the parser to reject
+        return self.allow_command(parts[0], parts[2].rstrip("\r\n"), now)
+
+    def allow_command(self, sender, command, now=None):
+        """ Reports whether `sender` may send `command` now """
+        limit = self.command_limits.get(command)
+        if limit is None:
+            return True
+        key = (sender, command)
+        with self._lock:
+            bucket = self._senders.get(key)
+            if bucket is None:
+                if len(self._senders) >= self.MAX_SENDERS:
+                    self._prune(now)
+                bucket = self._senders[key] = TokenBucket(*limit, now=now)
+            allowed = bucket.take(now)
+        if not allowed:
+            self.rejected += 1
+            logger.debug("Rate limited '%s' from '%s'", command, sender)
+        return allowed
+
+    def _prune(self, now=None):
+        # a full bucket is indistinguishable from a new one, so forgetting it changes nothing
+        self._senders = {key: bucket for key, bucket in self._senders.items() if not bucket.is_full(now)}
@@ -0,0 +1,152 @@
+from givr.exceptions import RoomException
+from givr.logging import get_logger
+import threading
+import time
+import math
+
+logger = get_logger(__name__)
+
+
+class TimerWheel:
+    """ Hashed timer wheel: a ring of `slots` buckets, each covering `tick` seconds. Scheduling drops
+        the item in the bucket its deadline hashes to and expiring walks only the buckets whose tick
+        has passed, so both cost O(1) per item however many are scheduled. Deadlines more than one
+        turn of the wheel away wait in their bucket until the turn they're due in """
+
+    def __init__(self, tick=1.0, slots=512, now=None):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._current = self._tick_of(time.monotonic() if now is None else now)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._slots)
+
+    def _tick_of(self, t):
+        return math.floor(t / self.tick)
+
+    def schedule(self, item, deadline):
+        # never in a bucket that has already been walked, or it would wait a whole turn
+        due = max(math.ceil(deadline / self.tick), self._current + 1)
+        with self._lock:
+            self._slots[due % len(self._slots)].append((due, item))
+
+    def expire(self, now=None):
+        """ Removes and returns every item whose deadline has passed """
+        target = self._tick_of(time.monotonic() if now is None else now)
+        expired = []
+        with self._lock:
+            # after a long stall every bucket is due at most once
+            first = max(self._current + 1, target - len(self._slots) + 1)
+            for t in range(first, target + 1):
+                i = t % len(self._slots)
+                slot = self._slots[i]
+                if not slot:
+                    continue
+                self._slots[i] = [entry for entry in slot if entry[0] > target]
+                expired.extend(item for due, item in slot if due <= target)
+            self._current = max(self._current, target)
+        return expired
+
+
+class RoomReaper:
+    """ Evicts rooms from the House once they have been idle for `ttl` seconds, or closed (or created
+        and never opened) for `closed_ttl` seconds. Evicting a room stops its server, drops its
+        RoomServer connections and releases its port.
+
+        Every room is scheduled once for the time it would expire if nothing happened. When that time
+        comes the room's `last_active` is checked and a room that was used in the meantime is simply
+        scheduled again for its new expiry, so activity itself costs no more than a timestamp. Closing
+        a room schedules it again for its closed expiry; only a room's latest schedule counts """
+
+    def __init__(self, house, ttl=3600, closed_ttl=None, tick=1.0, slots=512):
+        self.house = house
+        self.ttl = ttl
+        self.closed_ttl = ttl if closed_ttl is None else closed_ttl
+        self.wheel = TimerWheel(tick=tick, slots=slots)
+        self.evicted = 0
+        self._deadlines = {}  # room_id -> the deadline of the room's latest schedule
+        # request threads schedule rooms (room_close) while the reaper thread reaps them
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        for room in self.house.rooms:
+            self.track(room)
+        self.house.reaper = self
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        if self.house.reaper is self:
+            self.house.reaper = None
+
+    def track(self, room):
+        self._schedule(room, self.expires_at(room))
+
+    def _schedule(self, room, deadline):
+        # an earlier schedule of the room stays in the wheel and is skipped when it comes up
+        with self._lock:
+            self._deadlines[room.room_id] = deadline
+            self.wheel.schedule((room, deadline), deadline)
+
+    def expires_at(self, room):
+        return room.last_active + (self.ttl if room.is_open() else self.closed_ttl)
+
+    def reap(self, now=None):
+        """ Evicts every room that is due and returns how many were evicted """
+        now = time.monotonic() if now is None else now
+        evicted = 0
+        for room, deadline in self.wheel.expire(now):
+            # held until the room's deadline is settled, so a track() from a request thread can't
+            # land in between and be deleted along with the deadline it replaced
+            with self._lock:
+                if self._deadlines.get(room.room_id) != deadline:
+                    continue  # scheduled again since
+                if not self.house.has_room(room):
+                    del self._deadlines[room.room_id]  # removed since it was scheduled
+                    continue
+                expires_at = now + self.ttl if self.is_busy(room) else self.expires_at(room)
+                if expires_at > now:
+                    self._schedule(room, expires_at)
+                    continue
+                del self._deadlines[room.room_id]
+            if self.evict(room):
+                evicted += 1
+        return evicted
+
+    def is_busy(self, room):
+        """ Open rooms with a client still connected, or someone watching their events, aren't idle.
+            Closed rooms never are: their clients are dropped when they're evicted """
+        if not room.is_open():
+            return False
+        if room._watchers:
+            return True
+        if self.house.is_multiplexed(room):
+            return bool(self.house.room_server.room_connections.get(room.room_id))
+        return any(not c.is_closed() for c in getattr(room, "connections", ()))
+
+    def evict(self, room):
+        logger.info("Evicting idle room '{r}'".format(r=room.room_id))
+        if getattr(room, "listening", False):
+            room.stop_listening()
+        if self.house.is_multiplexed(room):
+            self.house.room_server.drop_room(room.room_id)
+        try:
+            self.house.remove_room(room)
+        except RoomException:
+            return False
+        self.evicted += 1
+        return True
+
+    def _run(self):
+        while not self._stopped.wait(self.wheel.tick):
+            try:
+                self.reap()
+            except Exception as err:
+                logger.error("Room reaper failed: {err}".format(err=err))
@@ -2,17 +2,33 @@ from givr.exceptions import RoomException, GivrException
 from givr.user import User
 from givr.socketmessage import SocketMessage
 from givr.giveaway import Giveaway
+from givr.membership import Membership
 from givr.logging import get_logger
-from stevesockets.websocket import WebSocketFrame
+from givr.frames import encode_frame, PerMessageDeflate
+from givr.dispatch import CommandDispatcher, command, check_recipient, record_metrics, reply_failure
+from givr.presence import Presence, current_connection, track_presence
+import collections
+import random
+import secrets
 import uuid
+import threading
+import time
+import gc
 import functools
 
 logger = get_logger(__name__)
 
 
 class House:
+    """ Registry of rooms and the ports they listen on. Registration and port allocation happen
+        under the House's lock; looking a room up or listing the rooms doesn't take it """
 
     _instance = None
+    _instance_lock = threading.Lock()
+    FIRST_PORT = 9000
+    LAST_PORT = 65535
+    # seconds a port that failed to bind is kept from being handed out again
+    PORT_QUARANTINE = 30.0
 
     def __init__(self, log=None):
         if self._instance:
@@ -20,176 +36,729 @@ class House:
         if not log:
             log = logger
         self.logger = log
-        self.rooms = []
+        self._lock = threading.RLock()
+        self._rooms = {}
+        self._room_ports = {}
+        self._ports_in_use = set()
+        self._free_ports = []
+        self._quarantined = {}  # port -> monotonic time it may be handed out again
+        self._next_port = self.FIRST_PORT
+        self._last_port = self.LAST_PORT
+        self.room_server = None  # set while a RoomServer is multiplexing every room on one port
+        self.room_pool = None
+        self.reaper = None
+        self.rate_limiter = None
+        self.journal = None
+        # room versions start over when a process restarts and recovers its rooms from the journal,
+        # so anything caching by version has to tell the processes apart
+        self.epoch = secrets.token_hex(4)
+
+    @property
+    def rooms(self):
+        return list(self._rooms.values())
 
     def add_room(self, room):
-        self.rooms.append(room)
+        with self._lock:
+            if room.room_id in self._rooms:
+                raise RoomException("Room with id '{room_id}' already registered".format(room_id=room.room_id))
+            self._rooms[room.room_id] = room
+            room.journal = self.journal
+            address = getattr(room, "address", None)
+            if self.journal:
+                self.journal.record("create", room.room_id, list(address) if address else None)
+            if address and not self.is_multiplexed(room):
+                self._room_ports[room.room_id] = address[1]
+                self._ports_in_use.add(address[1])
+            if self.reaper:
+                self.reaper.track(room)
 
     def remove_room(self, room):
-        self.rooms.remove(room)
+        with self._lock:
+            if self._rooms.get(room.room_id) is not room:
+                raise RoomException("No rooms found with id '{room_id}'".format(room_id=room.room_id))
+            del self._rooms[room.room_id]
+            if self.journal:
+                self.journal.record("remove_room", room.room_id)
+            room.journal = None
+            port = self._room_ports.pop(room.room_id, None)
+            if port is not None:
+                # a room that is still listening holds on to its port until its listen thread closes
+                # the socket, handing the port out before that would fail to bind
+                room.when_stopped(functools.partial(self.release_port, port))
+
+    def has_room(self, room):
+        """ Whether `room` itself, not just a room with its id, is registered """
+        return self._rooms.get(room.room_id) is room
 
     def get_room(self, room_id):
-        r = [room for room in self.rooms if room.room_id == room_id]
-        if len(r) > 1:
-            self.logger.warn("More than one room found with id '{room_id}'?".format(room_id=room_id))
-        elif len(r) == 0:
+        try:
+            return self._rooms[room_id]
+        except KeyError:
             self.logger.error("No rooms found with id '{room_id}'".format(room_id=room_id))
             raise RoomException("No rooms found with id '{room_id}'".format(room_id=room_id))
-        else:
-            return r[0]
+
+    def attach_journal(self, journal):
+        """ Rebuilds the rooms saved in `journal` (latest snapshot plus the journal after it) and
+            records every change from then on """
+        # recovery allocates millions of small objects and none of them are garbage, so cyclic
+        # GC passes would only slow it down
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for state in journal.load().values():
+                self.restore_room(state)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.journal = journal
+        for room in self._rooms.values():
+            room.journal = journal
+        journal.start(self)
+        self.logger.info("Recovered {n} rooms from the journal".format(n=len(self._rooms)))
+
+    def listen_open_rooms(self):
+        """ Starts listening for every open room that isn't served by the RoomServer, e.g. rooms that
+            were just recovered from the journal """
+        for room in self._rooms.values():
+            if room.is_open() and hasattr(room, "dlisten") and not room.listening and not self.is_multiplexed(room):
+                room.dlisten()
+
+    def detach_journal(self):
+        """ Stops recording and flushes whatever the journal still has buffered """
+        journal, self.journal = self.journal, None
+        for room in self._rooms.values():
+            room.journal = None
+        if journal:
+            journal.stop()
+
+    def restore_room(self, state):
+        room = WebSocketRoom(address=tuple(state["address"])) if state["address"] else Room()
+        room.room_id = state["room_id"]
+        room._open = state["open"]
+        room.owner = User.from_user_id(state["owner"]) if state["owner"] else None
+        room.users = User.from_user_ids(state["users"])
+        self.add_room(room)
+        return room
+
+    def set_port_range(self, first, last):
+        """ Limits the ports handed out by get_available_port to `first`..`last`, e.g. so shard
+            workers each stay in their own block """
+        with self._lock:
+            self._next_port = first
+            self._last_port = last
+            self._free_ports = []
+
+    def is_multiplexed(self, room):
+        return self.room_server is not None and getattr(room, "address", None) == self.room_server.address
+
+    def reserve_port(self):
+        """ Claims a port for a room that isn't registered yet, e.g. one waiting in the RoomPool """
+        with self._lock:
+            port = self.get_available_port()
+            self._ports_in_use.add(port)
+        return port
+
+    def release_port(self, port):
+        with self._lock:
+            self._ports_in_use.discard(port)
+            if port < self._next_port:
+                self._free_ports.append(port)
+
+    def quarantine_port(self, port):
+        """ Releases a port that failed to bind, e.g. because another process holds it, to be
+            handed out again only after PORT_QUARANTINE seconds """
+        with self._lock:
+            self._ports_in_use.discard(port)
+            self._quarantined[port] = time.monotonic() + self.PORT_QUARANTINE
+
+    def new_room(self):
+        """ Builds a WebSocketRoom on the RoomServer's port, or on a port reserved for it """
+        if self.room_server:
+            return WebSocketRoom(address=self.room_server.address)
+        return WebSocketRoom(address=('127.0.0.1', self.reserve_port()))
 
     def get_available_port(self):
-        p = 9000
-        all_ports = [r.address[1] for r in self.rooms]
-        while p in all_ports:
-            p += 1
-        return p
+        """ Returns a free port without claiming it; use reserve_port when another thread could pick
+            the same port before the room is registered. Raises RoomException once every port in the
+            range is taken """
+        with self._lock:
+            if self._quarantined:
+                now = time.monotonic()
+                for port, until in list(self._quarantined.items()):
+                    if until <= now:
+                        del self._quarantined[port]
+                        self.release_port(port)
+            # freed ports are reused first; stale entries (ports since claimed by add_room, or quarantined)
+            # are discarded lazily
+            free = self._free_ports
+            while free and (free[-1] in self._ports_in_use or free[-1] in self._quarantined):
+                free.pop()
+            if free:
+                return free[-1]
+            while self._next_port in self._ports_in_use or self._next_port in self._quarantined:
+                self._next_port += 1
+            if self._next_port > self._last_port:
+                raise RoomException("No free ports left up to {last}".format(last=self._last_port))
+            return self._next_port
 
     @classmethod
     def get_instance(cls, log=None):
         if cls._instance:
             return cls._instance
-        else:
-            h = cls(log=log)
-            cls._instance = h
-            return h
+        with cls._instance_lock:
+            # another thread may have built it while this one waited for the lock
+            if not cls._instance:
+                cls._instance = cls(log=log)
+        return cls._instance
+
+RoomSnapshot = collections.namedtuple("RoomSnapshot", "version is_open user_count owner")
+
 
 class Room:
+    """ Membership and open/closed state of a room. Every change happens under the room's own lock,
+        so endpoint threads and the room's socket thread can't interleave halfway through one.
+        Counting and membership checks don't lock, and `snapshot` hands out an immutable view that
+        is only rebuilt after the room changes.
+
+        Members are kept by a MEMBERSHIP backend (see givr.membership) that can be indexed by
+        position, so a giveaway picks winners by random index in O(winners) however big the room is """
     ROOM_ID_LEN = len(str(uuid.uuid1()))
+    MEMBERSHIP = Membership
+    journal = None  # set by the House while the room is registered
 
     def __init__(self):
         self.room_id = str(uuid.uuid1())
         self._open = False
-        self.users = []
+        self._members = self.MEMBERSHIP()
         self.owner = None
-        logger.debug("Room '{r}' created".format(r=self.room_id))
+        self.version = 0  # bumped on every membership or open/close change
+        self._lock = threading.RLock()
+        self._snapshot = None
+        self._change = threading.Condition()
+        self._watchers = 0
+        self.last_active = time.monotonic()  # read by the RoomReaper to find idle rooms
+        logger.debug("Room '%s' created", self.room_id)
+
+    @property
+    def users(self):
+        with self._lock:
+            return self._members.users()
+
+    @users.setter
+    def users(self, users):
+        with self._lock:
+            members = self.MEMBERSHIP()
+            for user in users:
+                members.add(user)
+            self._members = members
+            self._changed()
+
+    def draw(self, n, rng=None):
+        """ Draws `n` distinct winners uniformly at random in O(n). Given the same `rng` seed and the
+            same history of joins and leaves the same winners come out """
+        with self._lock:
+            return Giveaway(users=self._members.entrants(), rng=rng).draw(n)
+
+    def snapshot(self):
+        """ Returns a consistent RoomSnapshot of the room, built again only when the version moved """
+        snapshot = self._snapshot
+        # the version is bumped after the change it counts, so a stale match still describes a
+        # state the room really was in
+        if snapshot is not None and snapshot.version == self.version:
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot = RoomSnapshot(self.version,
+                                                     self._open,
+                                                     len(self._members),
+                                                     self.owner.user_id if self.owner else None)
+        return snapshot
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def _changed(self, *event):
+        """ Bumps the room's version, journals `event` if there is one and wakes anything waiting
+            in `wait_for_change`. Called with the room's lock held """
+        self.version += 1
+        self.last_active = time.monotonic()
+        if event and self.journal:
+            self.journal.record(*event)
+        if self._watchers:
+            with self._change:
+                self._change.notify_all()
+
+    def wait_for_change(self, version, timeout=None):
+        """ Blocks until the room's version differs from `version` or `timeout` runs out, and
+            returns the current version. Changes made while nobody is waiting cost nothing extra """
+        with self._change:
+            self._watchers += 1
+            try:
+                self._change.wait_for(lambda: self.version != version, timeout)
+            finally:
+                self._watchers -= 1
+        return self.version
 
     def open(self):
-        logger.debug("Opening room '{r}'".format(r=self.room_id))
-        self._open = True
+        logger.debug("Opening room '%s'", self.room_id)
+        with self._lock:
+            self._open = True
+            self._changed("open", self.room_id)
 
     def is_open(self):
         return self._open
 
     def close(self):
-        logger.debug("Closing room '{r}'".format(r=self.room_id))
-        self._open = False
-        users_copy = self.users[:] # avoid looping through list we're modifying
-        [self.remove_user(u) for u in users_copy]
+        logger.debug("Closing room '%s'", self.room_id)
+        with self._lock:
+            self._open = False
+            self._members = self.MEMBERSHIP()
+            self._changed("close", self.room_id)
 
     def add_user(self, user):
-        if not self.is_open():
-            logger.warning("Can't add user to closed room")
-            raise RoomException("Can't add user to closed room")
-        logger.debug("Adding user '{u}' to room '{r}'".format(u=user.user_id, r=self.room_id))
-        self.users.append(user)
+        with self._lock:
+            if not self._open:
+                logger.warning("Can't add user to closed room")
+                raise RoomException("Can't add user to closed room")
+            if not self._members.add(user):
+                logger.debug("User '%s' already in room '%s'", user.user_id, self.room_id)
+                return
+            logger.debug("Added user '%s' to room '%s'", user.user_id, self.room_id)
+            self._changed("add", self.room_id, [user.user_id])
+
+    def add_users(self, users):
+        """ Adds every user in one pass and returns, per user, whether it was added (False when it
+            was already in the room) """
+        with self._lock:
+            if not self._open:
+                logger.warning("Can't add users to closed room")
+                raise RoomException("Can't add user to closed room")
+            results = self._members.add_all(users)
+            logger.debug("Added %s users to room '%s'", results.count(True), self.room_id)
+            if any(results):
+                self._changed("add", self.room_id, [u.user_id for u, added in zip(users, results) if added])
+        return results
 
     def add_owner(self, user):
-        logger.debug("Adding owner '{u}' to room '{r}'".format(u=user.user_id, r=self.room_id))
-        self.owner = user
-        self.add_user(user)
+        logger.debug("Adding owner '%s' to room '%s'", user.user_id, self.room_id)
+        with self._lock:
+            self.owner = user
+            self._changed("owner", self.room_id, user.user_id)
+            self.add_user(user)
 
     def has_user(self, user):
-        has_user = user in self.users
-        logger.debug("Room '{r}' has user '{u}'? {b}".format(r=self.room_id, u=user.user_id, b=has_user))
+        has_user = user.user_id in self._members
+        logger.debug("Room '%s' has user '%s'? %s", self.room_id, user.user_id, has_user)
         return has_user
 
     def remove_user(self, user):
-        logger.debug("Removing user '{u}' from room {r}".format(u=user.user_id, r=self.room_id))
-        self.users = [u for u in self.users if user.user_id != u.user_id]
+        logger.debug("Removing user '%s' from room %s", user.user_id, self.room_id)
+        with self._lock:
+            if self._members.remove(user.user_id):
+                self._changed("remove", self.room_id, [user.user_id])
+
+    def remove_users(self, users):
+        """ Removes every user in one pass and returns, per user, whether it was in the room """
+        with self._lock:
+            remove = self._members.remove
+            results = [remove(user.user_id) for user in users]
+            logger.debug("Removed %s users from room '%s'", results.count(True), self.room_id)
+            if any(results):
+                self._changed("remove", self.room_id, [u.user_id for u, removed in zip(users, results) if removed])
+        return results
 
     def user_count(self):
-        return len(self.users)
+        return len(self._members)
 
 
-import socket, select, re, threading, base64, hashlib
+import socket, select, re, threading, base64, hashlib, struct, zlib
 from stevesockets.server import SocketServer, WebSocketServer
+from stevesockets.websocket import WebSocketFrame
 
-class SocketRoom(SocketServer, Room):
+class SocketRoom(SocketServer, Room, CommandDispatcher):
 
     MessageClass = SocketMessage
+    MIDDLEWARE = (reply_failure, record_metrics)
+    # None turns presence tracking off
+    HEARTBEAT_TIMEOUT = Presence.TIMEOUT
+    MAX_PENDING_BYTES = 1024 * 1024
 
     def __init__(self, address=('127.0.0.1', 9000)):
         SocketServer.__init__(self, address=address, logger=logger)
+        # SocketServer.__init__ assigns `handle_message = None` on the instance (it's meant to be
+        # set with its message_handler decorator), which would hide ours
+        self.__dict__.pop("handle_message", None)
         Room.__init__(self)
+        self.presence = None  # created with the first connection, most rooms never get one
+        self._known_connections = set()
+        self._next_heartbeat = 0
+        self._next_ping = 0
+        self._handling = False
+        self._serving = False  # from dlisten until the listen thread has closed the server socket
+        self._on_stopped = []
+        self._stop_lock = threading.Lock()
+
+    def dlisten(self):
+        with self._stop_lock:
+            self._serving = True
+        return super(SocketRoom, self).dlisten()
+
+    def _stop_server(self):
+        try:
+            super(SocketRoom, self)._stop_server()
+        finally:
+            with self._stop_lock:
+                self._serving = False
+                callbacks, self._on_stopped = self._on_stopped, []
+            for fn in callbacks:
+                fn()
+
+    def when_stopped(self, fn):
+        """ Calls `fn` once the room's server socket is closed, right away when it isn't listening.
+            `stop_listening` only asks the listen thread to stop, the socket stays bound until it does """
+        with self._stop_lock:
+            if self._serving:
+                self._on_stopped.append(fn)
+                return
+        fn()
+
+    def encode_message(self, msg):
+        return msg.to_text().encode()
+
+    def encode_for(self, connection, msg, data):
+        """ The bytes a broadcast of `msg` queues on `connection`, normally the shared `data` """
+        return data
+
+    def broadcast(self, msg):
+        """ Sends `msg` to every connection in the room. The message is serialized and encoded once
+            and the same bytes are queued on each connection, then flushed without blocking. While a
+            frame is being handled the flush is left to the one that sends its response, so every
+            broadcast it causes goes out in the same write """
+        data = self.encode_message(msg)
+        for connection in self.connections:
+            if not connection.is_closed() and not connection.is_to_be_closed():
+                connection.queue_message(self.encode_for(connection, msg, data))
+        if not self._handling:
+            self.flush_connections()
+        h = House.get_instance()
+        if h.is_multiplexed(self):
+            h.room_server.broadcast(self.room_id, data, msg)
+
+    def flush_connections(self):
+        for connection in self.connections:
+            if connection.messages and not connection.is_closed():
+                self._flush_connection(connection)
+
+    def _flush_connection(self, connection):
+        """ Sends as much of the connection's queue as its socket takes without blocking and keeps the
+            rest queued for the next flush. Connections that fall too far behind are closed """
+        batch = b"".join(connection.messages)
+        connection.messages.clear()
+        try:
+            sent = connection.socket.send(batch, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            sent = 0
+        except OSError as err:
+            logger.warning("Socket error while sending message: {err}".format(err=err))
+            connection.mark_for_closing()
+            return
+        if sent < len(batch):
+            if len(batch) - sent > self.MAX_PENDING_BYTES:
+                logger.warning("Dropping slow connection @ {addr}:{port}".format(addr=connection.address,
+                                                                                port=connection.port))
+                connection.mark_for_closing()
+            else:
+                connection.messages.append(batch[sent:])
+
+    def on_message(self, connection, response):
+        self.message_manager.dispatch_message(response,
+                                              message_type=self.get_message_type(response),
+                                              connection=connection,
+                                              server=self)
+        self.flush_connections()
+
+    def prune_connections(self):
+        super(SocketRoom, self).prune_connections()
+        if self.HEARTBEAT_TIMEOUT and (self.connections or self._known_connections):
+            self._track_connections()
+        # anything a slow client couldn't take earlier gets another chance every pass of the listen loop
+        self.flush_connections()
+
+    def _track_connections(self):
+        """ Reports new and pruned connections to the room's Presence and, once per wheel tick,
+            closes the connections that stopped answering and pings the quiet ones """
+        if self.presence is None:
+            self.presence = Presence(self.HEARTBEAT_TIMEOUT)
+        presence = self.presence
+        current = set(self.connections)
+        for connection in current - self._known_connections:
+            presence.connected(connection)
+        for connection in self._known_connections - current:
+            presence.disconnected(connection)
+        self._known_connections = current
+        now = time.monotonic()
+        if now < self._next_heartbeat:
+            return
+        self._next_heartbeat = now + presence.wheel.tick
+        for connection in presence.expire(now):
+            logger.info("Closing connection @ {addr}:{port}, no heartbeat for {t}s".format(
+                addr=connection.address, port=connection.port, t=presence.timeout))
+            connection.mark_for_closing()
+        if now >= self._next_ping:
+            self._next_ping = now + presence.ping_interval
+            for connection in presence.idle(now):
+                self.ping(connection)
+
+    def ping(self, connection):
+        """ Plain sockets have no ping frame, so their clients keep their connection by sending a
+            PING message every so often """
+
+    def connection_handler(self, connection):
+        limiter = House.get_instance().rate_limiter
+        if limiter and limiter.connection_delay(connection):
+            # the frame stays in the socket buffer until the connection has a token again, so a
+            # flooding client is slowed down by TCP instead of by everyone else's latency
+            return None
+        token = None
+        if self.presence is not None:
+            self.presence.seen(connection)
+            token = current_connection.set((self.presence, connection))
+        self._handling = True
+        try:
+            response = self._receive(connection)
+        finally:
+            self._handling = False
+            if token is not None:
+                current_connection.reset(token)
+        if not response:
+            # on_message only runs, and flushes, for frames that get a response
+            self.flush_connections()
+        return response
+
+    def _receive(self, connection):
+        """ Reads one frame from `connection` and queues the room's response on it.
+            SocketServer.connection_handler can't be used here, it calls `handle_message` as a plain
+            function with the server as an extra argument, and plain SocketServers have no listener
+            to send a response, so each response line is written back here """
+        data = connection.socket.recv(4096)
+        if not data:
+            connection.mark_for_closing()
+            return None
+        try:
+            response = self.handle_message(connection, data)
+        except (GivrException, UnicodeDecodeError) as err:
+            response = self._failure(str(err)).to_text()
+        if response:
+            connection.queue_message(response.encode() + b"\n")
+        return None
 
     def handle_message(self, connection, data):
         data = data.decode() if type(data) == bytes else data
-        logger.debug("SocketRoom '{r}' recieved data '{m}'".format(r=self.room_id, m=data))
+        logger.debug("SocketRoom '%s' recieved data '%s'", self.room_id, data)
+        if self.is_pipelined(data):
+            return self.handle_commands(data)
+        if self.is_rate_limited(data):
+            return self.rate_limited_reply()
         msg = self.MessageClass.from_text(data)
         return self.delegate_command(msg).to_text()
 
-    def delegate_command(self, msg):
-        failed = False
+    @staticmethod
+    def is_pipelined(data):
+        return "\n" in data.rstrip("\r\n")
+
+    @staticmethod
+    def is_rate_limited(data):
+        """ Checks one raw command against the House's RateLimiter, before anything is parsed """
+        limiter = House.get_instance().rate_limiter
+        return limiter is not None and not limiter.allow(data)
+
+    def rate_limited_reply(self):
+        return self._failure("Rate limit exceeded").to_text()
+
+    def _failure(self, info=None):
+        return self.MessageClass(sender=self.room_id, recipient=self.room_id, message=SocketMessage.FAILURE, info=info)
+
+    def handle_commands(self, data):
+        """ Handles a pipelined frame of newline-delimited commands. Commands are dispatched in
+            order and answered with one response line each, so a command that fails to parse gets a
+            FAILURE line in its place instead of failing the rest of the frame """
+        responses = []
+        for line in data.split("\n"):
+            if not line.strip():
+                continue
+            if self.is_rate_limited(line):
+                responses.append(self.rate_limited_reply())
+                continue
+            try:
+                msg = self.MessageClass.from_text(line)
+            except GivrException as err:
+                responses.append(self._failure(err.args[0]).to_text())
+            else:
+                responses.append(self.delegate_command(msg).to_text())
+        return "\n".join(responses)
+
+    def handle_binary(self, data):
+        """ Handles a frame of back-to-back binary commands (see `SocketMessage.to_bytes`) and returns
+            their binary responses in order. Binary commands carry no delimiter to resync on, so a
+            command that fails to decode is answered with a FAILURE and ends the frame """
+        limiter = House.get_instance().rate_limiter
+        responses = []
         try:
-            handler = getattr(self, "_handle_{msg}".format(msg=msg.message.lower()))
-            resp = handler(msg)
-            return resp
+            for msg in self.MessageClass.iter_bytes(data):
+                if limiter is not None and not limiter.allow_command(msg.sender, msg.message):
+                    responses.append(self._failure("Rate limit exceeded").to_bytes())
+                else:
+                    responses.append(self.delegate_command(msg).to_bytes())
         except GivrException as err:
-            logger.warn("A handled application error has occurred: {err}".format(err=err))
-            failed = True
-            fail_msg = "{err_type}: '{err_msg}'".format(err_type=err.__class__.__name__, err_msg=err.args[0])
-        except BaseException as err:
-            logger.error("An unhandled application error has occurred: {err}".format(err=err))
-            failed = True
-            fail_msg = "{err_type}: '{err_msg}'".format(err_type=err.__class__.__name__, err_msg=err.args[0])
-        finally:
-            if failed:
-                return self.MessageClass(recipient=msg.sender,
-                                         sender=self.room_id,
-                                         message=SocketMessage.FAILURE,
-                                         info=fail_msg)
-
-    def check_recipient(fn):
-        @functools.wraps(fn)
-        def wrapped_fn(self, msg):
-            if msg.recipient != self.room_id:
-                logger.warn("Message sent to incorrect room: {msg}".format(msg=msg))
-                return self.MessageClass(recipient=msg.sender,
-                                         sender=self.room_id,
-                                         message=SocketMessage.FAILURE,
-                                         info="Message not intended for this room")
-            else:
-                return fn(self, msg)
-        return wrapped_fn
+            responses.append(self._failure(err.args[0]).to_bytes())
+        return b"".join(responses)
+
+    def delegate_command(self, msg):
+        self.touch()
+        return self.commands[msg.message](self, msg)
 
-    @check_recipient
+    @command(SocketMessage.JOIN, check_recipient, track_presence)
     def _handle_join(self, msg):
         user = User.from_user_id(msg.sender)
         self.add_user(user)
         return self.MessageClass(recipient=msg.sender, sender=self.room_id, message=SocketMessage.SUCCESS)
 
-    @check_recipient
+    @command(SocketMessage.LEAVE, check_recipient, track_presence)
     def _handle_leave(self, msg):
         user = User.from_user_id(msg.sender)
         self.remove_user(user)
         return self.MessageClass(recipient=msg.sender, sender=self.room_id, message=SocketMessage.SUCCESS)
 
-    @check_recipient
+    @command(SocketMessage.PING, check_recipient)
+    def _handle_ping(self, msg):
+        # every frame counts as a heartbeat, PING is just one that changes nothing
+        return self.MessageClass(recipient=msg.sender, sender=self.room_id, message=SocketMessage.SUCCESS)
+
+    @command(SocketMessage.GIVEAWAY, check_recipient)
     def _handle_giveaway(self, msg):
         sender = User.from_user_id(msg.sender)
         if sender != self.owner:
             logger.warning("Giveaway attempted in room {r} by non-owner {u}".format(r=self.room_id, u=sender.user_id))
             raise RoomException("Giveaways can only be initiated by the room owner")
         else:
-            g = Giveaway(users=self.users)
-            winner = g.draw(1)[-1]
+            winner_count, seed = self._giveaway_args(msg)
+            winners = self.draw(winner_count, rng=random.Random(seed))
+            winner_ids = ",".join(w.user_id for w in winners)
+            logger.info("Giveaway in room %s drew %s winners with seed %s", self.room_id, winner_count, seed)
+            if self.journal:
+                # the seed goes in the journal so the draw can be audited and replayed
+                self.journal.record("giveaway", self.room_id, [w.user_id for w in winners], seed)
+            self.broadcast(self.MessageClass(sender=self.room_id,
+                                             recipient=self.room_id,
+                                             message=SocketMessage.WINNER,
+                                             info=winner_ids))
             return self.MessageClass(sender=self.room_id,
                                      recipient=sender.user_id,
                                      message=SocketMessage.SUCCESS,
-                                     info=winner.user_id)
+                                     info=winner_ids)
+
+    @staticmethod
+    def _giveaway_args(msg):
+        """ GIVEAWAY messages may carry the number of winners to draw and the seed to draw them with
+            in their info field, e.g. `owner_id:room_id:GIVEAWAY:3` or `owner_id:room_id:GIVEAWAY:3:42`,
+            defaulting to a single winner and a fresh random seed """
+        count, _, seed = (msg.info or "").partition(":")
+        try:
+            winner_count = int(count) if count else 1
+        except ValueError:
+            raise RoomException("Invalid number of winners '{n}'".format(n=count))
+        if winner_count < 1:
+            raise RoomException("Invalid number of winners '{n}'".format(n=count))
+        try:
+            seed = int(seed) if seed else secrets.randbits(64)
+        except ValueError:
+            raise RoomException("Invalid giveaway seed '{s}'".format(s=seed))
+        return winner_count, seed
 
 
 class WebSocketRoom(SocketRoom, WebSocketServer):
 
     MessageClass = SocketMessage
+    # largest message a compressed frame may inflate to
+    MAX_MESSAGE_SIZE = 1024 * 1024
 
     def __init__(self, address=('127.0.0.1', 9000)):
         WebSocketServer.__init__(self, address=address, logger=logger)
         SocketRoom.__init__(self, address=address)
 
+    def encode_message(self, msg):
+        return encode_frame(msg.to_text())
+
+    def _receive(self, connection):
+        """ WebSocketServer parses the frame, but its listeners only answer PING and CLOSE frames,
+            so text frames are handed to `handle_message` here and the response is queued on the
+            connection. Every other frame goes on to the listeners in on_message """
+        frame = WebSocketServer.connection_handler(self, connection)
+        if frame is None or frame.headers.opcode != WebSocketFrame.OPCODE_TEXT:
+            return frame
+        # the parser builds the payload one character per byte, and leaves RSV1 for us to inflate
+        data = frame.message.encode("latin-1")
+        if frame.headers.rsv & 0b100:
+            data = self._inflate(connection, data)
+            if data is None:
+                return None
+        try:
+            response = self.handle_message(connection, data.decode())
+        except UnicodeDecodeError as err:
+            response = self._failure(str(err)).to_text()
+        if response:
+            connection.queue_message(self.encode_text(connection, response))
+        return None
+
+    def _inflate(self, connection, data):
+        """ Inflates a compressed message, or queues a close frame and returns None when compression
+            wasn't negotiated or the message is corrupt or too big """
+        deflate = getattr(connection, "deflate", None)
+        if deflate is None:
+            reason = "compressed frame without permessage-deflate"
+        else:
+            try:
+                return deflate.decompress(data, self.MAX_MESSAGE_SIZE)
+            except zlib.error as err:
+                reason = err
+        logger.warning("Closing connection @ %s:%s: %s", connection.address, connection.port, reason)
+        connection.queue_message(encode_frame(struct.pack("!H", 1002), opcode=WebSocketFrame.OPCODE_CLOSE))
+        connection.mark_for_closing()
+        return None
+
+    def encode_text(self, connection, text):
+        deflate = getattr(connection, "deflate", None)
+        return deflate.encode_frame(text) if deflate else encode_frame(text)
+
+    def encode_for(self, connection, msg, data):
+        return self.encode_text(connection, msg.to_text()) if getattr(connection, "deflate", None) else data
+
+    def handle_websocket_handshake(self, conn, data):
+        # stevesockets answers the upgrade itself, so the offer is picked here and accepted in
+        # send_http_response
+        conn.deflate = None
+        if PerMessageDeflate.ENABLED:
+            lines = data.decode(errors="replace").split("\r\n")
+            offers = [line.split(":", 1)[1] for line in lines[1:]
+                      if line.lower().startswith("sec-websocket-extensions:")]
+            conn.deflate = PerMessageDeflate.negotiate(",".join(offers))
+        super(WebSocketRoom, self).handle_websocket_handshake(conn, data)
+
+    def send_http_response(self, conn, status, headers=None):
+        deflate = getattr(conn, "deflate", None)
+        if status == 101 and deflate:
+            headers = dict(headers or {}, **{"Sec-WebSocket-Extensions": deflate.response})
+        WebSocketServer.send_http_response(conn, status, headers=headers)
+
+    def ping(self, connection):
+        if not connection.is_closed() and not connection.is_to_be_closed():
+            connection.queue_message(encode_frame(b"", opcode=WebSocketFrame.OPCODE_PING))
+
     def handle_message(self, conn, data):
-        logger.debug("WebSocket data: {d}".format(d=data))
+        logger.debug("WebSocket data: %s", data)
+        if self.is_pipelined(data):
+            return self.handle_commands(data)
+        if self.is_rate_limited(data):
+            return self.rate_limited_reply()
         try:
             msg = self.MessageClass.from_text(data)
             return self.delegate_command(msg).to_text()
@@ -0,0 +1,99 @@
+from givr.exceptions import RoomException
+from givr.logging import get_logger
+import collections
+import functools
+import threading
+import time
+
+logger = get_logger(__name__)
+
+
+class RoomPool:
+    """ Keeps `size` idle rooms built, bound and listening ahead of time so `/api/room/create` can
+        hand one out immediately. A background thread builds replacements as rooms are taken """
+
+    LISTEN_TIMEOUT = 2.0
+    # rooms that fail to bind in a row before the pool backs off for LISTEN_TIMEOUT
+    BIND_ATTEMPTS = 3
+
+    def __init__(self, house, size=10):
+        self.house = house
+        self.size = size
+        self._rooms = collections.deque()
+        self._refill = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._refill.set()
+        return self
+
+    def take(self):
+        """ Returns a warm room, or None when the pool has run dry """
+        try:
+            room = self._rooms.popleft()
+        except IndexError:
+            logger.warning("Room pool empty, building a room on demand")
+            room = None
+        else:
+            # a pooled room's idle time counts from when it's handed out, not from when it was built
+            room.touch()
+        self._refill.set()
+        return room
+
+    def stop(self):
+        self._stopped.set()
+        self._refill.set()
+        if self._thread:
+            self._thread.join()
+        while self._rooms:
+            room = self._rooms.popleft()
+            if room.listening:
+                room.stop_listening()
+            if not self.house.is_multiplexed(room):
+                room.when_stopped(functools.partial(self.house.release_port, room.address[1]))
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._refill.wait()
+            self._refill.clear()
+            failures = 0
+            while len(self._rooms) < self.size and not self._stopped.is_set():
+                room = self._warm_room()
+                if room is None:
+                    failures += 1
+                    if failures >= self.BIND_ATTEMPTS:
+                        # back off rather than spin when no port will bind
+                        self._stopped.wait(self.LISTEN_TIMEOUT)
+                        self._refill.set()
+                        break
+                    continue
+                failures = 0
+                self._rooms.append(room)
+
+    def _warm_room(self):
+        try:
+            room = self.house.new_room()
+        except RoomException as err:
+            logger.error("Can't build a pooled room: {err}".format(err=err.args[0]))
+            return None
+        if self.house.is_multiplexed(room):
+            return room
+        stopped = threading.Event()
+        room.dlisten()
+        room.when_stopped(stopped.set)
+        deadline = time.monotonic() + self.LISTEN_TIMEOUT
+        while not room.listening and not stopped.is_set() and time.monotonic() < deadline:
+            time.sleep(.001)
+        if not room.listening:
+            # quarantined rather than released, so the next room tries another port
+            logger.error("Pooled room on port {port} failed to start listening".format(port=room.address[1]))
+            room.stop_listening()
+            room.when_stopped(functools.partial(self.house.quarantine_port, room.address[1]))
+            return None
+        return room
@@ -0,0 +1,423 @@
+from givr.room import House, WebSocketRoom
+from givr.exceptions import GivrException, RoomException, FrameException
+from givr.socketmessage import SocketMessage
+from givr.logging import get_logger
+from givr.frames import encode_frame, read_frame, PerMessageDeflate
+from givr.presence import Presence, current_connection
+from stevesockets.server import WebSocketServer
+from stevesockets.websocket import WebSocketFrame
+import asyncio
+import threading
+import time
+import base64
+import hashlib
+import struct
+import zlib
+
+logger = get_logger(__name__)
+
+
+class RoomConnection:
+    """ Frames sent to a connection during one pass of the event loop are coalesced and written
+        together once the pass is over, so a burst of responses and broadcasts costs one write """
+
+    # past this many queued bytes the outbox is written right away instead of at the end of the pass
+    FLUSH_SIZE = 64 * 1024
+
+    def __init__(self, reader, writer, room=None, binary=False, deflate=None):
+        self.reader = reader
+        self.writer = writer
+        self.room = room
+        self.binary = binary  # negotiated the binary subprotocol, so pushes are sent as binary frames
+        self.deflate = deflate  # PerMessageDeflate when the client negotiated compression
+        self.address, self.port = writer.get_extra_info("peername")[:2]
+        self._loop = asyncio.get_running_loop()
+        self._outbox = []
+        self._outbox_size = 0
+
+    def send(self, payload, opcode=WebSocketFrame.OPCODE_TEXT):
+        if self.deflate and opcode in (WebSocketFrame.OPCODE_TEXT, WebSocketFrame.OPCODE_BINARY):
+            self.queue(self.deflate.encode_frame(payload, opcode=opcode))
+        else:
+            self.queue(encode_frame(payload, opcode=opcode))
+
+    def queue(self, frame):
+        """ Queues an encoded frame to be written at the end of this pass of the event loop. Only
+            call from the loop's thread """
+        if not self._outbox:
+            self._loop.call_soon(self.flush)
+        self._outbox.append(frame)
+        self._outbox_size += len(frame)
+        if self._outbox_size > self.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._outbox:
+            return
+        data = self._outbox[0] if len(self._outbox) == 1 else b"".join(self._outbox)
+        self._outbox.clear()
+        self._outbox_size = 0
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def pending_bytes(self):
+        return self.writer.transport.get_write_buffer_size() + self._outbox_size
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class RoomServer:
+    """ Accepts WebSocket connections for every room on a single port and routes each connection to
+        its room by the room_id in the request path (`ws://host:port/<room_id>`) or, failing that,
+        by the recipient of the first message it sends. Rooms are looked up in the House, so they
+        only need to be created and opened, never `listen()`ed on their own ports """
+
+    WEBSOCKET_MAGIC = WebSocketServer.WEBSOCKET_MAGIC
+    # clients that offer this subprotocol get broadcasts in the binary format of SocketMessage.to_bytes;
+    # binary frames are understood on any connection
+    BINARY_PROTOCOL = "givr.binary"
+
+    MAX_PENDING_BYTES = 1024 * 1024
+    # a connection's reader stops taking data off its socket once this much is buffered, which is
+    # what throttled connections lean on while they aren't being read
+    INBOUND_LIMIT = 64 * 1024
+    HEARTBEAT_TIMEOUT = Presence.TIMEOUT
+    # largest frame, fragmented message or inflated message a client may send
+    MAX_MESSAGE_SIZE = WebSocketRoom.MAX_MESSAGE_SIZE
+
+    def __init__(self, address=('127.0.0.1', 9000), house=None, heartbeat_timeout=None):
+        self.address = address
+        self.house = house if house else House.get_instance()
+        self.connections = set()
+        self.room_connections = {}  # room_id -> connections routed to that room
+        self.listening = False
+        self._server = None
+        self._loop = None
+        self._started = threading.Event()
+        self.presence = Presence(heartbeat_timeout or self.HEARTBEAT_TIMEOUT, slots=512)
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle_connection, self.address[0], self.address[1],
+                                                  backlog=1024, limit=self.INBOUND_LIMIT)
+        # pick up the real port when bound to port 0
+        self.address = self._server.sockets[0].getsockname()[:2]
+        self.house.room_server = self
+        self.listening = True
+        self._started.set()
+        logger.info("Room server listening @ {addr}:{port}".format(addr=self.address[0], port=self.address[1]))
+        heartbeat = self._loop.create_task(self._heartbeat())
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            heartbeat.cancel()
+            self.listening = False
+            for connection in list(self.connections):
+                connection.close()
+            if self.house.room_server is self:
+                self.house.room_server = None
+            logger.info("Room server stopped")
+
+    def listen(self):
+        asyncio.run(self.serve())
+
+    def dlisten(self):
+        """ Starts the server's event loop on a daemon thread and returns the thread once the server is bound """
+        t = threading.Thread(target=self.listen, daemon=True)
+        t.start()
+        self._started.wait()
+        return t
+
+    def stop_listening(self):
+        if self._server and self._loop:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+    async def _handle_connection(self, reader, writer):
+        connection = None
+        try:
+            handshake = await self._handshake(reader, writer)
+            if handshake is False:
+                return
+            room_id, binary, deflate = handshake
+            connection = RoomConnection(reader, writer, binary=binary, deflate=deflate)
+            self.connections.add(connection)
+            self.presence.connected(connection)
+            if room_id:
+                self._route(connection, self.house.get_room(room_id))
+            await self._read_messages(connection)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.debug("Connection closed by client")
+        finally:
+            if connection:
+                self.presence.disconnected(connection)
+                self.connections.discard(connection)
+                if connection.room:
+                    self.room_connections.get(connection.room.room_id, set()).discard(connection)
+                connection.close()
+            else:
+                writer.close()
+
+    def _route(self, connection, room):
+        connection.room = room
+        self.room_connections.setdefault(room.room_id, set()).add(connection)
+
+    async def _handshake(self, reader, writer):
+        """ Completes the WebSocket upgrade and returns the room_id from the path (or None when the
+            path doesn't name a room), whether the binary subprotocol was negotiated and the
+            connection's PerMessageDeflate if compression was, or False if the connection was rejected """
+        try:
+            request = (await reader.readuntil(b"\r\n\r\n")).decode()
+            lines = request.split("\r\n")
+            method, path, http = lines[0].split(" ")
+            headers = {}
+            for line in lines[1:]:
+                if ": " in line:
+                    key, value = line.split(": ", 1)
+                    key = key.lower()
+                    # repeated headers are the same as one comma separated header
+                    headers[key] = headers[key] + ", " + value if key in headers else value
+            key = headers["sec-websocket-key"]
+        except (ValueError, KeyError, UnicodeDecodeError, asyncio.LimitOverrunError):
+            logger.error("Malformed headers in client handshake, closing connection")
+            self._send_http_response(writer, 400)
+            return False
+
+        room_id = path.split("?")[0].strip("/").split("/")[-1] or None
+        if room_id:
+            try:
+                self.house.get_room(room_id)
+            except RoomException:
+                self._send_http_response(writer, 404)
+                return False
+
+        accept = base64.b64encode(hashlib.sha1((key + self.WEBSOCKET_MAGIC).encode()).digest()).decode()
+        response_headers = {
+            "Upgrade": "websocket",
+            "Connection": "Upgrade",
+            "Sec-WebSocket-Accept": accept
+        }
+        protocols = [p.strip() for p in headers.get("sec-websocket-protocol", "").split(",")]
+        binary = self.BINARY_PROTOCOL in protocols
+        if binary:
+            response_headers["Sec-WebSocket-Protocol"] = self.BINARY_PROTOCOL
+        deflate = PerMessageDeflate.negotiate(headers.get("sec-websocket-extensions")) if PerMessageDeflate.ENABLED else None
+        if deflate:
+            response_headers["Sec-WebSocket-Extensions"] = deflate.response
+        self._send_http_response(writer, 101, headers=response_headers)
+        return room_id, binary, deflate
+
+    @staticmethod
+    def _send_http_response(writer, status, headers=None):
+        descriptions = {101: "Switching Protocols", 400: "Bad Request", 404: "Not Found"}
+        msg = "HTTP/1.1 {status} {desc}\r\n".format(status=status, desc=descriptions.get(status, ""))
+        for header, value in (headers or {}).items():
+            msg += "{header}: {value}\r\n".format(header=header, value=value)
+        writer.write((msg + "\r\n").encode())
+
+    async def _read_messages(self, connection):
+        fragments = []
+        fragments_size = 0
+        message_opcode = None
+        message_compressed = False
+        # every connection is read by its own task, which has its own copy of the context
+        current_connection.set((self.presence, connection))
+        while True:
+            limiter = self.house.rate_limiter
+            if limiter:
+                delay = limiter.connection_delay(connection)
+                if delay:
+                    await asyncio.sleep(delay)
+                    continue
+            try:
+                fin, compressed, opcode, payload = await read_frame(connection.reader, self.MAX_MESSAGE_SIZE)
+            except FrameException as err:
+                self._fail(connection, 1009, err.args[0])  # message too big
+                return
+            self.presence.seen(connection)
+            if opcode == WebSocketFrame.OPCODE_CLOSE:
+                connection.send(payload, opcode=WebSocketFrame.OPCODE_CLOSE)
+                connection.flush()
+                await connection.writer.drain()
+                return
+            elif opcode == WebSocketFrame.OPCODE_PING:
+                connection.send(payload, opcode=WebSocketFrame.OPCODE_PONG)
+            elif opcode in (WebSocketFrame.OPCODE_TEXT, WebSocketFrame.OPCODE_BINARY,
+                            WebSocketFrame.OPCODE_CONTINUATION):
+                if opcode != WebSocketFrame.OPCODE_CONTINUATION:
+                    message_opcode = opcode
+                    message_compressed = compressed
+                fragments.append(payload)
+                fragments_size += len(payload)
+                if fragments_size > self.MAX_MESSAGE_SIZE:
+                    self._fail(connection, 1009, "Fragmented message is over the {max} byte limit".format(
+                        max=self.MAX_MESSAGE_SIZE))
+                    return
+                if fin:
+                    data = fragments[0] if len(fragments) == 1 else b"".join(fragments)
+                    fragments = []
+                    fragments_size = 0
+                    if message_compressed:
+                        data = self._inflate(connection, data)
+                        if data is None:
+                            return
+                    if message_opcode == WebSocketFrame.OPCODE_BINARY:
+                        response = self.dispatch_binary(connection, data)
+                        if response:
+                            connection.send(response, opcode=WebSocketFrame.OPCODE_BINARY)
+                    else:
+                        try:
+                            text = data.decode()
+                        except UnicodeDecodeError as err:
+                            self._fail(connection, 1007, err)  # invalid frame payload data
+                            return
+                        response = self.dispatch(connection, text)
+                        if response:
+                            connection.send(response)
+            if connection.pending_bytes() > self.INBOUND_LIMIT:
+                # a client that keeps pipelining gets its responses written before more is read
+                connection.flush()
+                await connection.writer.drain()
+
+    def _inflate(self, connection, data):
+        """ Inflates a compressed message, or sends a close frame and returns None when compression
+            wasn't negotiated or the message is corrupt or too big """
+        if connection.deflate is None:
+            reason = "compressed frame without permessage-deflate"
+        else:
+            try:
+                return connection.deflate.decompress(data, self.MAX_MESSAGE_SIZE)
+            except zlib.error as err:
+                reason = err
+        self._fail(connection, 1002, reason)  # protocol error
+        return None
+
+    def _fail(self, connection, code, reason):
+        """ Sends a close frame with status `code`, the connection is closed once it stops being read """
+        logger.warning("Closing connection @ {addr}:{port}: {reason}".format(addr=connection.address,
+                                                                            port=connection.port, reason=reason))
+        connection.send(struct.pack("!H", code), opcode=WebSocketFrame.OPCODE_CLOSE)
+
+    async def _heartbeat(self):
+        """ Once per wheel tick closes the connections that stopped answering, and every
+            `ping_interval` pings the ones that have been quiet, so live clients answer with a PONG """
+        presence = self.presence
+        next_ping = 0
+        while True:
+            await asyncio.sleep(presence.wheel.tick)
+            now = time.monotonic()
+            for connection in presence.expire(now):
+                logger.info("Closing connection @ {addr}:{port}, no heartbeat for {t}s".format(
+                    addr=connection.address, port=connection.port, t=presence.timeout))
+                connection.close()
+            if now >= next_ping:
+                next_ping = now + presence.ping_interval
+                for connection in presence.idle(now):
+                    connection.send(b"", opcode=WebSocketFrame.OPCODE_PING)
+
+    def dispatch(self, connection, data):
+        """ Decodes `data`, routing the connection by the message recipient if it hasn't been routed
+            yet, and returns the text response from the connection's room. Pipelined frames are
+            routed by their first command """
+        room = connection.room
+        # single commands are checked on their raw text before anything is parsed; pipelined frames
+        # are checked line by line in handle_commands
+        limiter = self.house.rate_limiter
+        limited = limiter is not None and "\n" not in data.rstrip("\r\n") and not limiter.allow(data)
+        if limited and room is not None:
+            return room.rate_limited_reply()
+        message_cls = room.MessageClass if room else SocketMessage
+        try:
+            msg = message_cls.from_text(data.split("\n", 1)[0])
+        except GivrException as err:
+            logger.warning("Invalid message received: {err}".format(err=err))
+            if room is None:
+                return None
+            return room.MessageClass(sender=room.room_id, recipient=room.room_id, message=SocketMessage.FAILURE).to_text()
+        if room is None:
+            try:
+                room = self.house.get_room(msg.recipient)
+            except RoomException:
+                return SocketMessage(sender=msg.recipient,
+                                     recipient=msg.sender,
+                                     message=SocketMessage.FAILURE,
+                                     info="No room found to route message to").to_text()
+            self._route(connection, room)
+        if limited:
+            return room.rate_limited_reply()
+        if room.is_pipelined(data):
+            return room.handle_commands(data)
+        return room.delegate_command(msg).to_text()
+
+    def dispatch_binary(self, connection, data):
+        """ Binary counterpart of `dispatch`: `data` holds one or more binary commands and the
+            connection is routed by the recipient of the first one """
+        room = connection.room
+        if room is None:
+            try:
+                first = next(SocketMessage.iter_bytes(data))
+            except (GivrException, StopIteration) as err:
+                logger.warning("Invalid message received: {err}".format(err=err))
+                return None
+            try:
+                room = self.house.get_room(first.recipient)
+            except RoomException:
+                return SocketMessage(sender=first.recipient,
+                                     recipient=first.sender,
+                                     message=SocketMessage.FAILURE,
+                                     info="No room found to route message to").to_bytes()
+            self._route(connection, room)
+        return room.handle_binary(data)
+
+    def broadcast(self, room_id, data, msg=None):
+        """ Queues the already encoded frame `data` on every connection routed to `room_id`, or the
+            binary encoding of `msg` on connections that negotiated it. Safe to call from any thread;
+            the writes happen on the server's event loop """
+        if self._loop is None:
+            return
+        try:
+            in_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            self._broadcast(room_id, data, msg)
+        else:
+            self._loop.call_soon_threadsafe(self._broadcast, room_id, data, msg)
+
+    def drop_room(self, room_id):
+        """ Closes every connection routed to `room_id`, e.g. once the room has been evicted. Safe to
+            call from any thread """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._drop_room, room_id)
+
+    def _drop_room(self, room_id):
+        for connection in self.room_connections.pop(room_id, ()):
+            connection.close()
+
+    def _broadcast(self, room_id, data, msg=None):
+        binary_data = None
+        text = None
+        for connection in list(self.room_connections.get(room_id, ())):
+            # each transport buffers its own writes, so a slow client only backs up its own queue
+            if connection.pending_bytes() > self.MAX_PENDING_BYTES:
+                logger.warning("Dropping slow connection @ {addr}:{port}".format(addr=connection.address,
+                                                                                port=connection.port))
+                connection.close()
+                self.room_connections[room_id].discard(connection)
+            elif connection.binary and msg is not None:
+                if connection.deflate:
+                    connection.send(msg.to_bytes(), opcode=WebSocketFrame.OPCODE_BINARY)
+                else:
+                    if binary_data is None:
+                        binary_data = encode_frame(msg.to_bytes(), opcode=WebSocketFrame.OPCODE_BINARY)
+                    connection.queue(binary_data)
+            elif connection.deflate and msg is not None:
+                if text is None:
+                    text = msg.to_text().encode()
+                connection.send(text)
+            else:
+                connection.queue(data)
@@ -0,0 +1,201 @@
+from givr.room import House, Room, SocketRoom
+from givr.membership import CompactMembership
+from givr.operations import run_room_operation, WORKER_OPERATIONS
+from givr.exceptions import GivrException
+from givr.journal import RoomJournal
+from givr.roompool import RoomPool
+from givr.reaper import RoomReaper
+from givr.ratelimit import RateLimiter
+from givr.metrics import merge_shards
+from givr.logging import get_logger
+import multiprocessing
+import threading
+import hashlib
+import bisect
+import uuid
+import os
+
+logger = get_logger(__name__)
+
+
+class HashRing:
+    """ Consistent hash ring mapping keys to nodes. Each node is placed on the ring `replicas` times
+        so keys spread evenly, and adding or removing a node only moves the keys next to it """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._hashes = []
+        self._nodes = {}
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], "big")
+
+    def add_node(self, node):
+        for i in range(self.replicas):
+            h = self._hash("{node}:{i}".format(node=node, i=i))
+            self._nodes[h] = node
+            bisect.insort(self._hashes, h)
+
+    def remove_node(self, node):
+        for i in range(self.replicas):
+            h = self._hash("{node}:{i}".format(node=node, i=i))
+            if self._nodes.pop(h, None) is not None:
+                self._hashes.pop(bisect.bisect_left(self._hashes, h))
+
+    def get_node(self, key):
+        if not self._hashes:
+            raise GivrException("Hash ring has no nodes")
+        i = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[self._hashes[i]]
+
+
+def run_shard_worker(pipe, shard, first_port=None, last_port=House.LAST_PORT, room_port=None, journal_dir=None,
+                     room_pool=0, room_ttl=None, rate_limit=None, heartbeat_timeout=None, compact_membership=False):
+    """ Entry point of a shard worker process. Owns its own House and answers `(operation, data)`
+        requests from the router with `(ok, result)` until it receives None """
+    house = House.get_instance()
+    if first_port:
+        house.set_port_range(first_port, last_port)
+    if heartbeat_timeout:
+        SocketRoom.HEARTBEAT_TIMEOUT = heartbeat_timeout
+    if compact_membership:
+        Room.MEMBERSHIP = CompactMembership
+    if room_port:
+        from givr.roomserver import RoomServer
+        RoomServer(address=("127.0.0.1", room_port), house=house, heartbeat_timeout=heartbeat_timeout).dlisten()
+    if journal_dir:
+        house.attach_journal(RoomJournal(os.path.join(journal_dir, "shard-{shard}".format(shard=shard))))
+        house.listen_open_rooms()
+    if room_pool:
+        house.room_pool = RoomPool(house, size=room_pool).start()
+    if rate_limit:
+        house.rate_limiter = RateLimiter(connection_rate=rate_limit)
+    if room_ttl:
+        RoomReaper(house, ttl=room_ttl).start()
+    logger.info("Shard worker {shard} started".format(shard=shard))
+    while True:
+        try:
+            request = pipe.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        operation, data = request
+        try:
+            pipe.send((True, run_room_operation(operation, data, house=house, operations=WORKER_OPERATIONS)))
+        except GivrException as err:
+            pipe.send((False, err))
+        except Exception as err:
+            logger.error("Shard worker {shard} failed running '{op}': {err}".format(shard=shard, op=operation, err=err))
+            pipe.send((False, GivrException("{err_type}: '{err}'".format(err_type=err.__class__.__name__, err=err))))
+    if house.reaper:
+        house.reaper.stop()
+    house.detach_journal()
+    if house.room_pool:
+        house.room_pool.stop()
+    for room in house.rooms:
+        if getattr(room, "listening", False):
+            room.stop_listening()
+    logger.info("Shard worker {shard} stopped".format(shard=shard))
+
+
+class ShardRouter:
+    """ Starts `workers` shard processes and forwards room operations to the process that owns the
+        room, chosen by consistent hashing on room_id. Each worker gets its own block of room ports,
+        or its own single-port RoomServer at `room_port + shard`, and its own journal directory under
+        `journal_dir` when one is given """
+
+    PORTS_PER_SHARD = 1000
+
+    def __init__(self, workers=2, first_port=House.FIRST_PORT, room_port=None, journal_dir=None, room_pool=0,
+                 room_ttl=None, rate_limit=None, heartbeat_timeout=None, compact_membership=False):
+        self.workers = workers
+        self.first_port = first_port
+        self.room_port = room_port
+        self.journal_dir = journal_dir
+        self.room_pool = room_pool
+        self.room_ttl = room_ttl
+        self.rate_limit = rate_limit
+        self.heartbeat_timeout = heartbeat_timeout
+        self.compact_membership = compact_membership
+        self.ring = HashRing(range(workers))
+        self._pipes = {}
+        self._locks = {}
+        self._processes = {}
+
+    def start(self):
+        for shard in range(self.workers):
+            parent_pipe, child_pipe = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_shard_worker,
+                                              args=(child_pipe, shard),
+                                              kwargs={
+                                                  "first_port": self.first_port + shard * self.PORTS_PER_SHARD,
+                                                  "last_port": self.first_port + (shard + 1) * self.PORTS_PER_SHARD - 1,
+                                                  "room_port": self.room_port + shard if self.room_port else None,
+                                                  "journal_dir": self.journal_dir,
+                                                  "room_pool": self.room_pool,
+                                                  "room_ttl": self.room_ttl,
+                                                  "rate_limit": self.rate_limit,
+                                                  "heartbeat_timeout": self.heartbeat_timeout,
+                                                  "compact_membership": self.compact_membership
+                                              },
+                                              daemon=True)
+            process.start()
+            self._pipes[shard] = parent_pipe
+            self._locks[shard] = threading.Lock()
+            self._processes[shard] = process
+        return self
+
+    def stop(self):
+        for shard, pipe in self._pipes.items():
+            with self._locks[shard]:
+                pipe.send(None)
+        for process in self._processes.values():
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._pipes.clear()
+        self._processes.clear()
+
+    def shard_for(self, room_id):
+        return self.ring.get_node(room_id)
+
+    def forward(self, operation, data):
+        if operation == "bulk_membership":
+            return self._forward_bulk_membership(data)
+        if operation == "create":
+            # the id is picked here so the room lands on the worker that will be asked about it
+            operation, data = "create_with_id", dict(data, room_id=str(uuid.uuid1()))
+        return self._send(self.shard_for(data.get("room_id")), operation, data)
+
+    def _send(self, shard, operation, data):
+        # Flask request threads share the pipe, so each request/response pair holds its lock
+        with self._locks[shard]:
+            self._pipes[shard].send((operation, data))
+            ok, result = self._pipes[shard].recv()
+        if not ok:
+            raise result
+        return result
+
+    def render_metrics(self):
+        """ Every worker's metrics, each sample labelled with the shard it came from """
+        return merge_shards({shard: self._send(shard, "metrics", {})["metrics"] for shard in list(self._pipes)})
+
+    def _forward_bulk_membership(self, data):
+        """ Splits the items by owning shard, sends each shard its part and stitches the per-item
+            results back together in request order """
+        items = data.get("memberships") or []
+        by_shard = {}
+        for i, item in enumerate(items):
+            by_shard.setdefault(self.shard_for(item.get("room_id")), []).append(i)
+        results = [None] * len(items)
+        user_counts = {}
+        for shard, indices in by_shard.items():
+            resp = self._send(shard, "bulk_membership", {"memberships": [items[i] for i in indices]})
+            for i, result in zip(indices, resp["results"]):
+                results[i] = result
+            user_counts.update(resp["user_counts"])
+        return {"success": True, "results": results, "user_counts": user_counts}
@@ -1,8 +1,8 @@
-import re
 from givr.user import User
 from givr.exceptions import SocketMessageException
 from stevesockets.websocket import WebSocketFrame
 from givr.logging import get_logger
+import struct
 
 logger = get_logger(__name__)
 
@@ -16,24 +16,36 @@ class SocketMessageMetaClass(type):
         "SUCCESS": "SUCCESS",
         "WINNER": "WINNER",
         "GIVEAWAY": "GIVEAWAY",
-        "FAILURE": "FAILURE"
+        "FAILURE": "FAILURE",
+        "PING": "PING"
     }
 
     def __init__(self, name, bases, namespace):
         super(SocketMessageMetaClass, self).__init__(name, bases, namespace)
         for msg, value in self.all_messages.items():
             setattr(self, msg, value)
+        # one-byte type codes for the binary wire format, in all_messages order, so new message
+        # types must only ever be added at the end
+        self.message_codes = {msg: code for code, msg in enumerate(self.all_messages)}
+        self.code_messages = tuple(self.all_messages)
 
 
 class SocketMessage(metaclass=SocketMessageMetaClass):
-    MSG_REGEX = re.compile(r"([\w\d-]+):([\w\d\-]+):(\w+)(?:\:(.+))?")
-    UUID_REGEX = re.compile(r"[\w\d]{8}-[\w\d]{4}-[\w\d]{4}-[\w\d]{4}-[\w\d]{12}")
+    __slots__ = ("sender", "recipient", "message", "info", "_raw", "_text", "_bytes")
+
+    UUID_LEN = 36
+    UUID_HYPHENS = (8, 13, 18, 23)
+    UUID_CHARS = frozenset("0123456789abcdefABCDEF-")
+    # binary layout: sender and recipient as raw 16-byte UUIDs, the message type code and the length
+    # of the UTF-8 info that follows, 4 bytes wide since a big giveaway's WINNER info runs past 64KB
+    BINARY_HEADER = struct.Struct("!16s16sBI")
+    NIL_UUID = bytes(16)
 
     def __init__(self, sender=None, recipient=None, message=None, info=None):
-        if sender and not self.UUID_REGEX.findall(sender):
+        if sender and not self.is_uuid(sender):
             logger.warning("Sender UUID '{uid}' invalid".format(uid=sender))
             raise SocketMessageException("Sender UUID '{uid}' invalid".format(uid=sender))
-        if recipient and not self.UUID_REGEX.findall(recipient):
+        if recipient and not self.is_uuid(recipient):
             logger.warning("Recipient UUID '{uid}' invalid".format(uid=recipient))
             raise SocketMessageException("Recipient UUID '{uid}' invalid".format(uid=recipient))
         if message and message not in SocketMessage.all_messages:
@@ -44,24 +56,116 @@ class SocketMessage(metaclass=SocketMessageMetaClass):
         self.recipient = recipient
         self.message = message
         self.info = info
-        logger.debug("New SocketMessage created '{msg}'".format(msg=self))
+        self._raw = None
+        self._text = None
+        self._bytes = None
+
+    @classmethod
+    def is_uuid(cls, uid):
+        """ Checks the canonical 8-4-4-4-12 hex layout by length and character set, no regex needed """
+        if len(uid) != cls.UUID_LEN or not cls.UUID_CHARS.issuperset(uid):
+            return False
+        return uid.count("-") == 4 and all(uid[i] == "-" for i in cls.UUID_HYPHENS)
 
     def __str__(self):
-        return "{sender}:{recipient}:{msg}{info}".format(sender=self.sender,
-                                                       recipient=self.recipient,
-                                                       msg=self.message,
-                                                       info=":" + self.info if self.info else "")
+        return self.to_text()
+
     def to_text(self):
-        return str(self)
+        # messages are treated as immutable once built, so the serialized text is cached
+        if self._text is None:
+            if self.info:
+                self._text = "{sender}:{recipient}:{msg}:{info}".format(sender=self.sender,
+                                                                        recipient=self.recipient,
+                                                                        msg=self.message,
+                                                                        info=self.info)
+            else:
+                self._text = "{sender}:{recipient}:{msg}".format(sender=self.sender,
+                                                                 recipient=self.recipient,
+                                                                 msg=self.message)
+        return self._text
 
     @classmethod
     def from_text(cls, text):
-        matches = cls.MSG_REGEX.findall(text)
-        if matches:
-            sender, recipient, msg, info = matches[0]
-        else:
+        if type(text) == bytes:
+            text = text.decode()
+        parts = text.rstrip("\r\n").split(":", 3)
+        if len(parts) < 3 or not parts[0] or not parts[1] or not parts[2]:
             raise SocketMessageException("Message text '{msg}' invalid".format(msg=text))
+        if len(parts) == 3:
+            sender, recipient, msg = parts
+            info = None
+        else:
+            sender, recipient, msg, info = parts
 
         smsg = cls(sender=sender, recipient=recipient, message=msg, info=info)
         smsg._raw = text
         return smsg
+
+    def to_bytes(self):
+        """ Encodes the message in the binary wire format, cached like the text """
+        if self._bytes is None:
+            info = self.info.encode() if self.info else b""
+            self._bytes = self.BINARY_HEADER.pack(self._uuid_bytes(self.sender),
+                                                  self._uuid_bytes(self.recipient),
+                                                  self.message_codes[self.message],
+                                                  len(info)) + info
+        return self._bytes
+
+    @classmethod
+    def _uuid_bytes(cls, uid):
+        return User.id_to_bytes(uid) if uid else cls.NIL_UUID
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Decodes one binary message, which must fill `data` exactly """
+        msg, end = cls._decode(memoryview(data), 0)
+        if end != len(data):
+            raise SocketMessageException("Binary message has {n} trailing bytes".format(n=len(data) - end))
+        return msg
+
+    @classmethod
+    def iter_bytes(cls, data):
+        """ Yields every message of a frame holding binary messages back to back, the binary
+            counterpart of a pipelined text frame """
+        view = memoryview(data)
+        offset = 0
+        while offset < len(view):
+            msg, offset = cls._decode(view, offset)
+            yield msg
+
+    @classmethod
+    def _decode(cls, view, offset):
+        header = cls.BINARY_HEADER
+        try:
+            sender, recipient, code, info_len = header.unpack_from(view, offset)
+        except struct.error:
+            raise SocketMessageException("Binary message truncated at byte {n}".format(n=offset))
+        start = offset + header.size
+        end = start + info_len
+        if end > len(view):
+            raise SocketMessageException("Binary message info truncated at byte {n}".format(n=offset))
+        if code >= len(cls.code_messages):
+            raise SocketMessageException("Message code '{code}' invalid".format(code=code))
+        # like the empty ids from_text rejects, a nil id names no one
+        if sender == cls.NIL_UUID or recipient == cls.NIL_UUID:
+            raise SocketMessageException("Binary message at byte {n} has a nil sender or recipient".format(n=offset))
+        try:
+            info = str(view[start:end], "utf-8") if info_len else None
+        except UnicodeDecodeError:
+            raise SocketMessageException("Binary message info at byte {n} isn't UTF-8".format(n=offset))
+        # ids decoded from raw bytes are well-formed by construction, so the checks in __init__ are skipped
+        msg = cls.__new__(cls)
+        msg.sender = User.id_from_bytes(sender)
+        msg.recipient = User.id_from_bytes(recipient)
+        msg.message = cls.code_messages[code]
+        msg.info = info
+        msg._raw = None
+        msg._text = None
+        msg._bytes = None
+        return msg, end
+
+    @classmethod
+    def from_texts(cls, texts):
+        """ Decodes a batch of raw frames (str or bytes) into a list of messages in one call """
+        from_text = cls.from_text
+        return [from_text(text) for text in texts]
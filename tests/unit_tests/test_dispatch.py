@@ -0,0 +1,87 @@
+import unittest
+import uuid
+from givr.dispatch import CommandDispatcher, command, check_recipient, reply_failure
+from givr.exceptions import RoomException
+from givr.room import SocketRoom
+from givr.socketmessage import SocketMessage
+
+
+calls = []
+
+
+def trace(name):
+    def middleware(handler, message):
+        calls.append(("wrap", name, message))
+
+        def traced(room, msg):
+            calls.append(("call", name))
+            return handler(room, msg)
+        return traced
+    return middleware
+
+
+class Dispatcher(CommandDispatcher):
+    MessageClass = SocketMessage
+    MIDDLEWARE = (reply_failure, trace("outer"))
+
+    def __init__(self):
+        self.room_id = str(uuid.uuid1())
+
+    @command(SocketMessage.JOIN, trace("inner"), check_recipient)
+    def join(self, msg):
+        calls.append(("handler", msg.message))
+        return "joined"
+
+    @command(SocketMessage.LEAVE)
+    def leave(self, msg):
+        raise RoomException("Can't leave")
+
+
+class TestCommandDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        calls.clear()
+        self.dispatcher = Dispatcher()
+
+    def message(self, message, recipient=None):
+        return SocketMessage(sender=str(uuid.uuid1()), recipient=recipient or self.dispatcher.room_id, message=message)
+
+    def test_middleware_resolved_once(self):
+        for i in range(2):
+            self.assertEqual(self.dispatcher.commands["JOIN"](self.dispatcher, self.message("JOIN")), "joined")
+        self.assertEqual([c for c in calls if c[0] == "wrap"], [])
+        self.assertEqual(calls, [("call", "outer"), ("call", "inner"), ("handler", "JOIN")] * 2)
+
+    def test_middleware_short_circuits(self):
+        resp = self.dispatcher.commands["JOIN"](self.dispatcher, self.message("JOIN", str(uuid.uuid1())))
+        self.assertEqual(resp.message, SocketMessage.FAILURE)
+        self.assertNotIn(("handler", "JOIN"), calls)
+
+    def test_errors_become_failures(self):
+        resp = self.dispatcher.commands["LEAVE"](self.dispatcher, self.message("LEAVE"))
+        self.assertEqual(resp.message, SocketMessage.FAILURE)
+        self.assertIn("Can't leave", resp.info)
+
+    def test_unknown_commands(self):
+        resp = self.dispatcher.commands["ENTER"](self.dispatcher, self.message("ENTER"))
+        self.assertEqual(resp.message, SocketMessage.FAILURE)
+        self.assertIn("No handler", resp.info)
+
+    def test_subclass_overrides_and_adds(self):
+        class Sub(Dispatcher):
+            def join(self, msg):
+                return "rejoined"
+
+            @command(SocketMessage.ENTER)
+            def enter(self, msg):
+                return "entered"
+
+        sub = Sub()
+        sub.room_id = self.dispatcher.room_id
+        self.assertEqual(Sub.commands["JOIN"](sub, self.message("JOIN")), "rejoined")
+        self.assertEqual(Sub.commands["ENTER"](sub, self.message("ENTER")), "entered")
+        self.assertEqual(Dispatcher.commands["ENTER"](sub, self.message("ENTER")).message, SocketMessage.FAILURE)
+
+    def test_socket_room_commands(self):
+        self.assertEqual({m for m, h in SocketRoom.commands.items() if h.__name__.startswith("_handle")},
+                         {"JOIN", "LEAVE", "GIVEAWAY", "PING"})
@@ -1,6 +1,7 @@
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import json
+import threading
 from givr.app import app
 from givr.user import User
 from givr.endpoints import *
@@ -9,8 +10,10 @@ import givr.room
 class EndpointsTestCase(unittest.TestCase):
 
     def setUp(self):
-        givr.room.WebSocketServer = Mock()
-        givr.room.SocketServer = Mock()
+        for server_cls in ("givr.room.WebSocketServer", "givr.room.SocketServer"):
+            patcher = patch(server_cls)
+            patcher.start()
+            self.addCleanup(patcher.stop)
         self.app = app.test_client()
 
         self.house = givr.room.House.get_instance()
@@ -40,6 +43,13 @@ class EndpointsTestCase(unittest.TestCase):
         self.assertTrue(json_resp.get("success"))
         self.assertIsNotNone(json_resp.get("room_id"))
 
+    def test_endpoint_room_create_ignores_room_id(self):
+        self.room.open()
+        json_resp = self.json_response(path="/api/room/create", method="POST", params={"room_id": self.room.room_id})
+        self.assertNotEqual(json_resp["room_id"], self.room.room_id)
+        self.assertIs(self.house.get_room(self.room.room_id), self.room)
+        self.assertTrue(self.room.is_open())
+
     def test_endpoint_room_open(self):
         json_resp = self.json_response(path="/api/room/open", method="POST", params={"room_id": self.room.room_id, "owner_id": "TEST USER"})
         self.assertTrue(json_resp["success"])
@@ -75,6 +85,35 @@ class EndpointsTestCase(unittest.TestCase):
         self.assertEqual(0, json_resp.get("user_count"))
         self.assertEqual(self.room.room_id, json_resp.get("room_id"))
 
+    def test_endpoint_room_add_users(self):
+        self.room.open()
+        self.room.add_user(User.from_user_id("TEST USER 1"))
+        json_resp = self.json_response(path="/api/room/add_users", method="POST",
+                                       params={"room_id": self.room.room_id, "user_ids": ["TEST USER 1", "TEST USER 2"]})
+        self.assertTrue(json_resp["success"])
+        self.assertEqual(json_resp["user_count"], 2)
+        self.assertEqual([r["added"] for r in json_resp["results"]], [False, True])
+
+    def test_endpoint_room_remove_users(self):
+        self.room.open()
+        self.room.add_user(User.from_user_id("TEST USER 1"))
+        json_resp = self.json_response(path="/api/room/remove_users", method="POST",
+                                       params={"room_id": self.room.room_id, "user_ids": ["TEST USER 1", "TEST USER 2"]})
+        self.assertEqual(json_resp["user_count"], 0)
+        self.assertEqual([r["removed"] for r in json_resp["results"]], [True, False])
+
+    def test_endpoint_room_bulk_membership(self):
+        self.room.open()
+        self.room.add_user(User.from_user_id("TEST USER 3"))
+        memberships = [{"room_id": self.room.room_id, "user_id": "TEST USER 1"},
+                       {"room_id": "MISSING ROOM", "user_id": "TEST USER 1"},
+                       {"room_id": self.room.room_id, "user_id": "TEST USER 3", "action": "remove"},
+                       {"room_id": self.room.room_id, "user_id": "TEST USER 2", "action": "add"}]
+        json_resp = self.json_response(path="/api/room/bulk_membership", method="POST", params={"memberships": memberships})
+        self.assertEqual([r["success"] for r in json_resp["results"]], [True, False, True, True])
+        self.assertEqual(json_resp["results"][2]["changed"], True)
+        self.assertEqual(json_resp["user_counts"], {self.room.room_id: 2})
+
     def test_endpoint_room_info(self):
         json_resp = self.json_response(path="/api/room/info", method="GET", params={"room_id": self.room.room_id})
         self.assertIsNone(json_resp["owner"])
@@ -83,3 +122,66 @@ class EndpointsTestCase(unittest.TestCase):
         self.assertFalse(json_resp["is_open"])
         self.assertEqual(json_resp["address"], "127.0.0.1")
         self.assertEqual(json_resp["port"], 9000)
+
+    def test_endpoint_forwarded_to_shard_router(self):
+        router = Mock()
+        router.forward = Mock(return_value={"success": True, "room_id": "SHARDED ROOM"})
+        app.config["GIVR_SHARD_ROUTER"] = router
+        self.addCleanup(app.config.pop, "GIVR_SHARD_ROUTER")
+        json_resp = self.json_response(path="/api/room/create", method="POST")
+        self.assertEqual(json_resp["room_id"], "SHARDED ROOM")
+        router.forward.assert_called_once_with("create", {})
+
+    def test_endpoint_metrics(self):
+        response = self.app.get("/api/metrics")
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        self.assertIn('givr_room_users{{room_id="{r}"}} 0'.format(r=self.room.room_id), response.get_data().decode())
+
+    def test_endpoint_metrics_from_shards(self):
+        router = Mock()
+        router.render_metrics = Mock(return_value='givr_rooms{shard="0",state="open"} 3\n')
+        app.config["GIVR_SHARD_ROUTER"] = router
+        self.addCleanup(app.config.pop, "GIVR_SHARD_ROUTER")
+        response = self.app.get("/api/metrics")
+        self.assertEqual(response.get_data().decode(), 'givr_rooms{shard="0",state="open"} 3\n')
+
+    def test_endpoint_room_info_etag(self):
+        response = self.app.get("/api/room/info", query_string={"room_id": self.room.room_id})
+        etag = response.headers["ETag"]
+        self.assertEqual(response.status_code, 200)
+        response = self.app.get("/api/room/info", query_string={"room_id": self.room.room_id},
+                                headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.room.open()
+        response = self.app.get("/api/room/info", query_string={"room_id": self.room.room_id},
+                                headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_endpoint_room_info_etag_changes_with_epoch(self):
+        response = self.app.get("/api/room/info", query_string={"room_id": self.room.room_id})
+        etag = response.headers["ETag"]
+        house = House.get_instance()
+        # a restarted process recovers the room at the same version, under a new epoch
+        self.addCleanup(setattr, house, "epoch", house.epoch)
+        house.epoch = "restarted"
+        response = self.app.get("/api/room/info", query_string={"room_id": self.room.room_id},
+                                headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_endpoint_room_events(self):
+        self.room.open()
+        response = self.app.get("/api/room/events", query_string={"room_id": self.room.room_id, "timeout": 2},
+                                buffered=False)
+        events = iter(response.response)
+        first = json.loads(next(events).decode().split("data: ")[1])
+        self.assertEqual(first["user_count"], 0)
+        self.assertTrue(first["is_open"])
+        timer = threading.Timer(.1, lambda: self.room.add_users([User(), User()]))
+        timer.start()
+        delta = json.loads(next(events).decode().split("data: ")[1])
+        timer.join()
+        self.assertEqual(delta["user_count"], 2)
+        self.assertNotIn("is_open", delta)
+        response.close()
+
@@ -0,0 +1,79 @@
+import unittest
+from givr.frames import encode_frame, unmask, PerMessageDeflate
+import zlib
+
+
+class TestFrames(unittest.TestCase):
+
+    def test_encode_short_frame(self):
+        self.assertEqual(encode_frame("hi"), b"\x81\x02hi")
+
+    def test_encode_medium_frame(self):
+        frame = encode_frame("a" * 200)
+        self.assertEqual(frame[:4], b"\x81\x7e\x00\xc8")
+        self.assertEqual(len(frame), 204)
+
+    def test_unmask_round_trip(self):
+        mask = b"\x01\x02\x03\x04"
+        self.assertEqual(unmask(unmask(b"hello world", mask), mask), b"hello world")
+
+    def test_encode_compressed_frame(self):
+        self.assertEqual(encode_frame(b"hi", compressed=True), b"\xc1\x02hi")
+
+
+class TestPerMessageDeflate(unittest.TestCase):
+
+    def test_negotiate(self):
+        deflate = PerMessageDeflate.negotiate("permessage-deflate; client_max_window_bits")
+        self.assertEqual(deflate.response, "permessage-deflate")
+        self.assertTrue(deflate.context_takeover)
+        deflate = PerMessageDeflate.negotiate("x-webkit, permessage-deflate; server_max_window_bits=10; "
+                                              "client_no_context_takeover; server_no_context_takeover")
+        self.assertEqual(deflate.response, "permessage-deflate; server_max_window_bits=10; "
+                                           "client_no_context_takeover; server_no_context_takeover")
+        self.assertEqual(deflate.window_bits, 10)
+        self.assertFalse(deflate.context_takeover)
+
+    def test_negotiate_declines_unsupported_offers(self):
+        self.assertIsNone(PerMessageDeflate.negotiate(None))
+        self.assertIsNone(PerMessageDeflate.negotiate("x-webkit-deflate-frame"))
+        self.assertIsNone(PerMessageDeflate.negotiate("permessage-deflate; server_max_window_bits=8"))
+        self.assertIsNone(PerMessageDeflate.negotiate("permessage-deflate; unknown_param"))
+        self.assertIsNone(PerMessageDeflate.negotiate("permessage-deflate; server_no_context_takeover; "
+                                                      "server_no_context_takeover"))
+        # falls back to the next offer
+        deflate = PerMessageDeflate.negotiate("permessage-deflate; server_max_window_bits=8, permessage-deflate")
+        self.assertEqual(deflate.response, "permessage-deflate")
+
+    def inflate(self, decompressor, frame):
+        self.assertTrue(frame[0] & 0x40)
+        return decompressor.decompress(frame[2:] + PerMessageDeflate.TAIL)
+
+    def test_context_takeover(self):
+        deflate = PerMessageDeflate()
+        decompressor = zlib.decompressobj(-15)
+        message = "a1b2c3d4-0000-11f1-9b22-02fc00000001:a1b2c3d4-0000-11f1-9b22-02fc00000001:ENTER"
+        first = deflate.encode_frame(message)
+        second = deflate.encode_frame(message)
+        self.assertEqual(self.inflate(decompressor, first), message.encode())
+        self.assertEqual(self.inflate(decompressor, second), message.encode())
+        self.assertLess(len(second), len(first))
+
+    def test_no_context_takeover(self):
+        deflate = PerMessageDeflate(context_takeover=False)
+        message = "x" * 100
+        # every message has to inflate on its own
+        for i in range(2):
+            self.assertEqual(self.inflate(zlib.decompressobj(-15), deflate.encode_frame(message)), message.encode())
+
+    def test_short_messages_not_compressed(self):
+        self.assertEqual(PerMessageDeflate().encode_frame("hi"), b"\x81\x02hi")
+
+    def test_decompress(self):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        data = (compressor.compress(b"y" * 1000) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        self.assertEqual(PerMessageDeflate().decompress(data, 1000), b"y" * 1000)
+        with self.assertRaises(zlib.error):
+            PerMessageDeflate().decompress(data, 999)
+        with self.assertRaises(zlib.error):
+            PerMessageDeflate().decompress(b"\xff\xff\xff")
@@ -1,7 +1,11 @@
-from givr.giveaway import Giveaway
+from givr.giveaway import Giveaway, AliasTable
+from givr.exceptions import GiveawayException
 import unittest
 from unittest.mock import Mock
 import uuid
+import random
+import time
+from givr.user import User
 
 class TestGiveaway(unittest.TestCase):
 
@@ -24,3 +28,56 @@ class TestGiveaway(unittest.TestCase):
         for user in u:
             self.assertIn(user, self.users)
             self.assertTrue(u.count(user) == 1)
+
+    def test_giveaway_draw_too_many(self):
+        g = Giveaway(users=self.users)
+        with self.assertRaises(GiveawayException):
+            g.draw(6)
+
+    def test_giveaway_draw_seeded(self):
+        first = Giveaway(users=self.users, rng=random.Random(42)).draw(3)
+        second = Giveaway(users=self.users, rng=random.Random(42)).draw(3)
+        self.assertEqual(first, second)
+
+    def test_giveaway_draw_weighted(self):
+        g = Giveaway(users=self.users, weights=[0, 0, 1, 0, 3])
+        for x in range(20):
+            u = g.draw(2)
+            self.assertEqual(set(u), {self.users[2], self.users[4]})
+
+    def test_giveaway_draw_weighted_too_many(self):
+        g = Giveaway(users=self.users, weights=[0, 0, 1, 0, 3])
+        with self.assertRaises(GiveawayException):
+            g.draw(3)
+
+    def test_giveaway_draw_weighted_skewed(self):
+        users = [User() for x in range(10)]
+        g = Giveaway(users=users, weights=[10 ** 6] + [1] * 9, rng=random.Random(1))
+        start = time.monotonic()
+        self.assertCountEqual(g.draw(10), users)
+        self.assertLess(time.monotonic() - start, .5)
+
+    def test_weighted_keys_distribution(self):
+        g = Giveaway(users=self.users, weights=[0, 1, 0, 0, 3], rng=random.Random(0))
+        firsts = [g._draw_weighted_keys(1, set())[0] for x in range(4000)]
+        self.assertEqual(set(firsts), {1, 4})
+        self.assertAlmostEqual(firsts.count(4) / len(firsts), .75, delta=.05)
+        self.assertEqual(g._draw_weighted_keys(1, {4}), [1])
+
+    def test_giveaway_weights_mismatch(self):
+        g = Giveaway(users=self.users, weights=[1, 2])
+        with self.assertRaises(GiveawayException):
+            g.draw(1)
+
+
+class TestAliasTable(unittest.TestCase):
+
+    def test_alias_table_distribution(self):
+        table = AliasTable([1, 3])
+        rng = random.Random(0)
+        picks = [table.pick(rng) for x in range(4000)]
+        self.assertAlmostEqual(picks.count(1) / len(picks), .75, delta=.05)
+
+    def test_alias_table_no_positive_weights(self):
+        with self.assertRaises(GiveawayException):
+            AliasTable([0, 0])
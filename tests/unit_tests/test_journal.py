@@ -0,0 +1,156 @@
+import unittest
+import tempfile
+import shutil
+import os
+import uuid
+import threading
+from givr.journal import RoomJournal
+from givr.room import House, Room
+from givr.user import User
+from unittest.mock import patch
+
+
+class TestRoomJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.house = House.get_instance()
+
+    def tearDown(self):
+        self.house.detach_journal()
+        for room in self.house.rooms:
+            self.house.remove_room(room)
+
+    def test_replay(self):
+        journal = RoomJournal(self.directory).start(self.house)
+        journal.record("create", "ROOM", ["127.0.0.1", 9000])
+        journal.record("open", "ROOM")
+        journal.record("owner", "ROOM", "OWNER")
+        journal.record("add", "ROOM", ["OWNER", "U1", "U2"])
+        journal.record("remove", "ROOM", ["U1"])
+        journal.record("create", "GONE", None)
+        journal.record("remove_room", "GONE")
+        journal.stop()
+        rooms = RoomJournal(self.directory).load()
+        self.assertEqual(list(rooms), ["ROOM"])
+        self.assertEqual(rooms["ROOM"]["users"], ["OWNER", "U2"])
+        self.assertEqual(rooms["ROOM"]["owner"], "OWNER")
+        self.assertTrue(rooms["ROOM"]["open"])
+        self.assertEqual(rooms["ROOM"]["address"], ["127.0.0.1", 9000])
+
+    def test_torn_last_event_ignored(self):
+        journal = RoomJournal(self.directory).start(self.house)
+        journal.record("create", "ROOM", None)
+        journal.stop()
+        with open(os.path.join(self.directory, "journal-0.log"), "a") as f:
+            f.write('["open","RO')
+        rooms = RoomJournal(self.directory).load()
+        self.assertFalse(rooms["ROOM"]["open"])
+
+    def test_house_recovers_rooms(self):
+        self.house.attach_journal(RoomJournal(self.directory))
+        room = Room()
+        self.house.add_room(room)
+        room.open()
+        owner = User()
+        room.add_owner(owner)
+        users = [User.from_user_id(str(uuid.uuid1())) for i in range(5)]
+        room.add_users(users)
+        room.remove_user(users[0])
+        self.house.detach_journal()
+        self.house.remove_room(room)
+
+        self.house.attach_journal(RoomJournal(self.directory))
+        recovered = self.house.get_room(room.room_id)
+        self.assertTrue(recovered.is_open())
+        self.assertEqual(recovered.owner, owner)
+        self.assertEqual(recovered.users, [owner] + users[1:])
+
+    def test_snapshot_compacts_journal(self):
+        journal = RoomJournal(self.directory)
+        self.house.attach_journal(journal)
+        room = Room()
+        self.house.add_room(room)
+        room.open()
+        room.add_user(User())
+        journal.snapshot()
+        late = User()
+        room.add_user(late)
+        self.house.detach_journal()
+        self.assertEqual(sorted(os.listdir(self.directory)), ["journal-1.log", "snapshot.json"])
+        self.house.remove_room(room)
+
+        rooms = RoomJournal(self.directory).load()
+        self.assertEqual(len(rooms[room.room_id]["users"]), 2)
+        self.assertIn(late.user_id, rooms[room.room_id]["users"])
+
+    def test_snapshot_during_writes(self):
+        # rooms record while holding their own lock, so a snapshot must not hold the journal's lock
+        # while it takes theirs
+        journal = RoomJournal(self.directory, snapshot_interval=3600)
+        self.house.attach_journal(journal)
+        room = Room()
+        self.house.add_room(room)
+        room.open()
+        stop = threading.Event()
+
+        def join():
+            while not stop.is_set():
+                room.add_user(User())
+
+        def snapshot():
+            for i in range(50):
+                journal.snapshot()
+
+        writers = [threading.Thread(target=join, daemon=True) for i in range(2)]
+        snapshots = threading.Thread(target=snapshot, daemon=True)
+        for t in writers + [snapshots]:
+            t.start()
+        snapshots.join(timeout=10)
+        stop.set()
+        for t in writers:
+            t.join(timeout=5)
+        self.assertFalse(snapshots.is_alive())
+        self.assertFalse(any(t.is_alive() for t in writers))
+        self.house.detach_journal()
+        self.assertEqual(len(RoomJournal(self.directory).load()[room.room_id]["users"]), room.user_count())
+
+    def test_journal_after_unfinished_snapshot_replayed(self):
+        journal = RoomJournal(self.directory).start(self.house)
+        journal.record("create", "ROOM", None)
+        journal.stop()
+        # what a crash after switching to the next journal but before writing the snapshot leaves
+        with open(os.path.join(self.directory, "journal-1.log"), "w") as f:
+            f.write('["open","ROOM"]\n')
+        journal = RoomJournal(self.directory)
+        rooms = journal.load()
+        self.assertTrue(rooms["ROOM"]["open"])
+        self.assertEqual(journal.generation, 1)
+
+    def test_recording_not_held_off_by_snapshot(self):
+        journal = RoomJournal(self.directory, snapshot_interval=3600)
+        self.house.attach_journal(journal)
+        room = Room()
+        self.house.add_room(room)
+        collecting, release = threading.Event(), threading.Event()
+        room_state = RoomJournal._room_state
+
+        def slow_room_state(room):
+            collecting.set()
+            release.wait(5)
+            return room_state(room)
+
+        with patch.object(RoomJournal, "_room_state", staticmethod(slow_room_state)):
+            snapshot = threading.Thread(target=journal.snapshot, daemon=True)
+            snapshot.start()
+            self.assertTrue(collecting.wait(5))
+            recorder = threading.Thread(target=room.open, daemon=True)
+            recorder.start()
+            recorder.join(timeout=1)
+            self.assertFalse(recorder.is_alive())
+            journal.sync()
+            release.set()
+            snapshot.join(timeout=5)
+        self.house.detach_journal()
+        self.assertTrue(RoomJournal(self.directory).load()[room.room_id]["open"])
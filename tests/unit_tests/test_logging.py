@@ -0,0 +1,24 @@
+import unittest
+import logging
+from givr.logging import get_logger, DeferredQueueHandler
+
+
+class TestLogging(unittest.TestCase):
+
+    def test_handlers_shared(self):
+        first = get_logger("givr.test_logging.first")
+        second = get_logger("givr.test_logging.second")
+        self.assertEqual(first.handlers, second.handlers)
+
+    def test_handler_added_once(self):
+        get_logger("givr.test_logging.repeat")
+        logger = get_logger("givr.test_logging.repeat")
+        self.assertEqual(len(logger.handlers), 1)
+        self.assertIsInstance(logger.handlers[0], DeferredQueueHandler)
+
+    def test_record_not_formatted_by_caller(self):
+        handler = get_logger("givr.test_logging.prepare").handlers[0]
+        record = logging.LogRecord("test", logging.DEBUG, __file__, 1, "value %s", ("x",), None)
+        prepared = handler.prepare(record)
+        self.assertEqual(prepared.msg, "value %s")
+        self.assertEqual(prepared.args, ("x",))
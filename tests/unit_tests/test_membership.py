@@ -0,0 +1,129 @@
+import unittest
+import random
+from givr.exceptions import RoomException
+from givr.membership import Membership, CompactMembership
+from givr.room import House, Room
+from givr.operations import run_room_operation
+from givr.user import User
+
+
+class CompactRoom(Room):
+    MEMBERSHIP = CompactMembership
+
+
+class TestMembership(unittest.TestCase):
+
+    BACKEND = Membership
+
+    def setUp(self):
+        self.members = self.BACKEND()
+
+    def test_add_remove(self):
+        users = [User() for i in range(5)]
+        self.assertTrue(all(self.members.add(u) for u in users))
+        self.assertFalse(self.members.add(users[0]))
+        self.assertEqual(len(self.members), 5)
+        self.assertIn(users[3].user_id, self.members)
+        self.assertTrue(self.members.remove(users[3].user_id))
+        self.assertFalse(self.members.remove(users[3].user_id))
+        self.assertNotIn(users[3].user_id, self.members)
+        self.assertEqual(len(self.members), 4)
+        self.assertCountEqual(self.members.users(), users[:3] + users[4:])
+
+    def test_entrants_follow_removals(self):
+        users = [User() for i in range(50)]
+        for u in users:
+            self.members.add(u)
+        rng = random.Random(7)
+        left = set(users)
+        for u in rng.sample(users, 30):
+            self.members.remove(u.user_id)
+            left.discard(u)
+        entrants = self.members.entrants()
+        self.assertEqual({entrants[i] for i in range(len(self.members))}, left)
+
+
+class TestCompactMembership(TestMembership):
+
+    BACKEND = CompactMembership
+
+    def test_rejects_non_uuid_ids(self):
+        user = User.from_user_id("not-a-uuid")
+        with self.assertRaises(RoomException):
+            self.members.add(user)
+        self.assertNotIn("not-a-uuid", self.members)
+        self.assertFalse(self.members.remove("not-a-uuid"))
+
+    def test_add_all_rejects_batch_with_non_uuid_id(self):
+        users = [User(), User(), User.from_user_id("bob")]
+        with self.assertRaises(RoomException):
+            self.members.add_all(users)
+        self.assertEqual(len(self.members), 0)
+        self.assertEqual(self.members.add_all(users[:2] + users[:1]), [True, True, False])
+
+    def test_room_add_users_all_or_nothing(self):
+        room = CompactRoom()
+        room.open()
+        version = room.version
+        with self.assertRaises(RoomException):
+            room.add_users([User(), User(), User.from_user_id("bob")])
+        self.assertEqual((room.user_count(), room.version), (0, version))
+
+    def test_bulk_membership_reports_bad_id_alone(self):
+        house = House.get_instance()
+        room = CompactRoom()
+        room.open()
+        house.add_room(room)
+        self.addCleanup(house.remove_room, room)
+        version = room.version
+        memberships = [{"room_id": room.room_id, "user_id": uid} for uid in (User().user_id, "bob", User().user_id)]
+        resp = run_room_operation("bulk_membership", {"memberships": memberships})
+        self.assertEqual([r["success"] for r in resp["results"]], [True, False, True])
+        self.assertIn("bob", resp["results"][1]["message"])
+        self.assertEqual(resp["user_counts"], {room.room_id: 2})
+        self.assertEqual(room.version, version + 2)
+
+    def test_index_survives_churn(self):
+        # enough adds and removes to grow the index and rebuild it over its tombstones
+        rng = random.Random(3)
+        present = {}
+        for step in range(5000):
+            if present and rng.random() < .4:
+                uid = rng.choice(list(present))
+                self.assertTrue(self.members.remove(uid))
+                del present[uid]
+            else:
+                user = User()
+                self.assertTrue(self.members.add(user))
+                present[user.user_id] = user
+        self.assertEqual(len(self.members), len(present))
+        self.assertCountEqual(self.members.user_ids(), present)
+        self.assertTrue(all(uid in self.members for uid in present))
+
+    def test_members_are_built_lazily(self):
+        uid = str(User().user_id)
+        self.members.add(User.from_user_id(uid))
+        self.assertIsNone(User._registry.get(uid))
+        self.assertEqual(self.members.entrants()[0].user_id, uid)
+        with self.assertRaises(IndexError):
+            self.members.entrants()[1]
+
+    def test_room(self):
+        room = CompactRoom()
+        room.open()
+        users = [User() for i in range(20)]
+        room.add_users(users)
+        room.remove_user(users[0])
+        self.assertEqual(room.user_count(), 19)
+        self.assertTrue(room.has_user(users[1]))
+        self.assertFalse(room.has_user(users[0]))
+        self.assertCountEqual(room.users, users[1:])
+        winners = room.draw(5, random.Random(1))
+        self.assertEqual(len(set(winners)), 5)
+        self.assertTrue(set(winners) <= set(users[1:]))
+        room.close()
+        self.assertEqual(room.user_count(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
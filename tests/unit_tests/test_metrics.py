@@ -0,0 +1,55 @@
+import unittest
+import threading
+from unittest.mock import Mock
+from givr.metrics import Metrics, merge_shards
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_record_command(self):
+        self.metrics.record_command("JOIN", "ok", .0002)
+        self.metrics.record_command("JOIN", "ok", .0002)
+        self.metrics.record_command("JOIN", "handled_error", .0002)
+        counts = self.metrics.command_counts()
+        self.assertEqual(counts[("JOIN", "ok")], 2)
+        self.assertEqual(counts[("JOIN", "handled_error")], 1)
+
+    def test_counts_summed_across_threads(self):
+        def record():
+            for x in range(100):
+                self.metrics.record_command("LEAVE", "ok", .001)
+        threads = [threading.Thread(target=record) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.metrics.command_counts()[("LEAVE", "ok")], 400)
+        self.assertEqual(sum(self.metrics.latency_histograms()["LEAVE"][:-1]), 400)
+
+    def test_render(self):
+        self.metrics.record_command("GIVEAWAY", "ok", .003)
+        room = Mock(room_id="ROOM", connections=[Mock(), Mock()])
+        room.is_open = Mock(return_value=True)
+        room.user_count = Mock(return_value=7)
+        house = Mock(rooms=[room], room_server=None)
+        text = self.metrics.render(house)
+        self.assertIn('givr_commands_total{command="GIVEAWAY",outcome="ok"} 1', text)
+        self.assertIn('givr_command_latency_seconds_bucket{command="GIVEAWAY",le="0.0025"} 0', text)
+        self.assertIn('givr_command_latency_seconds_bucket{command="GIVEAWAY",le="0.005"} 1', text)
+        self.assertIn('givr_command_latency_seconds_count{command="GIVEAWAY"} 1', text)
+        self.assertIn('givr_rooms{state="open"} 1', text)
+        self.assertIn('givr_room_users{room_id="ROOM"} 7', text)
+        self.assertIn('givr_room_connections{room_id="ROOM"} 2', text)
+
+    def test_merge_shards(self):
+        text = ("# HELP givr_rooms Rooms\n# TYPE givr_rooms gauge\ngivr_rooms{state=\"open\"} {n}\n"
+                "# HELP givr_rooms_evicted_total Evicted\n# TYPE givr_rooms_evicted_total counter\n"
+                "givr_rooms_evicted_total {n}\n")
+        merged = merge_shards({0: text.replace("{n}", "1"), 1: text.replace("{n}", "2")}).splitlines()
+        self.assertEqual(merged, ["# HELP givr_rooms Rooms", "# TYPE givr_rooms gauge",
+                                  'givr_rooms{shard="0",state="open"} 1', 'givr_rooms{shard="1",state="open"} 2',
+                                  "# HELP givr_rooms_evicted_total Evicted", "# TYPE givr_rooms_evicted_total counter",
+                                  'givr_rooms_evicted_total{shard="0"} 1', 'givr_rooms_evicted_total{shard="1"} 2'])
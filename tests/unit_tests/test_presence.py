@@ -0,0 +1,170 @@
+import unittest
+import time
+import uuid
+from unittest.mock import Mock
+from givr.presence import Presence
+from givr.room import House, Room, SocketRoom, WebSocketRoom
+from givr.roomserver import RoomServer
+from givr.user import User
+from tests.unit_tests import test_roomserver
+
+
+class TestPresence(unittest.TestCase):
+
+    def setUp(self):
+        self.presence = Presence(timeout=10)
+        self.room = Room()
+        self.room.open()
+
+    def join(self, connection, user):
+        self.room.add_user(user)
+        self.presence.joined(connection, self.room, user.user_id)
+
+    def test_disconnect_removes_users(self):
+        connection, other = Mock(), Mock()
+        users = [User() for i in range(3)]
+        self.join(connection, users[0])
+        self.join(connection, users[1])
+        self.join(other, users[2])
+        self.assertEqual(self.presence.disconnected(connection), 2)
+        self.assertEqual(self.room.users, [users[2]])
+
+    def test_user_on_two_connections(self):
+        connection, other = Mock(), Mock()
+        user = User()
+        self.join(connection, user)
+        self.join(other, user)
+        self.presence.disconnected(connection)
+        self.assertTrue(self.room.has_user(user))
+        self.presence.disconnected(other)
+        self.assertFalse(self.room.has_user(user))
+
+    def test_left_users_not_removed_again(self):
+        connection = Mock()
+        user = User()
+        self.join(connection, user)
+        self.presence.left(connection, self.room, user.user_id)
+        self.room.remove_user(user)
+        version = self.room.version
+        self.assertEqual(self.presence.disconnected(connection), 0)
+        self.assertEqual(self.room.version, version)
+
+    def test_expire(self):
+        quiet, chatty = Mock(), Mock()
+        now = time.monotonic()
+        self.presence.connected(quiet, now)
+        self.presence.connected(chatty, now)
+        self.presence.seen(chatty, now + 8)
+        self.assertEqual(self.presence.expire(now + 5), [])
+        self.assertEqual(self.presence.expire(now + 11), [quiet])
+        self.assertEqual(self.presence.expire(now + 19), [chatty])
+
+    def test_idle(self):
+        quiet, chatty = Mock(), Mock()
+        now = time.monotonic()
+        self.presence.connected(quiet, now)
+        self.presence.connected(chatty, now + 3)
+        self.assertEqual(self.presence.idle(now + 4), [quiet])
+
+
+class TestSocketRoomPresence(unittest.TestCase):
+
+    def setUp(self):
+        self.room = SocketRoom()
+        self.room.open()
+
+    def connection(self):
+        return Mock(is_closed=Mock(return_value=False), is_to_be_closed=Mock(return_value=False),
+                    address="127.0.0.1", port=1234, messages=[])
+
+    def test_pruned_connection_users_removed(self):
+        connection = self.connection()
+        self.room.connections = [connection]
+        self.room._track_connections()
+        user = User()
+        self.room.add_user(user)
+        self.room.presence.joined(connection, self.room, user.user_id)
+        self.room.connections = []
+        self.room._track_connections()
+        self.assertFalse(self.room.has_user(user))
+
+    def test_ping_keeps_connection(self):
+        self.room.HEARTBEAT_TIMEOUT = .2
+        connection = self.connection()
+        self.room.connections = [connection]
+        self.room._track_connections()
+        time.sleep(.15)
+        connection.socket.recv.return_value = "{u}:{r}:PING".format(u=str(uuid.uuid1()), r=self.room.room_id).encode()
+        self.room.connection_handler(connection)
+        self.assertTrue(connection.queue_message.call_args[0][0].startswith(self.room.room_id.encode()))
+        self.assertIn(b":SUCCESS", connection.queue_message.call_args[0][0])
+        time.sleep(.1)
+        self.room._track_connections()
+        connection.mark_for_closing.assert_not_called()
+
+    def test_silent_connection_closed(self):
+        self.room.HEARTBEAT_TIMEOUT = .05
+        connection = self.connection()
+        self.room.connections = [connection]
+        self.room._track_connections()
+        time.sleep(.1)
+        self.room._track_connections()
+        connection.mark_for_closing.assert_called_once()
+
+
+class TestRoomServerPresence(unittest.TestCase):
+
+    connect = test_roomserver.TestRoomServer.connect
+    send_text = test_roomserver.TestRoomServer.send_text
+    recv_exactly = test_roomserver.TestRoomServer.recv_exactly
+    recv_raw_frame = test_roomserver.TestRoomServer.recv_raw_frame
+    recv_frame = test_roomserver.TestRoomServer.recv_frame
+    recv_text = test_roomserver.TestRoomServer.recv_text
+    tearDown = test_roomserver.TestRoomServer.tearDown
+
+    def setUp(self):
+        self.house = House.get_instance()
+        self.server = RoomServer(address=("127.0.0.1", 0), house=self.house, heartbeat_timeout=.3)
+        self.thread = self.server.dlisten()
+        self.room = WebSocketRoom(address=self.server.address)
+        self.room.address = self.server.address
+        self.room.open()
+        self.house.add_room(self.room)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(.01)
+        return condition()
+
+    def test_disconnect_removes_user(self):
+        sck, response = self.connect("/" + self.room.room_id)
+        self.send_text(sck, "{u}:{r}:JOIN".format(u=str(uuid.uuid1()), r=self.room.room_id))
+        self.recv_text(sck)
+        self.assertEqual(self.room.user_count(), 1)
+        sck.close()
+        self.assertTrue(self.wait_for(lambda: self.room.user_count() == 0))
+
+    def test_silent_connection_pinged_then_closed(self):
+        sck, response = self.connect("/" + self.room.room_id)
+        self.send_text(sck, "{u}:{r}:JOIN".format(u=str(uuid.uuid1()), r=self.room.room_id))
+        self.recv_text(sck)
+        opcode, payload = self.recv_frame(sck)
+        self.assertEqual(opcode, 0x9)
+        # never answering the ping gets the connection closed and the user removed
+        self.assertTrue(self.wait_for(lambda: self.room.user_count() == 0))
+        while sck.recv(4096):
+            pass  # pings sent before it was closed
+        sck.close()
+
+    def test_pong_keeps_connection(self):
+        sck, response = self.connect("/" + self.room.room_id)
+        self.send_text(sck, "{u}:{r}:JOIN".format(u=str(uuid.uuid1()), r=self.room.room_id))
+        self.recv_text(sck)
+        deadline = time.monotonic() + 1
+        while time.monotonic() < deadline:
+            opcode, payload = self.recv_frame(sck)
+            self.assertEqual(opcode, 0x9)
+            self.send_text(sck, payload, opcode=0xA)
+        self.assertEqual(self.room.user_count(), 1)
+        sck.close()
@@ -0,0 +1,84 @@
+import unittest
+import uuid
+from unittest.mock import Mock
+from givr.ratelimit import TokenBucket, RateLimiter
+from givr.room import House, SocketRoom
+from givr.socketmessage import SocketMessage
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=2, burst=3, now=0)
+        self.assertEqual([bucket.take(now=0) for i in range(4)], [True, True, True, False])
+        self.assertAlmostEqual(bucket.wait_time(now=0), .5)
+        self.assertTrue(bucket.take(now=.5))
+        self.assertFalse(bucket.take(now=.5))
+
+    def test_refill_capped_at_burst(self):
+        bucket = TokenBucket(rate=10, burst=2, now=0)
+        bucket.take(now=0)
+        self.assertTrue(bucket.is_full(now=100))
+        self.assertEqual([bucket.take(now=100) for i in range(3)], [True, True, False])
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = RateLimiter(connection_rate=2, command_limits={"JOIN": (1, 2)})
+        self.room_id = str(uuid.uuid1())
+
+    def command(self, sender, command="JOIN"):
+        return "{s}:{r}:{c}".format(s=sender, r=self.room_id, c=command)
+
+    def test_per_sender_limit(self):
+        a, b = str(uuid.uuid1()), str(uuid.uuid1())
+        self.assertEqual([self.limiter.allow(self.command(a), now=0) for i in range(3)], [True, True, False])
+        self.assertTrue(self.limiter.allow(self.command(b), now=0))
+        self.assertTrue(self.limiter.allow(self.command(a), now=1))
+        self.assertEqual(self.limiter.rejected, 1)
+
+    def test_unlimited_commands(self):
+        sender = str(uuid.uuid1())
+        self.assertTrue(all(self.limiter.allow(self.command(sender, "LEAVE"), now=0) for i in range(10)))
+        self.assertTrue(self.limiter.allow("garbage", now=0))
+
+    def test_connection_delay(self):
+        connection = Mock()
+        self.assertEqual(self.limiter.connection_delay(connection, now=0), 0)
+        self.assertEqual(self.limiter.connection_delay(connection, now=0), 0)
+        self.assertAlmostEqual(self.limiter.connection_delay(connection, now=0), .5)
+        self.assertEqual(self.limiter.connection_delay(Mock(), now=0), 0)
+
+    def test_idle_senders_pruned(self):
+        self.limiter.MAX_SENDERS = 2
+        for i in range(2):
+            self.limiter.allow(self.command(str(uuid.uuid1())), now=0)
+        self.limiter.allow(self.command(str(uuid.uuid1())), now=10)
+        self.assertEqual(len(self.limiter._senders), 1)
+
+
+class TestSocketRoomRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.house = House.get_instance()
+        self.house.rate_limiter = RateLimiter(command_limits={"JOIN": (1, 1)})
+        self.room = SocketRoom()
+        self.room.open()
+
+    def tearDown(self):
+        self.house.rate_limiter = None
+
+    def test_over_limit_gets_failure(self):
+        msg = "{u}:{r}:JOIN".format(u=str(uuid.uuid1()), r=self.room.room_id)
+        self.assertTrue(self.room.handle_message(Mock(), msg).endswith("SUCCESS"))
+        resp = SocketMessage.from_text(self.room.handle_message(Mock(), msg))
+        self.assertEqual(resp.message, SocketMessage.FAILURE)
+        self.assertEqual(resp.info, "Rate limit exceeded")
+
+    def test_pipelined_commands_limited_per_line(self):
+        msg = "{u}:{r}:JOIN".format(u=str(uuid.uuid1()), r=self.room.room_id)
+        resp = self.room.handle_message(Mock(), "\n".join([msg, msg])).split("\n")
+        self.assertTrue(resp[0].endswith("SUCCESS"))
+        self.assertTrue(resp[1].endswith("FAILURE:Rate limit exceeded"))
+        self.assertEqual(self.room.user_count(), 1)
@@ -0,0 +1,150 @@
+import unittest
+import time
+from unittest.mock import Mock
+from givr.room import House, Room, SocketRoom, WebSocketRoom
+from givr.operations import run_room_operation
+from givr.reaper import TimerWheel, RoomReaper
+from givr.user import User
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_expire(self):
+        wheel = TimerWheel(tick=1, slots=8, now=0)
+        wheel.schedule("a", 2)
+        wheel.schedule("b", 5)
+        self.assertEqual(wheel.expire(1), [])
+        self.assertEqual(wheel.expire(2), ["a"])
+        self.assertEqual(wheel.expire(4), [])
+        self.assertEqual(wheel.expire(5), ["b"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_deadline_past_one_turn(self):
+        wheel = TimerWheel(tick=1, slots=8, now=0)
+        wheel.schedule("a", 11)
+        self.assertEqual(wheel.expire(8), [])
+        self.assertEqual(wheel.expire(10), [])
+        self.assertEqual(wheel.expire(11), ["a"])
+
+    def test_deadline_in_past(self):
+        wheel = TimerWheel(tick=1, slots=8, now=5)
+        wheel.schedule("a", 1)
+        self.assertEqual(wheel.expire(6), ["a"])
+
+    def test_long_stall(self):
+        wheel = TimerWheel(tick=1, slots=8, now=0)
+        for i in range(1, 30):
+            wheel.schedule(i, i)
+        self.assertCountEqual(wheel.expire(100), range(1, 30))
+
+
+class TestRoomReaper(unittest.TestCase):
+
+    def setUp(self):
+        self.house = House.get_instance()
+        self.reaper = RoomReaper(self.house, ttl=10, closed_ttl=2)
+        self.house.reaper = self.reaper
+
+    def tearDown(self):
+        self.house.reaper = None
+        for room in self.house.rooms:
+            self.house.remove_room(room)
+
+    @staticmethod
+    def wait_for(condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(.01)
+        return condition()
+
+    def add_room(self, open=True):
+        room = Room()
+        if open:
+            room.open()
+        self.house.add_room(room)
+        return room
+
+    def test_idle_room_evicted(self):
+        room = self.add_room()
+        now = time.monotonic()
+        self.assertEqual(self.reaper.reap(now + 5), 0)
+        self.assertEqual(self.reaper.reap(now + 12), 1)
+        self.assertNotIn(room, self.house.rooms)
+
+    def test_closed_room_evicted_sooner(self):
+        room = self.add_room(open=False)
+        self.assertEqual(self.reaper.reap(time.monotonic() + 3), 1)
+        self.assertNotIn(room, self.house.rooms)
+
+    def test_activity_postpones_eviction(self):
+        room = self.add_room()
+        room.last_active += 5
+        room.add_user(User.from_user_id("u1"))
+        room.last_active += 5
+        self.assertEqual(self.reaper.reap(room.last_active - 1), 0)
+        self.assertIn(room, self.house.rooms)
+        self.assertEqual(self.reaper.reap(room.last_active + 11), 1)
+
+    def test_connected_room_kept(self):
+        room = SocketRoom(address=("127.0.0.1", self.house.get_available_port()))
+        room.open()
+        self.house.add_room(room)
+        room.connections.append(Mock(is_closed=Mock(return_value=False)))
+        self.assertEqual(self.reaper.reap(time.monotonic() + 11), 0)
+        room.connections.clear()
+        self.assertEqual(self.reaper.reap(time.monotonic() + 30), 1)
+
+    def test_eviction_releases_port(self):
+        port = self.house.get_available_port()
+        room = SocketRoom(address=("127.0.0.1", port))
+        self.house.add_room(room)
+        self.assertNotEqual(self.house.get_available_port(), port)
+        self.reaper.reap(time.monotonic() + 3)
+        self.assertEqual(self.house.get_available_port(), port)
+
+    def test_evicted_listening_room_port_reused_after_close(self):
+        room = self.house.new_room()
+        room.open()
+        self.house.add_room(room)
+        thread = room.dlisten()
+        self.assertTrue(self.wait_for(lambda: room.listening))
+        port = room.address[1]
+        self.reaper.evict(room)
+        # handed out again only once the old listener has let go of it
+        if thread.is_alive():
+            self.assertNotEqual(self.house.get_available_port(), port)
+        thread.join(5)
+        self.assertEqual(self.house.get_available_port(), port)
+        new_room = self.house.new_room()
+        new_thread = new_room.dlisten()
+        self.assertTrue(self.wait_for(lambda: new_room.listening))
+        new_room.stop_listening()
+        new_thread.join(5)
+        self.house.release_port(new_room.address[1])
+
+    def test_removed_room_skipped(self):
+        room = self.add_room()
+        self.house.remove_room(room)
+        self.assertEqual(self.reaper.reap(time.monotonic() + 11), 0)
+        self.assertEqual(self.reaper.evicted, 0)
+
+    def test_closed_room_with_connections_evicted(self):
+        room = WebSocketRoom(address=("127.0.0.1", 9000))
+        self.house.room_server = Mock(address=room.address, room_connections={room.room_id: {Mock()}})
+        self.addCleanup(setattr, self.house, "room_server", None)
+        room.open()
+        self.house.add_room(room)
+        self.assertTrue(self.house.is_multiplexed(room))
+        self.assertTrue(self.reaper.is_busy(room))
+        run_room_operation("close", {"room_id": room.room_id})
+        self.assertEqual(self.reaper.reap(time.monotonic() + 3), 1)
+        self.house.room_server.drop_room.assert_called_once_with(room.room_id)
+
+    def test_close_reschedules_for_closed_ttl(self):
+        room = self.add_room()
+        room.close()
+        self.reaper.track(room)
+        # the schedule from when the room was open is superseded, not evicted twice
+        self.assertEqual(self.reaper.reap(time.monotonic() + 3), 1)
+        self.assertEqual(self.reaper.reap(time.monotonic() + 11), 0)
+        self.assertEqual(self.reaper.evicted, 1)
@@ -1,9 +1,19 @@
 import unittest
-from givr.room import Room, SocketRoom, WebSocketRoom
+from givr.room import House, Room, SocketRoom, WebSocketRoom
 from givr.user import User
-from givr.exceptions import RoomException
+from givr.exceptions import RoomException, GiveawayException
 from givr.socketmessage import SocketMessage
 from unittest.mock import Mock
+from stevesockets.server import WebSocketConnection
+from givr.frames import encode_frame, PerMessageDeflate
+from givr.metrics import metrics
+from tests.unit_tests import test_roomserver
+import random
+import socket
+import struct
+import threading
+import time
+import zlib
 
 class TestRoom(unittest.TestCase):
 
@@ -44,6 +54,45 @@ class TestRoom(unittest.TestCase):
         self.assertNotIn(u1, r.users)
         self.assertIn(u2, r.users)
 
+    def test_room_add_user_twice(self):
+        r = Room()
+        r.open()
+        u = User()
+        r.add_user(u)
+        r.add_user(User.from_user_id(u.user_id))
+        self.assertEqual(r.user_count(), 1)
+        self.assertTrue(r.has_user(u))
+
+    def test_users_keep_join_order(self):
+        r = Room()
+        r.open()
+        joined = [User() for i in range(5)]
+        for u in joined:
+            r.add_user(u)
+        r.remove_user(joined[2])
+        self.assertEqual(r.users, joined[:2] + joined[3:])
+
+    def test_room_add_users(self):
+        r = Room()
+        r.open()
+        u1, u2 = User(), User()
+        r.add_user(u1)
+        self.assertEqual(r.add_users([u1, u2, u2]), [False, True, False])
+        self.assertEqual(r.users, [u1, u2])
+
+    def test_room_add_users_closed_room(self):
+        r = Room()
+        with self.assertRaises(RoomException):
+            r.add_users([User()])
+
+    def test_room_remove_users(self):
+        r = Room()
+        r.open()
+        u1, u2, u3 = User(), User(), User()
+        r.add_users([u1, u2])
+        self.assertEqual(r.remove_users([u1, u3]), [True, False])
+        self.assertEqual(r.users, [u2])
+
     def test_close_room(self):
         r = Room()
         r.open()
@@ -58,6 +107,28 @@ class TestRoom(unittest.TestCase):
         self.assertEqual(len(r.users), 0)
         self.assertEqual(r.owner, o)
 
+    def test_room_version_changes(self):
+        r = Room()
+        versions = [r.version]
+        r.open()
+        versions.append(r.version)
+        u = User()
+        r.add_user(u)
+        versions.append(r.version)
+        r.add_user(u)  # already in the room, nothing changes
+        versions.append(r.version)
+        self.assertEqual(len(set(versions)), 3)
+        self.assertEqual(versions[2], versions[3])
+
+    def test_wait_for_change(self):
+        r = Room()
+        version = r.version
+        self.assertEqual(r.wait_for_change(version, timeout=.01), version)
+        timer = threading.Timer(.05, r.open)
+        timer.start()
+        self.assertNotEqual(r.wait_for_change(version, timeout=5), version)
+        timer.join()
+
     def test_add_users_to_unopened_room(self):
         r = Room()
         u = User()
@@ -65,6 +136,156 @@ class TestRoom(unittest.TestCase):
         with self.assertRaises(RoomException):
             r.add_user(u)
 
+    def test_concurrent_adds(self):
+        r = Room()
+        r.open()
+        users = [User() for i in range(2000)]
+
+        def add(users):
+            for u in users:
+                r.add_user(u)
+        threads = [threading.Thread(target=add, args=(users[i::4],)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(r.user_count(), len(users))
+        self.assertEqual(r.version, len(users) + 1)
+
+    def test_close_racing_joins(self):
+        r = Room()
+        r.open()
+        closed = threading.Event()
+
+        def join():
+            while not closed.is_set():
+                try:
+                    r.add_user(User())
+                except RoomException:
+                    pass
+        t = threading.Thread(target=join)
+        t.start()
+        r.close()
+        closed.set()
+        t.join()
+        self.assertEqual(r.user_count(), 0)
+
+    def test_draw_after_removals(self):
+        r = Room()
+        r.open()
+        users = [User() for i in range(50)]
+        r.add_users(users)
+        r.remove_users(users[::3])
+        r.remove_user(users[-1])
+        remaining = [u for i, u in enumerate(users[:-1]) if i % 3]
+        self.assertEqual(r.users, remaining)
+        winners = r.draw(len(remaining))
+        self.assertCountEqual(winners, remaining)
+        with self.assertRaises(GiveawayException):
+            r.draw(len(remaining) + 1)
+
+    def test_draw_seeded(self):
+        r = Room()
+        r.open()
+        r.add_users([User() for i in range(100)])
+        self.assertEqual(r.draw(5, rng=random.Random(7)), r.draw(5, rng=random.Random(7)))
+
+    def test_snapshot(self):
+        r = Room()
+        r.open()
+        u = User()
+        r.add_owner(u)
+        snapshot = r.snapshot()
+        self.assertEqual(snapshot, (r.version, True, 1, u.user_id))
+        self.assertIs(r.snapshot(), snapshot)
+        r.add_user(User())
+        self.assertEqual(r.snapshot().user_count, 2)
+        self.assertEqual(snapshot.user_count, 1)
+
+
+class TestHouse(unittest.TestCase):
+
+    def setUp(self):
+        self.house = House.get_instance()
+
+    def tearDown(self):
+        for room in self.house.rooms:
+            self.house.remove_room(room)
+
+    def make_room(self, port):
+        # like a room that isn't listening, its port is free as soon as it's removed
+        return Mock(room_id=str(uuid.uuid1()), address=("127.0.0.1", port), when_stopped=lambda fn: fn())
+
+    def test_get_room(self):
+        r = self.make_room(9000)
+        self.house.add_room(r)
+        self.assertIs(self.house.get_room(r.room_id), r)
+
+    def test_get_missing_room(self):
+        with self.assertRaises(RoomException):
+            self.house.get_room("MISSING ROOM")
+
+    def test_add_room_duplicate_id(self):
+        r = self.make_room(9000)
+        self.house.add_room(r)
+        with self.assertRaises(RoomException):
+            self.house.add_room(Mock(room_id=r.room_id, address=("127.0.0.1", 9001)))
+        self.assertIs(self.house.get_room(r.room_id), r)
+
+    def test_remove_room(self):
+        r = self.make_room(9000)
+        self.house.add_room(r)
+        self.assertTrue(self.house.has_room(r))
+        self.house.remove_room(r)
+        self.assertFalse(self.house.has_room(r))
+        self.assertNotIn(r, self.house.rooms)
+        with self.assertRaises(RoomException):
+            self.house.get_room(r.room_id)
+
+    def test_available_port_skips_used_ports(self):
+        first = self.house.get_available_port()
+        self.house.add_room(self.make_room(first))
+        second = self.house.get_available_port()
+        self.assertNotEqual(first, second)
+        self.house.add_room(self.make_room(second))
+        self.assertNotIn(self.house.get_available_port(), (first, second))
+
+    def test_concurrent_reserve_port(self):
+        ports = []
+
+        def reserve():
+            for i in range(50):
+                ports.append(self.house.reserve_port())
+        threads = [threading.Thread(target=reserve) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(ports)), len(ports))
+        for port in ports:
+            self.house.release_port(port)
+
+    def test_port_range_exhausted(self):
+        first = 29000  # past the ports the other tests' rooms use
+        self.house.set_port_range(first, first + 1)
+        self.addCleanup(self.house.set_port_range, House.FIRST_PORT, House.LAST_PORT)
+        ports = [self.house.reserve_port(), self.house.reserve_port()]
+        self.assertEqual(ports, [first, first + 1])
+        with self.assertRaises(RoomException):
+            self.house.reserve_port()
+        self.house.release_port(ports[0])
+        self.assertEqual(self.house.reserve_port(), first)
+        for port in ports:
+            self.house.release_port(port)
+
+    def test_available_port_reuses_freed_port(self):
+        r1 = self.make_room(self.house.get_available_port())
+        self.house.add_room(r1)
+        r2 = self.make_room(self.house.get_available_port())
+        self.house.add_room(r2)
+        self.house.remove_room(r1)
+        self.assertEqual(self.house.get_available_port(), r1.address[1])
+
 
 import uuid
 class TestSocketRoom(unittest.TestCase):
@@ -80,6 +301,50 @@ class TestSocketRoom(unittest.TestCase):
         self.assertTrue(resp.endswith("SUCCESS"))
         self.assertEqual(test_id, self.room.users[0].user_id)
 
+    @staticmethod
+    def free_port():
+        # a port no other test's room is still closing
+        with socket.socket() as sck:
+            sck.bind(("127.0.0.1", 0))
+            return sck.getsockname()[1]
+
+    @staticmethod
+    def connect(port):
+        # the room binds its socket in the listen thread, so the first attempts can be refused
+        for _ in range(50):
+            try:
+                return socket.create_connection(("127.0.0.1", port), timeout=5)
+            except ConnectionRefusedError:
+                time.sleep(.05)
+        return socket.create_connection(("127.0.0.1", port), timeout=5)
+
+    def test_listening_room_answers_frames(self):
+        port = self.free_port()
+        room = SocketRoom(address=("127.0.0.1", port))
+        room.open()
+        thread = room.dlisten()
+        try:
+            client = self.connect(port)
+            user_id = str(uuid.uuid1())
+            client.sendall("{uid}:{rid}:JOIN".format(uid=user_id, rid=room.room_id).encode())
+            reply = client.recv(4096).decode()
+            self.assertTrue(reply.endswith("SUCCESS\n"))
+            client.sendall(b"not a message")
+            self.assertIn(SocketMessage.FAILURE, client.recv(4096).decode())
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(user_id, room.users[0].user_id)
+            client.close()
+        finally:
+            room.stop_listening()
+            thread.join(5)
+
+    def test_handle_binary_rejects_nil_sender(self):
+        self.room.open()
+        join = SocketMessage(recipient=self.room.room_id, message=SocketMessage.JOIN).to_bytes()
+        resp = SocketMessage.from_bytes(self.room.handle_binary(join))
+        self.assertEqual(resp.message, SocketMessage.FAILURE)
+        self.assertEqual(self.room.users, [])
+
     def test_handle_message_leave(self):
         self.room.open()
         u = User()
@@ -98,6 +363,61 @@ class TestSocketRoom(unittest.TestCase):
         self.assertEqual(resp.info, owner.user_id)
         self.assertTrue(resp.message, "SUCCESS")
 
+    def test_handle_message_giveaway_multiple_winners(self):
+        self.room.open()
+        owner = User()
+        self.room.add_owner(owner)
+        users = [User() for i in range(4)]
+        for u in users:
+            self.room.add_user(u)
+        msg = "{uid1}:{uid2}:GIVEAWAY:3".format(uid1=owner.user_id, uid2=self.room.room_id)
+        resp = SocketMessage.from_text(self.room.handle_message(Mock("mock connection"), msg))
+        self.assertEqual(resp.message, "SUCCESS")
+        winners = resp.info.split(",")
+        self.assertEqual(len(winners), 3)
+        self.assertEqual(len(set(winners)), 3)
+        for winner in winners:
+            self.assertIn(winner, [u.user_id for u in self.room.users])
+
+    def test_handle_binary_giveaway_long_winner_list(self):
+        self.room.open()
+        owner = User()
+        self.room.add_owner(owner)
+        self.room.add_users([User() for i in range(2000)])
+        msg = SocketMessage(sender=owner.user_id, recipient=self.room.room_id, message=SocketMessage.GIVEAWAY, info="1900")
+        resp = SocketMessage.from_bytes(self.room.handle_binary(msg.to_bytes()))
+        self.assertEqual(resp.message, SocketMessage.SUCCESS)
+        self.assertEqual(len(resp.info.split(",")), 1900)
+
+    def test_handle_message_giveaway_seeded(self):
+        self.room.open()
+        owner = User()
+        self.room.add_owner(owner)
+        self.room.add_users([User() for i in range(20)])
+        msg = "{uid1}:{uid2}:GIVEAWAY:3:1234".format(uid1=owner.user_id, uid2=self.room.room_id)
+        first = SocketMessage.from_text(self.room.handle_message(Mock("mock connection"), msg))
+        second = SocketMessage.from_text(self.room.handle_message(Mock("mock connection"), msg))
+        self.assertEqual(first.message, "SUCCESS")
+        self.assertEqual(first.info, second.info)
+        self.assertEqual(len(first.info.split(",")), 3)
+
+    def test_handle_message_giveaway_bad_seed(self):
+        self.room.open()
+        owner = User()
+        self.room.add_owner(owner)
+        msg = "{uid1}:{uid2}:GIVEAWAY:1:abc".format(uid1=owner.user_id, uid2=self.room.room_id)
+        resp = SocketMessage.from_text(self.room.handle_message(Mock("mock connection"), msg))
+        self.assertEqual(resp.message, "FAILURE")
+        self.assertIn("seed", resp.info)
+
+    def test_handle_message_giveaway_too_many_winners(self):
+        self.room.open()
+        owner = User()
+        self.room.add_owner(owner)
+        msg = "{uid1}:{uid2}:GIVEAWAY:2".format(uid1=owner.user_id, uid2=self.room.room_id)
+        resp = SocketMessage.from_text(self.room.handle_message(Mock("mock connection"), msg))
+        self.assertEqual(resp.message, "FAILURE")
+
     def test_handle_message_giveaway_non_owner(self):
         self.room.open()
         owner = User()
@@ -109,6 +429,17 @@ class TestSocketRoom(unittest.TestCase):
         self.assertEqual(resp.message, "FAILURE")
         self.assertIn("initiated by the room owner", resp.info)
 
+    def test_handle_message_pipelined(self):
+        self.room.open()
+        users = [str(uuid.uuid1()) for i in range(3)]
+        lines = ["{u}:{r}:JOIN".format(u=u, r=self.room.room_id) for u in users]
+        lines.insert(1, "NOT A MESSAGE")
+        lines.append("{u}:{r}:LEAVE".format(u=users[0], r=self.room.room_id))
+        resp = self.room.handle_message(Mock("mock connection"), "\n".join(lines) + "\n")
+        responses = SocketMessage.from_texts(resp.split("\n"))
+        self.assertEqual([r.message for r in responses], ["SUCCESS", "FAILURE", "SUCCESS", "SUCCESS", "SUCCESS"])
+        self.assertEqual([u.user_id for u in self.room.users], users[1:])
+
     def test_handle_bad_recipient(self):
         u = User()
         self.room.open()
@@ -130,6 +461,13 @@ class TestSocketRoom(unittest.TestCase):
                 resp = fn(msg)
                 self.assertEqual(resp.message, SocketMessage.SUCCESS)
 
+    def test_delegate_command_records_metrics(self):
+        before = metrics.command_counts().get((SocketMessage.GIVEAWAY, "handled_error"), 0)
+        msg = SocketMessage(sender=str(uuid.uuid1()), recipient=self.room.room_id, message=SocketMessage.GIVEAWAY)
+        self.room.open()
+        self.room.delegate_command(msg)
+        self.assertEqual(metrics.command_counts()[(SocketMessage.GIVEAWAY, "handled_error")], before + 1)
+
     def test__handle_giveaway_non_owner(self):
         u = User()
         msg = SocketMessage(sender=u.user_id, recipient=self.room.room_id, message=SocketMessage.GIVEAWAY)
@@ -153,5 +491,134 @@ class TestWebSocketRoom(unittest.TestCase):
         r = self.room.handle_message(Mock(name="CONNECTION"), txt)
         self.assertEqual(r, "TEST RESPONSE")
 
+    def connect_client(self):
+        server_side, client_side = socket.socketpair()
+        self.addCleanup(server_side.close)
+        self.addCleanup(client_side.close)
+        self.room.connections.append(WebSocketConnection(server_side, "127.0.0.1", 0))
+        return client_side
+
+    def test_broadcast(self):
+        clients = [self.connect_client() for i in range(3)]
+        msg = SocketMessage(sender=self.room.room_id, recipient=self.room.room_id, message=SocketMessage.ENTER)
+        self.room.broadcast(msg)
+        expected = encode_frame(msg.to_text())
+        for client in clients:
+            self.assertEqual(client.recv(4096), expected)
+
+    def test_broadcast_slow_client_keeps_queue(self):
+        slow = self.connect_client()
+        fast = self.connect_client()
+        slow_conn, fast_conn = self.room.connections
+        slow_conn.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        msg = SocketMessage(sender=self.room.room_id, recipient=self.room.room_id, message=SocketMessage.WINNER,
+                            info="x" * 4000)
+        for i in range(100):
+            self.room.broadcast(msg)
+            fast.recv(65536)
+        self.assertTrue(slow_conn.messages)
+        self.assertFalse(fast_conn.messages)
+        self.assertFalse(slow_conn.is_to_be_closed())
+
+    def test_handshake_negotiates_deflate(self):
+        server_side, client_side = socket.socketpair()
+        self.addCleanup(server_side.close)
+        self.addCleanup(client_side.close)
+        conn = WebSocketConnection(server_side, "127.0.0.1", 0)
+        self.room.handle_websocket_handshake(conn, b"GET / HTTP/1.1\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                                                   b"Sec-WebSocket-Extensions: permessage-deflate\r\n\r\n")
+        self.assertIsNotNone(conn.deflate)
+        self.assertIn(b"Sec-WebSocket-Extensions: permessage-deflate\r\n", client_side.recv(4096))
+
+    def test_broadcast_compressed_per_connection(self):
+        plain = self.connect_client()
+        compressed = self.connect_client()
+        self.room.connections[1].deflate = PerMessageDeflate()
+        msg = SocketMessage(sender=self.room.room_id, recipient=self.room.room_id, message=SocketMessage.ENTER)
+        self.room.broadcast(msg)
+        self.assertEqual(plain.recv(4096), encode_frame(msg.to_text()))
+        frame = compressed.recv(4096)
+        self.assertEqual(frame[0], 0xc1)
+        self.assertEqual(zlib.decompressobj(-15).decompress(frame[2:] + PerMessageDeflate.TAIL), msg.to_text().encode())
+
+    def test_broadcasts_while_handling_written_together(self):
+        client = self.connect_client()
+        msg = SocketMessage(sender=self.room.room_id, recipient=self.room.room_id, message=SocketMessage.ENTER)
+        self.room._handling = True
+        self.room.broadcast(msg)
+        self.room.broadcast(msg)
+        self.assertEqual(len(self.room.connections[0].messages), 2)
+        self.room._handling = False
+        self.room.flush_connections()
+        self.assertEqual(client.recv(4096), encode_frame(msg.to_text()) * 2)
+
+    def test_giveaway_broadcasts_winner(self):
+        client = self.connect_client()
+        self.room.open()
+        owner = User()
+        self.room.add_owner(owner)
+        msg = "{uid1}:{uid2}:GIVEAWAY".format(uid1=owner.user_id, uid2=self.room.room_id)
+        self.room.handle_message(Mock("mock connection"), msg)
+        frame = client.recv(4096)
+        announcement = SocketMessage.from_text(frame[2:].decode())
+        self.assertEqual(announcement.message, SocketMessage.WINNER)
+        self.assertEqual(announcement.info, owner.user_id)
+
+class TestListeningWebSocketRoom(unittest.TestCase):
+
+    connect = test_roomserver.TestRoomServer.connect
+    send_text = test_roomserver.TestRoomServer.send_text
+    recv_exactly = test_roomserver.TestRoomServer.recv_exactly
+    recv_raw_frame = test_roomserver.TestRoomServer.recv_raw_frame
+    recv_frame = test_roomserver.TestRoomServer.recv_frame
+    recv_text = test_roomserver.TestRoomServer.recv_text
+
+    def setUp(self):
+        port = TestSocketRoom.free_port()
+        self.server = self.room = WebSocketRoom(address=("127.0.0.1", port))
+        self.room.open()
+        self.thread = self.room.dlisten()
+
+    def tearDown(self):
+        self.room.stop_listening()
+        self.thread.join(5)
+
+    def connect_when_listening(self, extensions=None):
+        # the room binds its socket in the listen thread, so the first attempts can be refused
+        for _ in range(50):
+            try:
+                return self.connect(extensions=extensions)
+            except ConnectionRefusedError:
+                time.sleep(.05)
+        return self.connect(extensions=extensions)
+
+    def test_listening_room_answers_frames(self):
+        sck, response = self.connect_when_listening()
+        self.assertTrue(response.startswith("HTTP/1.1 101"))
+        user_id = str(uuid.uuid1())
+        self.send_text(sck, "{u}:{r}:JOIN".format(u=user_id, r=self.room.room_id))
+        self.assertEqual(SocketMessage.from_text(self.recv_text(sck)).message, SocketMessage.SUCCESS)
+        self.assertEqual(self.room.users[0].user_id, user_id)
+        self.send_text(sck, b"\xff\xfe")
+        self.assertEqual(SocketMessage.from_text(self.recv_text(sck)).message, SocketMessage.FAILURE)
+        self.assertTrue(self.thread.is_alive())
+        sck.close()
 
+    def test_deflate_round_trip(self):
+        sck, response = self.connect_when_listening(extensions="permessage-deflate")
+        self.assertIn("Sec-WebSocket-Extensions: permessage-deflate", response)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        join = "{u}:{r}:JOIN".format(u=str(uuid.uuid1()), r=self.room.room_id).encode()
+        self.send_text(sck, (compressor.compress(join) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4], compressed=True)
+        first, payload = self.recv_raw_frame(sck)
+        self.assertTrue(first & 0x40)
+        reply = zlib.decompressobj(-15).decompress(payload + b"\x00\x00\xff\xff").decode()
+        self.assertEqual(SocketMessage.from_text(reply).message, SocketMessage.SUCCESS)
+        self.assertEqual(self.room.user_count(), 1)
+        sck.close()
 
+    def test_compressed_frame_without_deflate_closes(self):
+        sck, response = self.connect_when_listening()
+        self.send_text(sck, b"\x00", compressed=True)
+        self.assertEqual(self.recv_frame(sck), (0x8, struct.pack("!H", 1002)))
+        sck.close()
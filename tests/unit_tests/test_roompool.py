@@ -0,0 +1,95 @@
+import unittest
+import time
+import socket
+import threading
+from givr.room import House
+from givr.roompool import RoomPool
+from givr.operations import run_room_operation
+
+
+class TestRoomPool(unittest.TestCase):
+
+    def setUp(self):
+        self.house = House.get_instance()
+        self.pool = RoomPool(self.house, size=2).start()
+        self.house.room_pool = self.pool
+        self.wait_for_pool()
+
+    def tearDown(self):
+        self.house.room_pool = None
+        self.pool.stop()
+        for room in self.house.rooms:
+            if room.listening:
+                room.stop_listening()
+            self.house.remove_room(room)
+
+    def wait_for_pool(self):
+        deadline = time.monotonic() + 5
+        while len(self.pool) < self.pool.size and time.monotonic() < deadline:
+            time.sleep(.01)
+        self.assertEqual(len(self.pool), self.pool.size)
+
+    def release(self, room):
+        """ Stops a room taken from the pool and frees its port once its listener has closed """
+        stopped = threading.Event()
+        room.stop_listening()
+        room.when_stopped(stopped.set)
+        self.assertTrue(stopped.wait(5))
+        self.house.release_port(room.address[1])
+
+    def test_pooled_rooms_listening(self):
+        room = self.pool.take()
+        self.assertTrue(room.listening)
+        self.assertFalse(room.is_open())
+        self.release(room)
+
+    def test_pooled_rooms_have_distinct_ports(self):
+        rooms = [self.pool.take(), self.pool.take()]
+        self.assertNotEqual(rooms[0].address[1], rooms[1].address[1])
+        for room in rooms:
+            self.release(room)
+
+    def test_create_takes_from_pool_and_refills(self):
+        warm = list(self.pool._rooms)
+        room_id = run_room_operation("create", {})["room_id"]
+        self.assertIn(self.house.get_room(room_id), warm)
+        resp = run_room_operation("open", {"room_id": room_id})
+        self.assertTrue(resp["success"])
+        self.assertTrue(self.house.get_room(room_id).is_open())
+        self.wait_for_pool()
+
+    def test_taken_room_touched(self):
+        room = self.pool._rooms[0]
+        built = room.last_active
+        time.sleep(.01)
+        self.assertIs(self.pool.take(), room)
+        self.assertGreater(room.last_active, built)
+        self.release(room)
+
+    def test_empty_pool(self):
+        self.pool.size = 0
+        rooms = [self.pool.take(), self.pool.take()]
+        self.assertIsNone(self.pool.take())
+        for room in rooms:
+            self.release(room)
+
+    def test_port_that_fails_to_bind_quarantined(self):
+        port = self.house.get_available_port()
+        blocker = socket.socket()
+        blocker.bind(("127.0.0.1", port))
+        self.addCleanup(blocker.close)
+        pool = RoomPool(self.house, size=1)
+        started = time.monotonic()
+        self.assertIsNone(pool._warm_room())
+        self.assertLess(time.monotonic() - started, pool.LISTEN_TIMEOUT)
+        self.assertTrue(self.wait_for(lambda: port in self.house._quarantined))
+        room = pool._warm_room()
+        self.assertNotEqual(room.address[1], port)
+        self.assertTrue(room.listening)
+        self.release(room)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(.01)
+        return condition()
@@ -0,0 +1,275 @@
+import unittest
+import socket
+import struct
+import os
+import uuid
+from givr.room import House, WebSocketRoom
+from givr.roomserver import RoomServer
+from givr.frames import encode_frame, unmask
+from givr.socketmessage import SocketMessage
+from givr.ratelimit import RateLimiter
+import time
+import zlib
+import asyncio
+from unittest.mock import Mock
+from givr.roomserver import RoomConnection
+
+
+class TestRoomServer(unittest.TestCase):
+
+    def setUp(self):
+        self.house = House.get_instance()
+        self.server = RoomServer(address=("127.0.0.1", 0), house=self.house)
+        self.thread = self.server.dlisten()
+        self.room = WebSocketRoom(address=self.server.address)
+        self.room.address = self.server.address  # in case another test mocked out the WebSocketServer
+        self.room.open()
+        self.house.add_room(self.room)
+
+    def tearDown(self):
+        self.server.stop_listening()
+        self.thread.join(timeout=5)
+        for room in self.house.rooms:
+            self.house.remove_room(room)
+
+    def connect(self, path="/", protocol=None, extensions=None):
+        sck = socket.create_connection(self.server.address, timeout=5)
+        extra = "Sec-WebSocket-Protocol: {p}\r\n".format(p=protocol) if protocol else ""
+        if extensions:
+            extra += "Sec-WebSocket-Extensions: {e}\r\n".format(e=extensions)
+        sck.sendall("GET {path} HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                    "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n{extra}\r\n"
+                    .format(path=path, extra=extra).encode())
+        response = b""
+        while b"\r\n\r\n" not in response:
+            response += sck.recv(4096)
+        return sck, response.decode()
+
+    def send_text(self, sck, text, opcode=0x1, compressed=False, fin=True):
+        payload = text.encode() if isinstance(text, str) else text
+        mask = os.urandom(4)
+        first = (0x80 if fin else 0) | (0x40 if compressed else 0) | opcode
+        if len(payload) <= 125:
+            header = struct.pack("!BB", first, 0x80 | len(payload))
+        else:
+            header = struct.pack("!BBH", first, 0x80 | 126, len(payload))
+        sck.sendall(header + mask + unmask(payload, mask))
+
+    def recv_exactly(self, sck, n):
+        data = b""
+        while len(data) < n:
+            data += sck.recv(n - len(data))
+        return data
+
+    def recv_raw_frame(self, sck):
+        """ Returns a frame's first byte, with its flags, and its payload """
+        first, length = self.recv_exactly(sck, 2)
+        if length == 126:
+            length, = struct.unpack("!H", self.recv_exactly(sck, 2))
+        return first, self.recv_exactly(sck, length)
+
+    def recv_frame(self, sck):
+        first, payload = self.recv_raw_frame(sck)
+        return first & 0x0f, payload
+
+    def recv_text(self, sck):
+        return self.recv_frame(sck)[1].decode()
+
+    def test_handshake(self):
+        sck, response = self.connect()
+        self.assertTrue(response.startswith("HTTP/1.1 101"))
+        self.assertIn("Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=", response)
+        sck.close()
+
+    def test_handshake_unknown_room(self):
+        sck, response = self.connect("/" + str(uuid.uuid1()))
+        self.assertTrue(response.startswith("HTTP/1.1 404"))
+        sck.close()
+
+    def test_join_routed_by_path(self):
+        sck, response = self.connect("/" + self.room.room_id)
+        user_id = str(uuid.uuid1())
+        self.send_text(sck, "{u}:{r}:JOIN".format(u=user_id, r=self.room.room_id))
+        resp = SocketMessage.from_text(self.recv_text(sck))
+        self.assertEqual(resp.message, SocketMessage.SUCCESS)
+        self.assertEqual(self.room.user_count(), 1)
+        sck.close()
+
+    def test_join_routed_by_first_message(self):
+        other = WebSocketRoom(address=self.server.address)
+        other.address = self.server.address
+        other.open()
+        self.house.add_room(other)
+        sck, response = self.connect()
+        self.send_text(sck, "{u}:{r}:JOIN".format(u=str(uuid.uuid1()), r=other.room_id))
+        resp = SocketMessage.from_text(self.recv_text(sck))
+        self.assertEqual(resp.message, SocketMessage.SUCCESS)
+        self.assertEqual(other.user_count(), 1)
+        self.assertEqual(self.room.user_count(), 0)
+        sck.close()
+
+    def test_pipelined_frame_routed_by_first_command(self):
+        sck, response = self.connect()
+        users = [str(uuid.uuid1()) for i in range(3)]
+        self.send_text(sck, "\n".join("{u}:{r}:JOIN".format(u=u, r=self.room.room_id) for u in users))
+        responses = self.recv_text(sck).split("\n")
+        self.assertEqual(len(responses), 3)
+        self.assertTrue(all(r.endswith("SUCCESS") for r in responses))
+        self.assertEqual(self.room.user_count(), 3)
+        sck.close()
+
+    def test_rate_limited_connection(self):
+        self.house.rate_limiter = RateLimiter(connection_rate=10, connection_burst=1,
+                                              command_limits={"JOIN": (1, 1)})
+        self.addCleanup(setattr, self.house, "rate_limiter", None)
+        sck, response = self.connect("/" + self.room.room_id)
+        user_id = str(uuid.uuid1())
+        start = time.monotonic()
+        for i in range(3):
+            self.send_text(sck, "{u}:{r}:JOIN".format(u=user_id, r=self.room.room_id))
+        responses = [SocketMessage.from_text(self.recv_text(sck)) for i in range(3)]
+        # the connection gets one frame up front and then one every 1/10th of a second
+        self.assertGreaterEqual(time.monotonic() - start, .15)
+        self.assertEqual([r.message for r in responses], ["SUCCESS", "FAILURE", "FAILURE"])
+        self.assertEqual(responses[1].info, "Rate limit exceeded")
+        self.assertEqual(self.room.user_count(), 1)
+        sck.close()
+
+    def test_rooms_share_port(self):
+        self.assertTrue(self.house.is_multiplexed(self.room))
+        self.assertEqual(self.house.get_room(self.room.room_id), self.room)
+
+    def test_broadcast_reaches_routed_connections(self):
+        clients = [self.connect("/" + self.room.room_id)[0] for i in range(2)]
+        # make sure both connections are routed before broadcasting
+        for client in clients:
+            self.send_text(client, "{u}:{r}:JOIN".format(u=str(uuid.uuid1()), r=self.room.room_id))
+            self.recv_text(client)
+        msg = SocketMessage(sender=self.room.room_id, recipient=self.room.room_id, message=SocketMessage.ENTER)
+        self.room.broadcast(msg)
+        for client in clients:
+            self.assertEqual(self.recv_text(client), msg.to_text())
+            client.close()
+
+    def test_binary_protocol_negotiated(self):
+        sck, response = self.connect("/" + self.room.room_id, protocol="chat, givr.binary")
+        self.assertIn("Sec-WebSocket-Protocol: givr.binary", response)
+        sck.close()
+        sck, response = self.connect("/" + self.room.room_id, protocol="chat")
+        self.assertNotIn("Sec-WebSocket-Protocol", response)
+        sck.close()
+
+    def test_binary_join_routed_by_first_message(self):
+        sck, response = self.connect(protocol="givr.binary")
+        users = [str(uuid.uuid1()) for i in range(3)]
+        frame = b"".join(SocketMessage(sender=u, recipient=self.room.room_id, message=SocketMessage.JOIN).to_bytes()
+                         for u in users)
+        self.send_text(sck, frame, opcode=0x2)
+        opcode, payload = self.recv_frame(sck)
+        self.assertEqual(opcode, 0x2)
+        responses = list(SocketMessage.iter_bytes(payload))
+        self.assertEqual([r.message for r in responses], [SocketMessage.SUCCESS] * 3)
+        self.assertEqual([r.recipient for r in responses], users)
+        self.assertEqual(self.room.user_count(), 3)
+        sck.close()
+
+    def test_broadcast_binary_and_text(self):
+        binary, _ = self.connect("/" + self.room.room_id, protocol="givr.binary")
+        text, _ = self.connect("/" + self.room.room_id)
+        self.send_text(binary, SocketMessage(sender=str(uuid.uuid1()), recipient=self.room.room_id,
+                                             message=SocketMessage.JOIN).to_bytes(), opcode=0x2)
+        self.recv_frame(binary)
+        self.send_text(text, "{u}:{r}:JOIN".format(u=str(uuid.uuid1()), r=self.room.room_id))
+        self.recv_frame(text)
+        msg = SocketMessage(sender=self.room.room_id, recipient=self.room.room_id, message=SocketMessage.ENTER)
+        self.room.broadcast(msg)
+        self.assertEqual(self.recv_frame(binary), (0x2, msg.to_bytes()))
+        self.assertEqual(self.recv_frame(text), (0x1, msg.to_text().encode()))
+        binary.close()
+        text.close()
+
+    def test_deflate_negotiated(self):
+        sck, response = self.connect("/" + self.room.room_id,
+                                     extensions="permessage-deflate; server_no_context_takeover, x-other")
+        self.assertIn("Sec-WebSocket-Extensions: permessage-deflate; server_no_context_takeover", response)
+        sck.close()
+        sck, response = self.connect("/" + self.room.room_id, extensions="x-other")
+        self.assertNotIn("Sec-WebSocket-Extensions", response)
+        sck.close()
+
+    def test_deflate_round_trip(self):
+        sck, _ = self.connect("/" + self.room.room_id, extensions="permessage-deflate; client_max_window_bits")
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        join = "{u}:{r}:JOIN".format(u=str(uuid.uuid1()), r=self.room.room_id).encode()
+        self.send_text(sck, (compressor.compress(join) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4], compressed=True)
+        inflate = zlib.decompressobj(-15)
+        first, payload = self.recv_raw_frame(sck)
+        self.assertTrue(first & 0x40)
+        self.assertEqual(SocketMessage.from_text(inflate.decompress(payload + b"\x00\x00\xff\xff").decode()).message,
+                         SocketMessage.SUCCESS)
+        msg = SocketMessage(sender=self.room.room_id, recipient=self.room.room_id, message=SocketMessage.ENTER)
+        sizes = []
+        for i in range(2):
+            self.room.broadcast(msg)
+            first, payload = self.recv_raw_frame(sck)
+            sizes.append(len(payload))
+            self.assertEqual(inflate.decompress(payload + b"\x00\x00\xff\xff").decode(), msg.to_text())
+        # the connection's compression context remembers the first broadcast
+        self.assertLess(sizes[0], len(msg.to_text()) / 4)
+        self.assertLess(sizes[1], sizes[0])
+        sck.close()
+
+    def test_oversized_frame_closes(self):
+        sck, _ = self.connect("/" + self.room.room_id)
+        # only the header is sent, the declared length alone gets the connection closed
+        sck.sendall(struct.pack("!BBQ", 0x81, 0x80 | 127, 2 ** 63) + os.urandom(4))
+        self.assertEqual(self.recv_frame(sck), (0x8, struct.pack("!H", 1009)))
+        sck.close()
+
+    def test_oversized_fragmented_message_closes(self):
+        self.server.MAX_MESSAGE_SIZE = 200
+        sck, _ = self.connect("/" + self.room.room_id)
+        self.send_text(sck, b"a" * 120, opcode=0x1, fin=False)
+        self.send_text(sck, b"a" * 120, opcode=0x0, fin=False)
+        self.assertEqual(self.recv_frame(sck), (0x8, struct.pack("!H", 1009)))
+        sck.close()
+
+    def test_invalid_utf8_text_closes(self):
+        sck, _ = self.connect("/" + self.room.room_id)
+        self.send_text(sck, b"\xff\xfe")
+        self.assertEqual(self.recv_frame(sck), (0x8, struct.pack("!H", 1007)))
+        sck.close()
+
+    def test_compressed_frame_without_deflate_closes(self):
+        sck, _ = self.connect("/" + self.room.room_id)
+        self.send_text(sck, b"\x00", compressed=True)
+        self.assertEqual(self.recv_frame(sck), (0x8, struct.pack("!H", 1002)))
+        self.assertEqual(sck.recv(16), b"")
+        sck.close()
+
+
+class TestRoomConnection(unittest.TestCase):
+
+    def test_frames_coalesced_per_loop_pass(self):
+        async def run():
+            writer = Mock()
+            writer.get_extra_info.return_value = ("127.0.0.1", 1234)
+            writer.is_closing.return_value = False
+            connection = RoomConnection(Mock(), writer)
+            for i in range(3):
+                connection.send("frame {i}".format(i=i))
+            self.assertFalse(writer.write.called)
+            await asyncio.sleep(0)
+            return writer
+        writer = asyncio.run(run())
+        writer.write.assert_called_once_with(b"".join(encode_frame("frame {i}".format(i=i)) for i in range(3)))
+
+    def test_big_outbox_written_right_away(self):
+        async def run():
+            writer = Mock()
+            writer.get_extra_info.return_value = ("127.0.0.1", 1234)
+            writer.is_closing.return_value = False
+            connection = RoomConnection(Mock(), writer)
+            connection.send("x" * (RoomConnection.FLUSH_SIZE + 1))
+            self.assertTrue(writer.write.called)
+        asyncio.run(run())
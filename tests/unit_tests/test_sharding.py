@@ -0,0 +1,79 @@
+import unittest
+import uuid
+from givr.sharding import HashRing, ShardRouter
+from givr.exceptions import RoomException
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_same_key_same_node(self):
+        ring = HashRing(range(4))
+        key = str(uuid.uuid1())
+        self.assertEqual(ring.get_node(key), ring.get_node(key))
+
+    def test_keys_spread_over_nodes(self):
+        ring = HashRing(range(4))
+        nodes = [ring.get_node(str(uuid.uuid4())) for i in range(2000)]
+        for node in range(4):
+            self.assertGreater(nodes.count(node), 300)
+
+    def test_adding_node_moves_few_keys(self):
+        ring = HashRing(range(4))
+        keys = [str(uuid.uuid4()) for i in range(2000)]
+        before = [ring.get_node(k) for k in keys]
+        ring.add_node(4)
+        after = [ring.get_node(k) for k in keys]
+        moved = sum(1 for b, a in zip(before, after) if b != a)
+        self.assertLess(moved, 700)
+        self.assertTrue(all(a == 4 for b, a in zip(before, after) if b != a))
+
+    def test_remove_node(self):
+        ring = HashRing(range(3))
+        ring.remove_node(1)
+        self.assertNotIn(1, {ring.get_node(str(uuid.uuid4())) for i in range(500)})
+
+
+class TestShardRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.router = ShardRouter(workers=2, first_port=19000).start()
+
+    def tearDown(self):
+        self.router.stop()
+
+    def test_create_and_info_routed_to_owner(self):
+        room_ids = [self.router.forward("create", {})["room_id"] for i in range(6)]
+        for room_id in room_ids:
+            info = self.router.forward("info", {"room_id": room_id})
+            self.assertEqual(info["room_id"], room_id)
+            self.assertFalse(info["is_open"])
+            port = info["port"] - 19000
+            self.assertEqual(port // ShardRouter.PORTS_PER_SHARD, self.router.shard_for(room_id))
+
+    def test_create_ignores_client_room_id(self):
+        room_id = self.router.forward("create", {})["room_id"]
+        self.assertNotEqual(self.router.forward("create", {"room_id": room_id})["room_id"], room_id)
+
+    def test_metrics_labelled_per_shard(self):
+        room_id = self.router.forward("create", {})["room_id"]
+        text = self.router.render_metrics()
+        shard = self.router.shard_for(room_id)
+        self.assertIn('givr_room_users{{shard="{s}",room_id="{r}"}} 0'.format(s=shard, r=room_id), text)
+        self.assertEqual(text.count("# TYPE givr_rooms gauge"), 1)
+        self.assertIn('givr_rooms{shard="0",state="closed"}', text)
+        self.assertIn('givr_rooms{shard="1",state="closed"}', text)
+
+    def test_missing_room_raises(self):
+        with self.assertRaises(RoomException):
+            self.router.forward("info", {"room_id": str(uuid.uuid1())})
+
+    def test_bulk_membership_split_across_shards(self):
+        room_ids = [self.router.forward("create", {})["room_id"] for i in range(6)]
+        for room_id in room_ids:
+            self.router.forward("open", {"room_id": room_id})
+        memberships = [{"room_id": room_id, "user_id": "TEST USER"} for room_id in room_ids]
+        resp = self.router.forward("bulk_membership", {"memberships": memberships})
+        self.assertEqual([r["room_id"] for r in resp["results"]], room_ids)
+        self.assertTrue(all(r["success"] for r in resp["results"]))
+        self.assertEqual(resp["user_counts"], {room_id: 1 for room_id in room_ids})
+
@@ -62,3 +62,72 @@ class TestSocketMessage(unittest.TestCase):
         for key, value, in SocketMessage.all_messages.items():
             self.assertTrue(hasattr(SocketMessage, key))
             self.assertEqual(getattr(SocketMessage, key), value)
+
+    def test_from_text_bytes(self):
+        msg = SocketMessage.from_text("{uid1}:{uid2}:JOIN".format(uid1=self.good_uid1, uid2=self.good_uid2).encode())
+        self.assertEqual(msg.sender, self.good_uid1)
+        self.assertIsNone(msg.info)
+
+    def test_from_text_trailing_newline(self):
+        msg = SocketMessage.from_text("{uid1}:{uid2}:JOIN\r\n".format(uid1=self.good_uid1, uid2=self.good_uid2))
+        self.assertEqual(msg.message, "JOIN")
+
+    def test_invalid_from_text_too_few_parts(self):
+        with self.assertRaises(SocketMessageException):
+            SocketMessage.from_text("{uid1}:{uid2}".format(uid1=self.good_uid1, uid2=self.good_uid2))
+
+    def test_invalid_uuid_layout(self):
+        shifted = self.good_uid1.replace("-", "")
+        shifted = shifted[:9] + "-" + shifted[9:13] + "-" + shifted[13:17] + "-" + shifted[17:21] + "-" + shifted[21:32]
+        self.assertEqual(len(shifted), len(self.good_uid1))
+        self.assertFalse(SocketMessage.is_uuid(shifted))
+        self.assertTrue(SocketMessage.is_uuid(self.good_uid1))
+
+    def test_from_texts(self):
+        texts = ["{uid1}:{uid2}:{msg}".format(uid1=self.good_uid1, uid2=self.good_uid2, msg=m) for m in ("JOIN", "LEAVE")]
+        msgs = SocketMessage.from_texts(texts)
+        self.assertEqual([m.message for m in msgs], ["JOIN", "LEAVE"])
+        self.assertEqual([m.to_text() for m in msgs], texts)
+
+    def test_to_text_with_info(self):
+        msg = SocketMessage(sender=self.good_uid1, recipient=self.good_uid2, message=SocketMessage.SUCCESS, info="x:y")
+        self.assertEqual(msg.to_text(), "{uid1}:{uid2}:SUCCESS:x:y".format(uid1=self.good_uid1, uid2=self.good_uid2))
+        self.assertEqual(SocketMessage.from_text(msg.to_text()).info, "x:y")
+
+    def test_to_bytes_round_trip(self):
+        msg = SocketMessage(sender=self.good_uid1, recipient=self.good_uid2, message=SocketMessage.GIVEAWAY, info="3")
+        data = msg.to_bytes()
+        self.assertEqual(len(data), SocketMessage.BINARY_HEADER.size + 1)
+        decoded = SocketMessage.from_bytes(data)
+        self.assertEqual(decoded.to_text(), msg.to_text())
+
+    def test_to_bytes_long_info(self):
+        info = ",".join(self.good_uid1 for i in range(2000))
+        msg = SocketMessage(sender=self.good_uid1, recipient=self.good_uid2, message=SocketMessage.WINNER, info=info)
+        self.assertEqual(SocketMessage.from_bytes(msg.to_bytes()).info, info)
+
+    def test_to_bytes_without_info(self):
+        msg = SocketMessage(sender=self.good_uid1, recipient=self.good_uid2, message=SocketMessage.JOIN)
+        decoded = SocketMessage.from_bytes(msg.to_bytes())
+        self.assertIsNone(decoded.info)
+        self.assertEqual(decoded.message, SocketMessage.JOIN)
+
+    def test_message_codes(self):
+        self.assertEqual(len(set(SocketMessage.message_codes.values())), len(SocketMessage.all_messages))
+        for msg, code in SocketMessage.message_codes.items():
+            self.assertEqual(SocketMessage.code_messages[code], msg)
+
+    def test_iter_bytes(self):
+        msgs = [SocketMessage(sender=self.good_uid1, recipient=self.good_uid2, message=m, info=i)
+                for m, i in (("JOIN", None), ("SUCCESS", "ünïcode"), ("LEAVE", None))]
+        decoded = list(SocketMessage.iter_bytes(bytearray(b"".join(m.to_bytes() for m in msgs))))
+        self.assertEqual([m.to_text() for m in decoded], [m.to_text() for m in msgs])
+
+    def test_invalid_from_bytes(self):
+        data = SocketMessage(sender=self.good_uid1, recipient=self.good_uid2, message="SUCCESS", info="abc").to_bytes()
+        nil_sender = bytes(16) + data[16:]
+        bad_info = data[:-3] + b"\xff\xfe\xfd"
+        for bad in (data[:20], data[:-1], data + b"x", data[:32] + b"\xff" + data[33:], nil_sender, bad_info):
+            with self.subTest(bad=bad):
+                with self.assertRaises(SocketMessageException):
+                    SocketMessage.from_bytes(bad)
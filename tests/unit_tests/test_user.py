@@ -1,4 +1,6 @@
 import unittest
+import weakref
+import gc
 from givr.user import User
 
 class TestUser(unittest.TestCase):
@@ -13,3 +15,19 @@ class TestUser(unittest.TestCase):
         self.assertEqual(test_id, u.user_id)
 
 
+    def test_user_from_id_interned(self):
+        u = User()
+        self.assertIs(User.from_user_id(u.user_id), u)
+        self.assertIs(User.from_user_id("TEST_INTERNED_ID"), User.from_user_id("TEST_INTERNED_ID"))
+
+    def test_user_hash_matches_eq(self):
+        u = User()
+        self.assertEqual(hash(u), hash(User.from_user_id(u.user_id)))
+        self.assertEqual(len({u, User.from_user_id(u.user_id)}), 1)
+
+    def test_unreferenced_user_freed(self):
+        u = User.from_user_id("TEST_FREED_ID")
+        ref = weakref.ref(u)
+        del u
+        gc.collect()
+        self.assertIsNone(ref())